@@ -0,0 +1,484 @@
+"""
+Benchmark suite for every hc_nlp component and the end-to-end pipeline, recording docs/sec, p50 and
+p99 latency per doc and peak RSS, and comparing them against a baseline. Components are run on:
+- a Label Studio export (e.g. `test/2020-11-25-11-43-02.zip` in the repository), processed by a
+  spaCy model;
+- synthetic docs (see `benchmarking.make_scaled_doc`) scaled by length and entity density;
+- for `thesaurus_matcher`, synthetic thesauri of increasing size, timing loading and matching.
+
+Run `python -m hc_nlp.benchmark_suite --labelstudio-path export.zip --baseline benchmarks.json` to
+write a baseline on the first run, and compare against it on later ones. Everything runs offline with an installed model
+(`en_core_web_sm` by default).
+
+`python -m hc_nlp.benchmark_suite --soak-docs 1000000` instead runs a soak test (see
+`run_memory_soak`), checking that RSS stays flat while a million docs of new token texts are
+processed.
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+import spacy
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+from hc_nlp import benchmarking, io, logging
+from hc_nlp.corpus import process_corpus
+from hc_nlp.snapshot import save_snapshot
+import hc_nlp.pipeline  # noqa: F401 (registers the hc_nlp factories)
+
+logger = logging.get_logger(__name__)
+
+# components run on docs which have already been processed by the spaCy model, with their config
+COMPONENTS = {
+    "date_matcher": {},
+    "entity_filter": {},
+    "entity_joiner": {},
+    "map_entity_types": {},
+    "duplicate_entity_detector": {},
+}
+
+# synthetic docs have no parse, so century dates are found from patterns
+SYNTHETIC_COMPONENTS = dict(COMPONENTS, date_matcher={"century_detection": "patterns"})
+
+# results compared against the baseline, and whether higher values are better
+COMPARED_METRICS = {
+    "docs_per_sec": True,
+    "p99_seconds": False,
+    "load_seconds": False,
+    "peak_rss_mb": False,
+}
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process so far, in MB."""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # bytes on macOS, kilobytes elsewhere
+    return max_rss / (1 << 20) if sys.platform == "darwin" else max_rss / (1 << 10)
+
+
+def current_rss_mb() -> float:
+    """
+    Current resident set size of this process in MB, where /proc is available (Linux), and
+    otherwise the peak so far.
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            rss_pages = int(f.read().split()[1])
+    except OSError:
+        return peak_rss_mb()
+
+    return rss_pages * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+
+
+def summarise_latencies(seconds: Sequence[float]) -> dict:
+    """
+    Docs/sec and p50/p99 latency from the seconds taken for each doc, and the peak RSS of the
+    process so far. As peak RSS never goes down, benchmarks run in order of increasing size.
+    """
+    seconds = np.asarray(seconds)
+
+    return {
+        "n_docs": len(seconds),
+        "docs_per_sec": float(len(seconds) / seconds.sum()),
+        "p50_seconds": float(np.percentile(seconds, 50)),
+        "p99_seconds": float(np.percentile(seconds, 99)),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def time_docs(
+    component: Callable,
+    make_docs: Callable[[], List[spacy.tokens.Doc]],
+    repeats: int = 3,
+) -> dict:
+    """
+    Time `component` on each doc from `make_docs`, keeping the fastest time for each doc over
+    `repeats` runs. New docs are made for each run, outside of the timing, as components edit
+    docs in place.
+    """
+    best = None
+
+    for _ in range(repeats):
+        docs = make_docs()
+        seconds = []
+
+        for doc in docs:
+            start = time.perf_counter()
+            component(doc)
+            seconds.append(time.perf_counter() - start)
+
+        best = seconds if best is None else np.minimum(best, seconds)
+
+    return summarise_latencies(best)
+
+
+def docs_from_bytes(
+    vocab: spacy.vocab.Vocab, doc_bytes: Sequence[bytes]
+) -> Callable[[], List[spacy.tokens.Doc]]:
+    """Returns a function making new copies of the serialised docs."""
+    return lambda: [spacy.tokens.Doc(vocab).from_bytes(b) for b in doc_bytes]
+
+
+def labelstudio_texts(path: str) -> List[str]:
+    """The texts of a Label Studio zip export."""
+    return [item["data"]["text"] for item in io.load_raw_labelstudio_results(path)]
+
+
+def run_suite(
+    labelstudio_path: str,
+    model: str = "en_core_web_sm",
+    thesaurus_sizes: Sequence[int] = (10_000, 100_000, 1_000_000),
+    thesaurus_backend: str = "phrase_matcher",
+    doc_lengths: Sequence[int] = (100, 1000, 10000),
+    densities: Sequence[float] = (0.1, 0.5, 1.0),
+    n_synthetic_docs: int = 20,
+    repeats: int = 3,
+    seed: int = 0,
+) -> dict:
+    """
+    Run every benchmark in the suite.
+
+    Args:
+        labelstudio_path (str): Label Studio zip export, e.g. `test/2020-11-25-11-43-02.zip` in
+            the repository.
+        model (str, optional): spaCy model to process the Label Studio texts with and to add hc_nlp
+            components to. Defaults to "en_core_web_sm".
+        thesaurus_sizes (Sequence[int], optional): numbers of entries in the synthetic thesauri.
+            Defaults to 10k, 100k and 1M.
+        thesaurus_backend (str, optional): see `thesaurus_matcher`. Defaults to "phrase_matcher".
+        doc_lengths (Sequence[int], optional): numbers of tokens in the synthetic docs.
+        densities (Sequence[float], optional): entity densities of the synthetic docs (see
+            `benchmarking.make_scaled_doc`).
+        n_synthetic_docs (int, optional): number of synthetic docs of each length and density.
+        repeats (int, optional): runs over each set of docs, keeping the fastest time per doc.
+        seed (int, optional): random seed for synthetic docs and thesauri. Defaults to 0.
+
+    Returns:
+        dict: with "meta" describing the run, and "benchmarks" mapping the name of each benchmark
+            to its results (see `summarise_latencies`).
+    """
+    nlp = spacy.load(model)
+    results = {}
+
+    texts = labelstudio_texts(labelstudio_path)
+    make_labelstudio_docs = docs_from_bytes(
+        nlp.vocab, [doc.to_bytes() for doc in nlp.pipe(texts)]
+    )
+
+    for name, config in COMPONENTS.items():
+        logger.info(f"Benchmarking {name} on Label Studio data")
+        component = nlp.create_pipe(name, config=config)
+        results[f"labelstudio/{name}"] = time_docs(
+            component, make_labelstudio_docs, repeats
+        )
+
+    for n_tokens in doc_lengths:
+        for density in densities:
+            docs = [
+                benchmarking.make_scaled_doc(nlp, n_tokens, density, seed + idx)
+                for idx in range(n_synthetic_docs)
+            ]
+            make_docs = docs_from_bytes(nlp.vocab, [doc.to_bytes() for doc in docs])
+
+            for name, config in SYNTHETIC_COMPONENTS.items():
+                logger.info(
+                    f"Benchmarking {name} on synthetic docs of {n_tokens} tokens, density {density}"
+                )
+                component = nlp.create_pipe(name, config=config)
+                results[f"synthetic/{name}/tokens={n_tokens}/density={density}"] = (
+                    time_docs(component, make_docs, repeats)
+                )
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for idx, n_entries in enumerate(sorted(thesaurus_sizes)):
+            thesaurus_path = os.path.join(tmp_dir, f"thesaurus_{n_entries}.jsonl")
+            benchmarking.write_synthetic_thesaurus(thesaurus_path, n_entries, seed)
+            config = {"thesaurus_path": thesaurus_path, "backend": thesaurus_backend}
+
+            logger.info(f"Benchmarking thesaurus_matcher with {n_entries} entries")
+            start = time.perf_counter()
+            component = nlp.create_pipe("thesaurus_matcher", config=config)
+            results[f"thesaurus/{n_entries}/load"] = {
+                "load_seconds": time.perf_counter() - start,
+                "peak_rss_mb": peak_rss_mb(),
+            }
+            results[f"thesaurus/{n_entries}/match"] = time_docs(
+                component, make_labelstudio_docs, repeats
+            )
+            del component
+
+            # the whole pipeline, with the smallest thesaurus
+            if idx == 0:
+                logger.info("Benchmarking the end-to-end pipeline on Label Studio data")
+                pipeline = spacy.load(model)
+                pipeline.add_pipe("thesaurus_matcher", config=config)
+                for name, component_config in COMPONENTS.items():
+                    pipeline.add_pipe(name, config=component_config)
+
+                results["labelstudio/end_to_end"] = time_docs(
+                    pipeline, lambda: texts, repeats
+                )
+
+    return {
+        "meta": {
+            "model": model,
+            "spacy_version": spacy.__version__,
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "time": time.time(),
+        },
+        "benchmarks": results,
+    }
+
+
+def make_soak_pipeline() -> spacy.language.Language:
+    """
+    Blank English pipeline for `run_memory_soak`, tagging synthetic names and places with an
+    entity ruler so that `EntityJoiner` and `DuplicateEntityDetector` set span extensions.
+    """
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns(
+        [
+            {
+                "label": "PERSON",
+                "pattern": [{"TEXT": {"REGEX": "^(Visitor|Quibble)"}, "OP": "+"}],
+            },
+            {"label": "LOC", "pattern": [{"TEXT": {"REGEX": "^(Town|Region)"}}]},
+        ]
+    )
+    nlp.add_pipe("entity_joiner")
+    nlp.add_pipe("map_entity_types")
+    nlp.add_pipe("duplicate_entity_detector")
+
+    return nlp
+
+
+def soak_texts(n_docs: int) -> Iterable[Tuple[str, str]]:
+    """(id, text) records where every doc has token texts not seen in any other doc."""
+    for idx in range(n_docs):
+        yield (
+            str(idx),
+            f"Visitor{idx} Quibble{idx} met Quibble{idx} in Town{idx} , Region{idx} in the morning .",
+        )
+
+
+def run_memory_soak(
+    n_docs: int = 1_000_000,
+    memory_window: Optional[int] = 10_000,
+    max_new_strings: int = 200_000,
+    n_samples: int = 20,
+) -> dict:
+    """
+    Process `n_docs` docs of new token texts with `process_corpus`, sampling the RSS of the process
+    and the number of strings in the pipeline's vocab as it goes. The pipeline is refreshed from
+    a snapshot where spaCy has no memory zones (see `process_corpus`).
+
+    Args:
+        n_docs (int, optional): number of docs. Defaults to 1M.
+        memory_window (Optional[int], optional): see `process_corpus`, or None to let the vocab
+            grow, for comparison. Defaults to 10k.
+        max_new_strings (int, optional): see `process_corpus`. Defaults to 200k.
+        n_samples (int, optional): number of times to sample RSS. Defaults to 20.
+
+    Returns:
+        dict: with "samples", a list of dicts of "docs", "rss_mb" and "strings", and "rss_growth_mb",
+            the growth in RSS between the first sample and the last.
+    """
+    nlp = make_soak_pipeline()
+    sample_every = max(n_docs // n_samples, 1)
+    samples = []
+    # the pipeline processing the docs, which changes each time it's refreshed
+    current = {"nlp": nlp}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        snapshot_path = os.path.join(tmp_dir, "snapshot")
+        save_snapshot(nlp, snapshot_path)
+
+        records = process_corpus(
+            nlp,
+            soak_texts(n_docs),
+            dedupe=False,
+            memory_window=memory_window,
+            snapshot_path=snapshot_path,
+            max_new_strings=max_new_strings,
+            on_refresh=lambda fresh: current.update(nlp=fresh),
+        )
+
+        for n_records, _ in enumerate(records, 1):
+            if n_records % sample_every == 0:
+                samples.append(
+                    {
+                        "docs": n_records,
+                        "rss_mb": current_rss_mb(),
+                        "strings": len(current["nlp"].vocab.strings),
+                    }
+                )
+                logger.info(f"Soak: {samples[-1]}")
+
+    return {
+        "n_docs": n_docs,
+        "memory_window": memory_window,
+        "memory_zones": hasattr(nlp, "memory_zone"),
+        "samples": samples,
+        "rss_growth_mb": samples[-1]["rss_mb"] - samples[0]["rss_mb"] if samples else 0.0,
+    }
+
+
+def compare_to_baseline(
+    results: dict, baseline: dict, tolerance: float = 0.2
+) -> List[str]:
+    """
+    Compare the results of a run of the suite against a baseline run.
+
+    Args:
+        results (dict): from `run_suite`
+        baseline (dict): from an earlier `run_suite`
+        tolerance (float, optional): fraction by which a metric in `COMPARED_METRICS` can be worse
+            than the baseline before it counts as a regression. Defaults to 0.2.
+
+    Returns:
+        List[str]: a description of each regression. Benchmarks missing from either run are
+            ignored.
+    """
+    regressions = []
+
+    for name, benchmark in results["benchmarks"].items():
+        baseline_benchmark = baseline["benchmarks"].get(name)
+        if baseline_benchmark is None:
+            continue
+
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in benchmark or metric not in baseline_benchmark:
+                continue
+
+            value = benchmark[metric]
+            baseline_value = baseline_benchmark[metric]
+
+            if higher_is_better:
+                regressed = value < baseline_value * (1 - tolerance)
+            else:
+                regressed = value > baseline_value * (1 + tolerance)
+
+            if regressed:
+                regressions.append(
+                    f"{name}: {metric} {value:.4g} vs baseline {baseline_value:.4g}"
+                )
+
+    return regressions
+
+
+def main(argv: Optional[Iterable[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Benchmark every hc_nlp component and the end-to-end pipeline, and compare against a baseline."
+    )
+    parser.add_argument(
+        "--baseline",
+        default="benchmarks.json",
+        help="JSON file of baseline results, written if it doesn't exist (default: benchmarks.json)",
+    )
+    parser.add_argument(
+        "--update-baseline",
+        action="store_true",
+        help="overwrite the baseline with the results of this run",
+    )
+    parser.add_argument("--output", default=None, help="JSON file to write results to")
+    parser.add_argument("--model", default="en_core_web_sm")
+    parser.add_argument(
+        "--labelstudio-path",
+        default=None,
+        help="Label Studio zip export to benchmark on, e.g. test/2020-11-25-11-43-02.zip in the repository (required unless --soak-docs is given)",
+    )
+    parser.add_argument(
+        "--thesaurus-sizes",
+        type=int,
+        nargs="+",
+        default=[10_000, 100_000, 1_000_000],
+    )
+    parser.add_argument("--thesaurus-backend", default="phrase_matcher")
+    parser.add_argument(
+        "--doc-lengths", type=int, nargs="+", default=[100, 1000, 10000]
+    )
+    parser.add_argument(
+        "--densities", type=float, nargs="+", default=[0.1, 0.5, 1.0]
+    )
+    parser.add_argument("--n-synthetic-docs", type=int, default=20)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="fraction by which a metric can be worse than the baseline (default: 0.2)",
+    )
+    parser.add_argument(
+        "--soak-docs",
+        type=int,
+        default=None,
+        help="run the memory soak test on this many docs instead of the suite",
+    )
+    parser.add_argument(
+        "--soak-max-growth-mb",
+        type=float,
+        default=50.0,
+        help="RSS growth over the soak test above which it fails (default: 50)",
+    )
+    args = parser.parse_args(argv)
+
+    if args.soak_docs:
+        soak = run_memory_soak(args.soak_docs)
+        print(json.dumps(soak, indent=2))
+
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(soak, f, indent=2)
+
+        return 0 if soak["rss_growth_mb"] <= args.soak_max_growth_mb else 1
+
+    if args.labelstudio_path is None:
+        parser.error("--labelstudio-path is required unless --soak-docs is given")
+
+    results = run_suite(
+        model=args.model,
+        labelstudio_path=args.labelstudio_path,
+        thesaurus_sizes=args.thesaurus_sizes,
+        thesaurus_backend=args.thesaurus_backend,
+        doc_lengths=args.doc_lengths,
+        densities=args.densities,
+        n_synthetic_docs=args.n_synthetic_docs,
+        repeats=args.repeats,
+    )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Wrote baseline to {args.baseline}")
+
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+
+    regressions = compare_to_baseline(results, baseline, args.tolerance)
+
+    for regression in regressions:
+        logger.warning(f"Regression: {regression}")
+
+    logger.info(
+        f"{len(regressions)} regressions against {args.baseline} in {len(results['benchmarks'])} benchmarks"
+    )
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
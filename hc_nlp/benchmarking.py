@@ -0,0 +1,467 @@
+"""
+Benchmarks for hc_nlp pipeline components, run on synthetic documents so that they can be scaled
+to any number of entities. Run `python -m hc_nlp.benchmarking` to print results as JSON.
+"""
+
+import spacy
+import numpy as np
+import json
+import os
+import random
+import tempfile
+import time
+from typing import Callable, Sequence
+
+# (words, entities as (start, end, label) relative to the words) for each kind of synthetic text
+# segment. Together these exercise every EntityJoiner pass and DuplicateEntityDetector rule.
+SYNTHETIC_SEGMENTS = [
+    (
+        ["Katharine", "and", "Charles", "Parsons", "met"],
+        [(0, 1, "PERSON"), (2, 4, "PERSON")],
+    ),
+    (["in", "Brighton", ",", "UK", "."], [(1, 2, "LOC"), (3, 4, "LOC")]),
+    (
+        ["London", "Victoria", "Station", "was", "busy"],
+        [(0, 1, "FAC"), (1, 2, "FAC"), (2, 3, "FAC")],
+    ),
+    (
+        ["the", "Science", "Museum", "opened", "in", "1909"],
+        [(1, 3, "ORG"), (5, 6, "DATE")],
+    ),
+    (["Parsons", "said", "so"], [(0, 1, "PERSON")]),
+    (["Apple", "Inc", "or", "Apple", "?"], [(0, 2, "ORG"), (3, 4, "ORG")]),
+    (
+        ["at", "Haymarket", ",", "London", "near", "Haymarket"],
+        [(1, 4, "LOC"), (5, 6, "LOC")],
+    ),
+    (["nothing", "to", "see", "here", "."], []),
+]
+
+
+def make_synthetic_doc(
+    nlp: spacy.language.Language, n_ents: int, seed: int = 0
+) -> spacy.tokens.Doc:
+    """
+    Create a doc with at least `n_ents` entities from randomly chosen `SYNTHETIC_SEGMENTS`.
+
+    Args:
+        nlp (spacy.language.Language): only its vocab is used.
+        n_ents (int): minimum number of entities in the doc.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        spacy.tokens.Doc
+    """
+    rng = random.Random(seed)
+    words = []
+    ents = []
+
+    while len(ents) < n_ents:
+        segment_words, segment_ents = rng.choice(SYNTHETIC_SEGMENTS)
+        ents += [
+            (start + len(words), end + len(words), label)
+            for start, end, label in segment_ents
+        ]
+        words += segment_words
+
+    doc = spacy.tokens.Doc(nlp.vocab, words=words)
+    doc.ents = [spacy.tokens.Span(doc, start, end, label) for start, end, label in ents]
+
+    return doc
+
+
+def make_scaled_doc(
+    nlp: spacy.language.Language, n_tokens: int, density: float, seed: int = 0
+) -> spacy.tokens.Doc:
+    """
+    Create a doc of at least `n_tokens` tokens from `SYNTHETIC_SEGMENTS`, where a fraction
+    `density` of the segments are ones with entities and the rest are ones without.
+
+    Args:
+        nlp (spacy.language.Language): only its vocab is used.
+        n_tokens (int): minimum number of tokens in the doc.
+        density (float): fraction of segments with entities, between 0 and 1.
+        seed (int, optional): random seed. Defaults to 0.
+
+    Returns:
+        spacy.tokens.Doc
+    """
+    rng = random.Random(seed)
+    ent_segments = [segment for segment in SYNTHETIC_SEGMENTS if segment[1]]
+    empty_segments = [segment for segment in SYNTHETIC_SEGMENTS if not segment[1]]
+    words = []
+    ents = []
+
+    while len(words) < n_tokens:
+        segments = ent_segments if rng.random() < density else empty_segments
+        segment_words, segment_ents = rng.choice(segments)
+        ents += [
+            (start + len(words), end + len(words), label)
+            for start, end, label in segment_ents
+        ]
+        words += segment_words
+
+    doc = spacy.tokens.Doc(nlp.vocab, words=words)
+    doc.ents = [spacy.tokens.Span(doc, start, end, label) for start, end, label in ents]
+
+    return doc
+
+
+def time_component(
+    component: Callable, make_doc: Callable[[], spacy.tokens.Doc], repeats: int = 3
+) -> float:
+    """
+    Return the best time in seconds over `repeats` runs of `component` on a doc. A new doc is
+    made with `make_doc` for each run, outside of the timing, as components edit docs in place.
+    """
+    times = []
+
+    for _ in range(repeats):
+        doc = make_doc()
+        start = time.perf_counter()
+        component(doc)
+        times.append(time.perf_counter() - start)
+
+    return min(times)
+
+
+def scaling_exponent(sizes: Sequence[int], times: Sequence[float]) -> float:
+    """
+    Estimate k where time ~ size^k, from the slope of a straight line fitted to log(time)
+    against log(size). Linear scaling gives k close to 1, quadratic close to 2.
+    """
+    return float(np.polyfit(np.log(sizes), np.log(times), 1)[0])
+
+
+def benchmark_scaling(
+    component: Callable,
+    sizes: Sequence[int],
+    repeats: int = 3,
+    seed: int = 0,
+) -> dict:
+    """
+    Time a component on synthetic docs with increasing numbers of entities.
+
+    Args:
+        component (Callable): pipeline component, created with a blank English pipeline.
+        sizes (Sequence[int]): numbers of entities in each doc.
+        repeats (int, optional): runs per doc, of which the fastest is kept. Defaults to 3.
+        seed (int, optional): random seed for the synthetic docs. Defaults to 0.
+
+    Returns:
+        dict: with keys "sizes", "seconds" and "scaling_exponent".
+    """
+    nlp = spacy.blank("en")
+
+    seconds = [
+        time_component(
+            component, lambda: make_synthetic_doc(nlp, n_ents, seed), repeats
+        )
+        for n_ents in sizes
+    ]
+
+    return {
+        "sizes": list(sizes),
+        "seconds": seconds,
+        "scaling_exponent": scaling_exponent(sizes, seconds),
+    }
+
+
+def benchmark_entity_joiner(
+    sizes: Sequence[int] = (500, 1000, 2000, 4000, 8000),
+    repeats: int = 3,
+    seed: int = 0,
+) -> dict:
+    """
+    Time the EntityJoiner on synthetic docs with increasing numbers of entities.
+    """
+    from hc_nlp.pipeline import EntityJoiner
+
+    entity_joiner = EntityJoiner(spacy.blank("en"), "entity_joiner")
+
+    return benchmark_scaling(entity_joiner, sizes, repeats, seed)
+
+
+def benchmark_duplicate_entity_detector(
+    sizes: Sequence[int] = (500, 1000, 2000, 4000, 8000),
+    repeats: int = 3,
+    seed: int = 0,
+) -> dict:
+    """
+    Time the DuplicateEntityDetector on synthetic docs with increasing numbers of entities.
+    """
+    from hc_nlp.pipeline import DuplicateEntityDetector
+
+    duplicate_entity_detector = DuplicateEntityDetector(
+        spacy.blank("en"), "duplicate_entity_detector"
+    )
+
+    return benchmark_scaling(duplicate_entity_detector, sizes, repeats, seed)
+
+
+def benchmark_hc_postprocess(
+    n_ents: int = 100,
+    n_docs: int = 200,
+    repeats: int = 3,
+    seed: int = 0,
+) -> dict:
+    """
+    Time the fused hc_postprocess component against entity_filter, entity_joiner,
+    map_entity_types and duplicate_entity_detector run one after the other, on synthetic docs.
+
+    Args:
+        n_ents (int, optional): minimum number of entities in each doc. Defaults to 100.
+        n_docs (int, optional): number of docs. Defaults to 200.
+        repeats (int, optional): runs over all docs, of which the fastest is kept. Defaults to 3.
+        seed (int, optional): random seed for the synthetic docs. Defaults to 0.
+
+    Returns:
+        dict: with keys "seconds_per_doc_chained", "seconds_per_doc_fused" and "speedup".
+    """
+    from hc_nlp.pipeline import (
+        EntityFilter,
+        EntityJoiner,
+        MapEntityTypes,
+        DuplicateEntityDetector,
+        HCPostprocess,
+    )
+
+    nlp = spacy.blank("en")
+    chained = [
+        EntityFilter(nlp, "entity_filter"),
+        EntityJoiner(nlp, "entity_joiner"),
+        MapEntityTypes(nlp, "map_entity_types"),
+        DuplicateEntityDetector(nlp, "duplicate_entity_detector"),
+    ]
+    fused = HCPostprocess(nlp, "hc_postprocess")
+
+    def run_chained(docs):
+        for doc in docs:
+            for component in chained:
+                doc = component(doc)
+
+    def run_fused(docs):
+        for doc in docs:
+            fused(doc)
+
+    make_docs = lambda: [
+        make_synthetic_doc(nlp, n_ents, seed + idx) for idx in range(n_docs)
+    ]
+    seconds_chained = time_component(run_chained, make_docs, repeats) / n_docs
+    seconds_fused = time_component(run_fused, make_docs, repeats) / n_docs
+
+    return {
+        "seconds_per_doc_chained": seconds_chained,
+        "seconds_per_doc_fused": seconds_fused,
+        "speedup": seconds_chained / seconds_fused,
+    }
+
+
+def benchmark_instrumentation_overhead(
+    n_ents: int = 100,
+    n_docs: int = 200,
+    repeats: int = 10,
+    seed: int = 0,
+    max_overhead: float = 0.01,
+) -> dict:
+    """
+    Time the instrumentation (see `instrumentation.instrument_pipeline`) of entity_filter,
+    entity_joiner, map_entity_types and duplicate_entity_detector on synthetic docs, and check
+    that it adds less than `max_overhead` to the time they take.
+
+    The overhead is a few microseconds per doc, less than the variation between runs of the
+    components themselves, so it's timed on its own: as the time taken by
+    `InstrumentedComponent`s wrapping components which do nothing, less the time taken by the
+    same components unwrapped.
+
+    Returns:
+        dict: with keys "seconds_per_doc", "overhead_seconds_per_doc" and "overhead" (the
+            fraction of extra time taken with instrumentation).
+
+    Raises:
+        AssertionError: if "overhead" is `max_overhead` or more.
+    """
+    from hc_nlp import instrumentation
+    import hc_nlp.pipeline  # noqa: F401 (registers the hc_nlp factories)
+
+    nlp = spacy.blank("en")
+    for factory in [
+        "entity_filter",
+        "entity_joiner",
+        "map_entity_types",
+        "duplicate_entity_detector",
+    ]:
+        nlp.add_pipe(factory)
+
+    def runner(components):
+        def run(docs):
+            for doc in docs:
+                for component in components:
+                    doc = component(doc)
+
+        return run
+
+    def identity(doc):
+        return doc
+
+    bare = [identity for _ in nlp.pipe_names]
+    wrapped = []
+    for name in nlp.pipe_names:
+        wrapped.append(
+            instrumentation.InstrumentedComponent(
+                name, identity, wrapped[-1] if wrapped else None
+            )
+        )
+
+    make_docs = lambda: [
+        make_synthetic_doc(nlp, n_ents, seed + idx) for idx in range(n_docs)
+    ]
+    seconds = (
+        time_component(runner([component for _, component in nlp.pipeline]), make_docs, repeats)
+        / n_docs
+    )
+
+    # components which do nothing leave the docs as they are, so they can be reused. The two
+    # are alternated so that both see the same conditions.
+    docs = make_docs()
+    seconds_bare = []
+    seconds_wrapped = []
+    for _ in range(repeats):
+        seconds_bare.append(time_component(runner(bare), lambda: docs, 1) / n_docs)
+        seconds_wrapped.append(time_component(runner(wrapped), lambda: docs, 1) / n_docs)
+
+    overhead_seconds = max(min(seconds_wrapped) - min(seconds_bare), 0.0)
+    overhead = overhead_seconds / seconds
+
+    assert (
+        overhead < max_overhead
+    ), f"Instrumentation adds {overhead:.2%} to the time taken, over the budget of {max_overhead:.2%}"
+
+    return {
+        "seconds_per_doc": seconds,
+        "overhead_seconds_per_doc": overhead_seconds,
+        "overhead": overhead,
+    }
+
+
+def write_synthetic_thesaurus(path: str, n_entries: int, seed: int = 0):
+    """
+    Write a thesaurus JSONL file of `n_entries` entries with random labels and patterns of one
+    to three words, each made unique by a number.
+    """
+    rng = random.Random(seed)
+    labels = ["PERSON", "ORG", "LOC", "OBJECT"]
+    words = ["steam", "engine", "museum", "locomotive", "co"]
+
+    with open(path, "w") as f:
+        for idx in range(n_entries):
+            pattern = " ".join(rng.choice(words) for _ in range(rng.randint(1, 3)))
+            f.write(
+                json.dumps(
+                    {
+                        "label": rng.choice(labels),
+                        "pattern": f"{pattern} {idx}",
+                        "id": f"id{idx}",
+                    }
+                )
+                + "\n"
+            )
+
+
+def benchmark_snapshot_startup(n_entries: int = 20000, seed: int = 0) -> dict:
+    """
+    Time building a pipeline with a synthetic thesaurus of `n_entries` entries and the other
+    hc_nlp components, against loading it from a snapshot (see `snapshot.measure_snapshot_startup`).
+    """
+    from hc_nlp import snapshot
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        thesaurus_path = os.path.join(tmp_dir, "thesaurus.jsonl")
+        write_synthetic_thesaurus(thesaurus_path, n_entries, seed)
+
+        def build():
+            nlp = spacy.blank("en")
+            nlp.add_pipe(
+                "thesaurus_matcher", config={"thesaurus_path": thesaurus_path}
+            )
+            nlp.add_pipe("date_matcher", config={"century_detection": "patterns"})
+            for factory in [
+                "entity_filter",
+                "entity_joiner",
+                "map_entity_types",
+                "duplicate_entity_detector",
+            ]:
+                nlp.add_pipe(factory)
+
+            return nlp
+
+        return snapshot.measure_snapshot_startup(
+            build, os.path.join(tmp_dir, "snapshot")
+        )
+
+
+def benchmark_mention_memory(n_ents: int = 20, n_docs: int = 1000, seed: int = 0) -> dict:
+    """
+    Memory held by processed docs, with `user_data` set by entity_joiner and
+    duplicate_entity_detector, against the `EntityMention`s extracted from them (see
+    `mentions.doc_to_mentions`), as measured by tracemalloc.
+
+    Returns:
+        dict: with keys "doc_bytes_per_record", "mention_bytes_per_record" and "ratio".
+    """
+    import gc
+    import tracemalloc
+    from hc_nlp.mentions import doc_to_mentions
+    import hc_nlp.pipeline  # noqa: F401 (registers the hc_nlp factories)
+
+    nlp = spacy.blank("en")
+    nlp.add_pipe("entity_joiner")
+    nlp.add_pipe("duplicate_entity_detector")
+
+    def process(idx):
+        doc = make_synthetic_doc(nlp, n_ents, seed + idx)
+        for _, component in nlp.pipeline:
+            doc = component(doc)
+
+        return doc
+
+    # warm up, so that strings added to the vocab aren't counted
+    [process(idx) for idx in range(n_docs)]
+
+    def measure(make_results) -> float:
+        gc.collect()
+        tracemalloc.start()
+        results = make_results()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del results
+
+        return size / n_docs
+
+    doc_bytes = measure(lambda: [process(idx) for idx in range(n_docs)])
+    mention_bytes = measure(
+        lambda: [doc_to_mentions(process(idx), str(idx)) for idx in range(n_docs)]
+    )
+
+    return {
+        "doc_bytes_per_record": doc_bytes,
+        "mention_bytes_per_record": mention_bytes,
+        "ratio": doc_bytes / mention_bytes,
+    }
+
+
+if __name__ == "__main__":
+    print(
+        json.dumps(
+            {
+                "entity_joiner": benchmark_entity_joiner(),
+                "duplicate_entity_detector": benchmark_duplicate_entity_detector(),
+                "hc_postprocess": benchmark_hc_postprocess(),
+                "snapshot_startup": benchmark_snapshot_startup(),
+                "instrumentation_overhead": benchmark_instrumentation_overhead(),
+                "mention_memory": benchmark_mention_memory(),
+            },
+            indent=2,
+        )
+    )
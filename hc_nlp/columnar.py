@@ -0,0 +1,289 @@
+"""
+Streaming columnar export of annotation results, as an alternative to JSONL or a `DocBin`. Entity
+records (see `corpus.doc_to_record`) are written to two files in an output directory, in batches
+of rows as they are produced:
+- `mentions`: a row for each entity, with the columns of `mentions.MENTION_FIELDS`;
+- `documents`: a row for each record, with its id and number of entities.
+
+Files are either Parquet (`format="parquet"`), with a row group per batch, or Arrow IPC
+(`format="arrow"`), with a record batch per batch, which can be memory-mapped and read without
+copying. Labels and entity ids are dictionary-encoded, so they are stored once per row group or
+file rather than once per row. Either can be read a few columns at a time with `read_table`.
+
+Needs pyarrow to be installed, e.g. with `pip install hc-nlp[columnar]`.
+"""
+
+import json
+import os
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+from hc_nlp import logging
+from hc_nlp.mentions import MENTION_FIELDS
+
+logger = logging.get_logger(__name__)
+
+FORMATS = {"parquet": ".parquet", "arrow": ".arrow"}
+MENTIONS_NAME = "mentions"
+DOCUMENTS_NAME = "documents"
+
+# mention fields which take few distinct values, and are dictionary-encoded
+DICTIONARY_FIELDS = ("label", "ent_id")
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError(
+            "pyarrow is needed for columnar export: install it with `pip install hc-nlp[columnar]`"
+        ) from e
+
+    return pyarrow
+
+
+def mention_schema(metadata: Optional[Dict[str, Any]] = None):
+    """
+    Arrow schema of the mentions file. `metadata` is stored in the schema, with each value
+    JSON-encoded.
+    """
+    pa = _import_pyarrow()
+    types = {
+        "record_id": pa.string(),
+        "start_char": pa.int64(),
+        "end_char": pa.int64(),
+        "label": pa.dictionary(pa.int32(), pa.string()),
+        "ent_id": pa.dictionary(pa.int32(), pa.string()),
+        "alt_ent_text": pa.string(),
+        "entity_co_occurrence": pa.string(),
+        "entity_duplicate": pa.bool_(),
+    }
+
+    return pa.schema(
+        [(field, types[field]) for field in MENTION_FIELDS],
+        metadata=_encode_metadata(metadata),
+    )
+
+
+def document_schema(metadata: Optional[Dict[str, Any]] = None):
+    """Arrow schema of the documents file. `metadata` is as for `mention_schema`."""
+    pa = _import_pyarrow()
+
+    return pa.schema(
+        [("record_id", pa.string()), ("n_ents", pa.int32())],
+        metadata=_encode_metadata(metadata),
+    )
+
+
+def _encode_metadata(metadata: Optional[Dict[str, Any]]) -> Optional[Dict[str, str]]:
+    if not metadata:
+        return None
+
+    return {key: json.dumps(value) for key, value in metadata.items()}
+
+
+def output_paths(output_dir: str, format: str = "parquet") -> Dict[str, str]:
+    """Paths of the mentions and documents files in `output_dir`."""
+    if format not in FORMATS:
+        raise ValueError(f"format must be one of {list(FORMATS)}, not {format!r}")
+
+    return {
+        name: os.path.join(output_dir, name + FORMATS[format])
+        for name in (MENTIONS_NAME, DOCUMENTS_NAME)
+    }
+
+
+class _TableWriter:
+    """
+    Buffers rows of one table as columns of Python values, and writes them out as a Parquet row
+    group or an Arrow IPC record batch once there are `batch_size` of them.
+
+    Parquet encodes dictionaries per row group, so each batch has a dictionary of just the
+    values in it. Arrow IPC files can only extend a dictionary between batches, so there each
+    dictionary grows as new values are seen, and only the new values are written.
+    """
+
+    def __init__(self, path: str, schema, format: str, batch_size: int):
+        pa = _import_pyarrow()
+        self.schema = schema
+        self.format = format
+        self.batch_size = batch_size
+        self.columns = {name: [] for name in schema.names}
+        self.n_rows = 0
+        self.dictionaries = {
+            field.name: {}
+            for field in schema
+            if pa.types.is_dictionary(field.type)
+        }
+
+        if format == "parquet":
+            self.writer = pa.parquet.ParquetWriter(path, schema)
+        else:
+            self.writer = pa.ipc.new_file(
+                path,
+                schema,
+                options=pa.ipc.IpcWriteOptions(emit_dictionary_deltas=True),
+            )
+
+    def append(self, row: Sequence[Any]):
+        for column, value in zip(self.columns.values(), row):
+            column.append(value)
+
+        if len(self.columns[self.schema.names[0]]) >= self.batch_size:
+            self.flush()
+
+    def _dictionary_array(self, name: str, values: List[Optional[str]]):
+        pa = _import_pyarrow()
+
+        if self.format == "parquet":
+            return pa.array(values, pa.string()).dictionary_encode()
+
+        indices = self.dictionaries[name]
+        codes = [
+            None if value is None else indices.setdefault(value, len(indices))
+            for value in values
+        ]
+
+        return pa.DictionaryArray.from_arrays(
+            pa.array(codes, pa.int32()), pa.array(list(indices), pa.string())
+        )
+
+    def flush(self):
+        pa = _import_pyarrow()
+        n_rows = len(self.columns[self.schema.names[0]])
+        if not n_rows:
+            return
+
+        arrays = [
+            self._dictionary_array(field.name, self.columns[field.name])
+            if field.name in self.dictionaries
+            else pa.array(self.columns[field.name], field.type)
+            for field in self.schema
+        ]
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+        if self.format == "parquet":
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+        self.n_rows += n_rows
+        for column in self.columns.values():
+            column.clear()
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class ColumnarWriter:
+    """
+    Writes entity records to mentions and documents files in `output_dir` (see the module
+    docstring), in batches of at most `batch_size` rows. Use as a context manager, or call `close`
+    to write the last batch and finish the files.
+
+    Args:
+        output_dir (str): directory to write to, created if it doesn't exist.
+        format (str, optional): "parquet" or "arrow". Defaults to "parquet".
+        batch_size (int, optional): rows per Parquet row group or Arrow record batch. Defaults
+            to 100,000.
+        metadata (Optional[Dict[str, Any]], optional): stored in the schema of both files, e.g.
+            the pipeline fingerprint. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        format: str = "parquet",
+        batch_size: int = 100_000,
+        metadata: Optional[Dict[str, Any]] = None,
+    ):
+        paths = output_paths(output_dir, format)
+        os.makedirs(output_dir, exist_ok=True)
+
+        self.mentions = _TableWriter(
+            paths[MENTIONS_NAME], mention_schema(metadata), format, batch_size
+        )
+        self.documents = _TableWriter(
+            paths[DOCUMENTS_NAME], document_schema(metadata), format, batch_size
+        )
+
+    def write_record(self, record: dict):
+        """Write an entity record, as produced by `corpus.process_corpus`."""
+        record_id = str(record["id"])
+
+        for ent in record["ents"]:
+            self.mentions.append([record_id] + list(ent))
+
+        self.documents.append([record_id, len(record["ents"])])
+
+    def close(self):
+        self.mentions.close()
+        self.documents.close()
+
+    def __enter__(self) -> "ColumnarWriter":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_columnar(
+    records: Iterable[dict],
+    output_dir: str,
+    format: str = "parquet",
+    batch_size: int = 100_000,
+    metadata: Optional[Dict[str, Any]] = None,
+) -> int:
+    """
+    Write entity records to columnar files as they are produced, the columnar counterpart of
+    `corpus.write_records`. Arguments are as for `ColumnarWriter`.
+
+    Returns:
+        int: number of records written.
+    """
+    with ColumnarWriter(output_dir, format, batch_size, metadata) as writer:
+        for record in records:
+            writer.write_record(record)
+
+    logger.debug(
+        f"Wrote {writer.mentions.n_rows} mentions of {writer.documents.n_rows} records to {output_dir}"
+    )
+
+    return writer.documents.n_rows
+
+
+def read_table(path: str, columns: Optional[Sequence[str]] = None):
+    """
+    Read a mentions or documents file, memory-mapped and only reading `columns` if given.
+    Arrow IPC files are read without copying.
+
+    Returns:
+        pyarrow.Table
+    """
+    pa = _import_pyarrow()
+
+    if path.endswith(FORMATS["parquet"]):
+        return pa.parquet.read_table(path, columns=columns, memory_map=True)
+
+    with pa.memory_map(path) as source:
+        table = pa.ipc.open_file(source).read_all()
+
+    return table.select(columns) if columns is not None else table
+
+
+def read_metadata(path: str) -> Dict[str, Any]:
+    """The metadata stored in a mentions or documents file by `ColumnarWriter`."""
+    pa = _import_pyarrow()
+
+    if path.endswith(FORMATS["parquet"]):
+        schema = pa.parquet.read_schema(path)
+    else:
+        with pa.memory_map(path) as source:
+            schema = pa.ipc.open_file(source).schema
+
+    return {
+        key.decode(): json.loads(value)
+        for key, value in (schema.metadata or {}).items()
+        if not key.startswith(b"ARROW:")
+    }
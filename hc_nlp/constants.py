@@ -14,6 +14,11 @@ DATE_PATTERNS = [
     {"label": "DATE", "pattern": [{"SHAPE": "dddd"}, {"ORTH": "to"}, {"SHAPE": "dddd"}]},  # 1805 to 1860
 ]
 
+# every pattern in DATE_PATTERNS needs a digit, and every century date the word century/centuries,
+# so docs whose text doesn't match these can skip date matching
+DATE_PRESCAN_REGEX = r"\d"
+CENTURY_PRESCAN_REGEX = r"(?i)centur(y|ies)"
+
 COLLECTION_NAME_PATTERNS = [
     # TODO: use 'POS': 'PROPN' here instead of IS_TITLE: True for better detection of proper nouns
     {"label": "ORG", "pattern": [{'IS_TITLE': True, 'OP': '+'}, {'LOWER': 'collection'}]},  # Sforza collection
@@ -30,6 +35,14 @@ ORDINALS = [
     "seventeenth", "eighteenth", "nineteenth", "twentieth", "twenty-first"
 ]
 
+# used to find the start of "nth century" dates without the dependency parse, e.g.
+# "the second half of the 19th century", "early 18th to late 19th centuries"
+CENTURY_CONNECTORS = ["and", "to", "or"]
+CENTURY_MODIFIERS = ["the", "early", "late", "mid", "middle"]
+CENTURY_FRACTIONS = ["half", "quarter"]
+# max number of modifiers (or "<ordinal> <fraction> (of)" phrases) to the left of an ordinal
+CENTURY_MODIFIER_WINDOW = 3
+
 ROYAL_TITLES = [
     "king", "queen", "prince", "princess", "emperor", "empress"
 ]
@@ -0,0 +1,924 @@
+"""
+Batch annotation of a corpus with an hc_nlp pipeline. Records are read as a stream from a JSONL or
+CSV file, run through `nlp.pipe`, and written out as compact entity records as they are produced,
+so that corpora of any size can be annotated in bounded memory.
+
+Run `python -m hc_nlp.corpus --help` for the command line interface.
+"""
+
+import argparse
+import csv
+import gc
+import itertools
+import json
+import queue
+import threading
+import time
+import spacy
+from collections import defaultdict, deque
+from spacy.pipeline import Sentencizer
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from hc_nlp import logging
+from hc_nlp.columnar import FORMATS, write_columnar
+from hc_nlp.instrumentation import (
+    PipelineInstrumentation,
+    instrument_pipeline,
+    transfer_instrumentation,
+    uninstrument_pipeline,
+)
+from hc_nlp.mentions import ENT_EXTENSIONS, doc_to_mentions  # noqa: F401
+from hc_nlp.result_cache import ResultCache, pipeline_fingerprint, text_hash
+from hc_nlp.snapshot import is_snapshot, load_pipeline, load_snapshot
+import hc_nlp.pipeline  # noqa: F401 (registers the hc_nlp factories for spacy.load)
+
+logger = logging.get_logger(__name__)
+
+# marks the end of the items in a queue
+_DONE = object()
+
+# windows in a row with nothing to process after which `_process_windowed` ends its stream of
+# texts to process
+_MAX_IDLE_WINDOWS = 2
+
+
+class _Error:
+    """Wraps an exception raised in a background thread, to be raised again in the main thread."""
+
+    def __init__(self, exception: Exception):
+        self.exception = exception
+
+
+def read_records(
+    path: str, id_field: str = "id", text_field: str = "text"
+) -> Iterator[Tuple[str, str]]:
+    """
+    Read (id, text) records one at a time from a JSONL or CSV file. The format is taken from the
+    file extension: ".csv" for CSV with a header row, and JSONL otherwise.
+
+    Args:
+        path (str): path to the file.
+        id_field (str, optional): name of the id field. Defaults to "id".
+        text_field (str, optional): name of the text field. Defaults to "text".
+
+    Yields:
+        Tuple[str, str]: id, text
+    """
+    with open(path, "r", encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            for row in csv.DictReader(f):
+                yield row[id_field], row[text_field] or ""
+
+        else:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record[id_field], record[text_field] or ""
+
+
+def doc_to_record(doc: spacy.tokens.Doc, record_id: str) -> dict:
+    """
+    Returns a compact record of the entities in a doc: its id, and for each entity its
+    character offsets, label, entity id (if any) and the values of `ENT_EXTENSIONS` (None for
+    extensions that aren't registered). See `mentions.doc_to_mentions`.
+    """
+    return {
+        "id": record_id,
+        "ents": [mention.to_list() for mention in doc_to_mentions(doc, record_id)],
+    }
+
+
+def prefetch(iterable: Iterable, max_size: int) -> Iterator:
+    """
+    Iterate over `iterable` in a background thread, keeping at most `max_size` items in a queue
+    ahead of the consumer. The background thread blocks when the queue is full, so a slow
+    consumer applies back-pressure to the producer.
+    """
+    items = queue.Queue(maxsize=max_size)
+
+    def produce():
+        try:
+            for item in iterable:
+                items.put(item)
+        except Exception as e:
+            items.put(_Error(e))
+        finally:
+            items.put(_DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    while True:
+        item = items.get()
+
+        if item is _DONE:
+            return
+        elif isinstance(item, _Error):
+            raise item.exception
+
+        yield item
+
+
+def length_bucket(n_tokens: int) -> int:
+    """
+    Returns the length bucket for a doc with `n_tokens` tokens. Bucket b holds docs with
+    2^(b-1) to 2^b - 1 tokens, and bucket 0 empty docs.
+    """
+    return n_tokens.bit_length()
+
+
+def length_bucketed_batches(
+    lengths: Sequence[int], token_budget: int
+) -> Iterator[Tuple[int, List[int]]]:
+    """
+    Group docs into batches of docs from the same length bucket (see `length_bucket`), so that
+    little of each batch is padding. Each batch has as many docs as fit in `token_budget` once
+    padded to the length of the longest doc in the batch, and at least one doc.
+
+    Args:
+        lengths (Sequence[int]): number of tokens in each doc.
+        token_budget (int): maximum number of padded tokens in a batch.
+
+    Yields:
+        Tuple[int, List[int]]: length bucket, and positions in `lengths` of the docs in the batch.
+    """
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx])
+
+    for bucket, positions in itertools.groupby(
+        order, key=lambda idx: length_bucket(lengths[idx])
+    ):
+        batch = []
+
+        for idx in positions:
+            # docs are in order of length, so this doc is the longest in the batch
+            if batch and (len(batch) + 1) * lengths[idx] > token_budget:
+                yield bucket, batch
+                batch = []
+
+            batch.append(idx)
+
+        if batch:
+            yield bucket, batch
+
+
+class BucketStats:
+    """
+    Numbers of docs, tokens and padded tokens, and processing time, for each length bucket.
+    """
+
+    def __init__(self):
+        self.buckets = defaultdict(
+            lambda: {"docs": 0, "tokens": 0, "padded_tokens": 0, "seconds": 0.0}
+        )
+
+    def add(self, bucket: int, lengths: Sequence[int], seconds: float):
+        """Add a batch of docs with `lengths` tokens, which took `seconds` to process."""
+        stats = self.buckets[bucket]
+        stats["docs"] += len(lengths)
+        stats["tokens"] += sum(lengths)
+        stats["padded_tokens"] += len(lengths) * max(lengths)
+        stats["seconds"] += seconds
+
+    def report(self) -> Dict[int, dict]:
+        """
+        Returns the stats for each bucket, with the fraction of padded tokens that are padding
+        (`padding_ratio`) and the number of docs processed per second (`docs_per_sec`).
+        """
+        report = {}
+
+        for bucket, stats in sorted(self.buckets.items()):
+            report[bucket] = dict(
+                stats,
+                min_tokens=(1 << bucket) >> 1,
+                max_tokens=(1 << bucket) - 1,
+                padding_ratio=(
+                    1 - stats["tokens"] / stats["padded_tokens"]
+                    if stats["padded_tokens"]
+                    else 0.0
+                ),
+                docs_per_sec=(
+                    stats["docs"] / stats["seconds"] if stats["seconds"] else 0.0
+                ),
+            )
+
+        return report
+
+
+def _apply_pipeline(
+    nlp: spacy.language.Language, docs: List[spacy.tokens.Doc]
+) -> List[spacy.tokens.Doc]:
+    """
+    Runs the components of `nlp` over already tokenized docs as one batch.
+    """
+    for _, proc in nlp.pipeline:
+        if hasattr(proc, "pipe"):
+            docs = list(proc.pipe(docs, batch_size=len(docs)))
+        else:
+            docs = [proc(doc) for doc in docs]
+
+    return docs
+
+
+def _process_bucketed(
+    nlp: spacy.language.Language,
+    records: Iterable[Tuple[str, str]],
+    token_budget: int,
+    window_size: int,
+    bucket_stats: BucketStats,
+) -> Iterator[dict]:
+    """
+    Tokenize records `window_size` at a time, and run the pipeline over them in length-bucketed
+    batches (see `length_bucketed_batches`), yielding entity records in input order.
+    """
+    records = iter(records)
+
+    while True:
+        window = list(itertools.islice(records, window_size))
+        if not window:
+            return
+
+        docs = list(nlp.tokenizer.pipe([text for _, text in window]))
+        lengths = [len(doc) for doc in docs]
+        results = [None] * len(window)
+
+        for bucket, batch in length_bucketed_batches(lengths, token_budget):
+            start = time.perf_counter()
+            batch_docs = _apply_pipeline(nlp, [docs[idx] for idx in batch])
+            bucket_stats.add(
+                bucket, [lengths[idx] for idx in batch], time.perf_counter() - start
+            )
+
+            for idx, doc in zip(batch, batch_docs):
+                results[idx] = doc_to_record(doc, window[idx][0])
+
+        yield from results
+
+
+def _process_records(
+    nlp: spacy.language.Language,
+    records: Iterable[Tuple[str, str]],
+    batch_size: int,
+    n_process: int,
+    token_budget: Optional[int],
+    window_size: int,
+    bucket_stats: BucketStats,
+) -> Iterator[dict]:
+    """
+    Run records through the pipeline, in length-bucketed batches if `token_budget` is set and
+    otherwise with `nlp.pipe`, yielding entity records in input order.
+    """
+    if token_budget is not None:
+        yield from _process_bucketed(
+            nlp, records, token_budget, window_size, bucket_stats
+        )
+        return
+
+    texts_with_ids = ((text, record_id) for record_id, text in records)
+
+    for doc, record_id in nlp.pipe(
+        texts_with_ids, as_tuples=True, batch_size=batch_size, n_process=n_process
+    ):
+        yield doc_to_record(doc, record_id)
+
+
+def _split_sentences(
+    nlp: spacy.language.Language, sentencizer: Sentencizer, text: str
+) -> List[Tuple[int, str]]:
+    """Returns the character offset and text of each sentence in `text`."""
+    doc = sentencizer(nlp.make_doc(text))
+
+    return [(sent.start_char, sent.text) for sent in doc.sents]
+
+
+def _process_windowed(
+    nlp: spacy.language.Language,
+    records: Iterable[Tuple[str, str]],
+    window_size: int,
+    cache: Optional[ResultCache],
+    sentence_level: bool,
+    **kwargs,
+) -> Iterator[dict]:
+    """
+    Process records `window_size` at a time, running each distinct text in a window through the
+    pipeline (see `_process_records`) only once, and only if it isn't in `cache`. The results are
+    copied to every record with that text, and cached. Yields entity records in input order.
+
+    Texts to process from every window are fed into one streaming `_process_records` call, so
+    that with `n_process` > 1 worker processes are only started once rather than once per
+    window. Windows are held until all of their results are back, and results only until the
+    last window using them is yielded. As windows with nothing to process don't feed the
+    stream, it's ended after `_MAX_IDLE_WINDOWS` of them in a row so that they aren't held
+    back indefinitely, and started again when a window has texts to process.
+
+    If `sentence_level`, the distinct texts are sentences rather than whole records, and each
+    record's entities are put together from those of its sentences.
+    """
+    sentencizer = Sentencizer() if sentence_level else None
+    records = iter(records)
+
+    # windows read but not yet yielded, as (window, record units, unit hashes)
+    pending = deque()
+    # results for the units of pending windows, the number of units in pending windows with
+    # each hash, and the hashes of texts sent to the pipeline whose results aren't back yet
+    results = {}
+    n_units = defaultdict(int)
+    in_flight = set()
+    # results to add to the cache
+    new_results = {}
+
+    def read_window() -> Optional[Dict[str, str]]:
+        """
+        Read the next window into `pending`, returning the texts in it to process by hash, or
+        None if there are no more records.
+        """
+        window = list(itertools.islice(records, window_size))
+        if not window:
+            return None
+
+        # (character offset, text) of the parts of each record which are processed separately
+        record_units = [
+            _split_sentences(nlp, sentencizer, text) if sentence_level else [(0, text)]
+            for _, text in window
+        ]
+        unit_hashes = [
+            [text_hash(text) for _, text in units] for units in record_units
+        ]
+
+        for h in itertools.chain(*unit_hashes):
+            n_units[h] += 1
+
+        if cache is not None:
+            results.update(
+                cache.get_many(
+                    {
+                        h
+                        for h in itertools.chain(*unit_hashes)
+                        if h not in results and h not in in_flight
+                    }
+                )
+            )
+
+        texts_to_process = {}
+        for units, hashes in zip(record_units, unit_hashes):
+            for (_, text), h in zip(units, hashes):
+                if h not in results and h not in in_flight:
+                    texts_to_process.setdefault(h, text)
+
+        in_flight.update(texts_to_process)
+        pending.append((window, record_units, unit_hashes))
+
+        return texts_to_process
+
+    def stream_texts(texts_to_process: Dict[str, str]) -> Iterator[Tuple[str, str]]:
+        n_idle = 0
+
+        while texts_to_process is not None and n_idle < _MAX_IDLE_WINDOWS:
+            yield from texts_to_process.items()
+            texts_to_process = read_window()
+            n_idle = n_idle + 1 if texts_to_process == {} else 0
+
+    def yield_completed() -> Iterator[dict]:
+        """Yield the records of the windows at the front of `pending` with all their results."""
+        while pending and all(h in results for h in itertools.chain(*pending[0][2])):
+            if cache is not None and new_results:
+                cache.put_many(new_results)
+                new_results.clear()
+
+            window, record_units, unit_hashes = pending.popleft()
+
+            for (record_id, _), units, hashes in zip(window, record_units, unit_hashes):
+                ents = []
+                for (offset, _), h in zip(units, hashes):
+                    ents += [
+                        [ent[0] + offset, ent[1] + offset] + ent[2:] for ent in results[h]
+                    ]
+
+                yield {"id": record_id, "ents": ents}
+
+            for h in itertools.chain(*unit_hashes):
+                n_units[h] -= 1
+                if not n_units[h]:
+                    del n_units[h]
+                    del results[h]
+
+    while True:
+        texts_to_process = read_window()
+
+        if texts_to_process:
+            for result in _process_records(
+                nlp, stream_texts(texts_to_process), window_size=window_size, **kwargs
+            ):
+                results[result["id"]] = result["ents"]
+                in_flight.discard(result["id"])
+                if cache is not None:
+                    new_results[result["id"]] = result["ents"]
+
+                yield from yield_completed()
+
+        yield from yield_completed()
+
+        if texts_to_process is None:
+            return
+
+
+def refresh_pipeline(
+    nlp: spacy.language.Language, snapshot_path: str
+) -> spacy.language.Language:
+    """
+    Load a fresh copy of `nlp` from the snapshot at `snapshot_path` (see
+    `snapshot.save_snapshot`), without any of the strings and lexemes added to its vocab since.
+    Instrumented components of `nlp` are moved to the fresh copy (see
+    `instrumentation.transfer_instrumentation`), and `nlp` itself is otherwise left as it is:
+    its vocab is released once it's no longer referenced.
+
+    Returns:
+        spacy.language.Language: the fresh pipeline
+    """
+    fresh = load_snapshot(snapshot_path)
+    transfer_instrumentation(nlp, fresh)
+
+    return fresh
+
+
+def _process_in_memory_windows(
+    nlp: spacy.language.Language,
+    records: Iterable[Tuple[str, str]],
+    process: Callable[
+        [spacy.language.Language, Iterable[Tuple[str, str]]], Iterator[dict]
+    ],
+    memory_window: int,
+    snapshot_path: Optional[str],
+    max_new_strings: int,
+    on_refresh: Optional[Callable[[spacy.language.Language], None]] = None,
+) -> Iterator[dict]:
+    """
+    Run `process` with a pipeline on records `memory_window` at a time, releasing the strings
+    added to the vocab by each window: with `nlp.memory_zone` where spaCy has it (v3.8+), and
+    otherwise by switching to a fresh pipeline loaded from `snapshot_path` once more than
+    `max_new_strings` strings have been added to the current one (see `refresh_pipeline`), which
+    is passed to `on_refresh` if given.
+
+    Docs, and the span extension data that hc_nlp components keep in them, are only valid inside
+    their window. `process` yields plain entity records (see `doc_to_record`), which are extracted
+    from each doc before the window ends.
+    """
+    use_memory_zones = hasattr(nlp, "memory_zone")
+
+    if not use_memory_zones and snapshot_path is None:
+        logger.warning(
+            f"spaCy {spacy.__version__} has no memory zones, and there is no snapshot to refresh "
+            "the pipeline from, so strings added to the vocab won't be released"
+        )
+
+    records = iter(records)
+    n_strings = len(nlp.vocab.strings)
+
+    while True:
+        window = list(itertools.islice(records, memory_window))
+        if not window:
+            return
+
+        if use_memory_zones:
+            with nlp.memory_zone():
+                yield from process(nlp, window)
+            continue
+
+        yield from process(nlp, window)
+
+        n_new_strings = len(nlp.vocab.strings) - n_strings
+        if snapshot_path is not None and n_new_strings > max_new_strings:
+            logger.debug(
+                f"Refreshing pipeline from {snapshot_path} after {n_new_strings} new strings"
+            )
+            nlp = refresh_pipeline(nlp, snapshot_path)
+            n_strings = len(nlp.vocab.strings)
+            if on_refresh is not None:
+                on_refresh(nlp)
+
+            # the old components and their vocab are in reference cycles, so are only freed by
+            # the cyclic garbage collector, which otherwise lets several old copies build up first
+            gc.collect()
+
+
+def process_corpus(
+    nlp: spacy.language.Language,
+    records: Iterable[Tuple[str, str]],
+    batch_size: int = 1000,
+    n_process: int = 1,
+    queue_size: int = 10000,
+    token_budget: Optional[int] = None,
+    window_size: int = 10000,
+    bucket_stats: Optional[BucketStats] = None,
+    cache: Optional[ResultCache] = None,
+    dedupe: bool = True,
+    sentence_level: bool = False,
+    memory_window: Optional[int] = None,
+    snapshot_path: Optional[str] = None,
+    max_new_strings: int = 1_000_000,
+    on_refresh: Optional[Callable[[spacy.language.Language], None]] = None,
+) -> Iterator[dict]:
+    """
+    Run (id, text) records through `nlp.pipe`, yielding a compact entity record (see
+    `doc_to_record`) for each one, in input order.
+
+    Records are read ahead in a background thread through a queue of at most `queue_size`
+    records, and `nlp.pipe` only takes more records as results are consumed, so memory use is
+    bounded however many records there are.
+
+    If `token_budget` is set, records are instead processed `window_size` at a time in batches
+    of docs of similar length with at most `token_budget` tokens once padded, which wastes much
+    less compute on padding in transformer pipelines. These batches are processed in the
+    current process, so `n_process` must be 1. Numbers of docs, padding and time for each
+    length bucket are added to `bucket_stats`, if given.
+
+    If `dedupe`, records are processed `window_size` at a time and each distinct text in a
+    window is only processed once, with its results copied to every record with that text. If
+    `cache` is given, only texts without cached results for the pipeline are processed, which
+    also catches repeated texts in different windows. The texts to process from every window
+    go through a single streaming `nlp.pipe` call, so worker processes are started once per run
+    rather than once per window.
+
+    If `sentence_level`, sentences rather than whole texts are deduplicated and cached, so
+    boilerplate sentences repeated across different records are only processed once. Each
+    sentence is processed as a doc of its own, so entities aren't joined, and duplicate
+    mentions aren't detected, across sentence boundaries.
+
+    If `memory_window` is set, strings added to the vocab by new token texts are released
+    periodically, so that the pipeline's memory use doesn't grow over a long run: records are
+    processed `memory_window` at a time, each inside a memory zone on spaCy v3.8+. On older
+    versions, later windows are instead processed by a fresh copy of the pipeline loaded from the
+    snapshot at `snapshot_path` (see `refresh_pipeline`) once more than `max_new_strings` strings
+    have been added to the vocab of the current one, and `on_refresh` is called with each fresh
+    pipeline. `nlp` itself is then no longer used, and keeps the strings added by the windows it
+    processed until the caller drops it.
+
+    Args:
+        nlp (spacy.language.Language): pipeline, e.g. including hc_nlp components.
+        records (Iterable[Tuple[str, str]]): (id, text) records, e.g. from `read_records`.
+        batch_size (int, optional): batch size for `nlp.pipe`. Defaults to 1000.
+        n_process (int, optional): number of processes for `nlp.pipe`. Defaults to 1.
+        queue_size (int, optional): maximum number of records read ahead. Defaults to 10000.
+        token_budget (Optional[int], optional): maximum number of padded tokens in a batch, or
+            None to use `nlp.pipe` batches of `batch_size` docs. Defaults to None.
+        window_size (int, optional): number of records to sort into length buckets at a time.
+            Defaults to 10000.
+        bucket_stats (Optional[BucketStats], optional): stats for each length bucket. Defaults to None.
+        cache (Optional[ResultCache], optional): cache of results for the pipeline. Defaults to None.
+        dedupe (bool, optional): whether to process repeated texts once. Defaults to True.
+        sentence_level (bool, optional): whether to deduplicate and cache sentences instead of
+            whole texts. Defaults to False.
+        memory_window (Optional[int], optional): number of records to process between releases
+            of new strings, or None to never release them. Defaults to None.
+        snapshot_path (Optional[str], optional): snapshot of `nlp` to refresh it from, where
+            memory zones aren't available. Defaults to None.
+        max_new_strings (int, optional): number of new strings in the vocab above which the
+            pipeline is refreshed. Defaults to 1,000,000.
+        on_refresh (Optional[Callable[[spacy.language.Language], None]], optional): called with
+            each fresh pipeline loaded from `snapshot_path`. Defaults to None.
+
+    Yields:
+        dict: entity record
+    """
+    if token_budget is not None and n_process != 1:
+        raise ValueError(
+            "Length-bucketed batches (token_budget) can only be processed with n_process=1"
+        )
+
+    kwargs = dict(
+        batch_size=batch_size,
+        n_process=n_process,
+        token_budget=token_budget,
+        bucket_stats=bucket_stats or BucketStats(),
+    )
+    records = prefetch(records, queue_size)
+
+    def process(
+        nlp: spacy.language.Language, records: Iterable[Tuple[str, str]]
+    ) -> Iterator[dict]:
+        if dedupe or sentence_level or (cache is not None):
+            return _process_windowed(
+                nlp, records, window_size, cache, sentence_level, **kwargs
+            )
+
+        return _process_records(nlp, records, window_size=window_size, **kwargs)
+
+    if memory_window is None:
+        yield from process(nlp, records)
+    else:
+        yield from _process_in_memory_windows(
+            nlp,
+            records,
+            process,
+            memory_window,
+            snapshot_path,
+            max_new_strings,
+            on_refresh,
+        )
+
+
+def write_records(records: Iterable[dict], output_path: str, queue_size: int = 10000) -> int:
+    """
+    Write records to a JSONL file as they are produced. Lines are written in a background thread
+    through a queue of at most `queue_size` records, so that writing overlaps with processing.
+
+    Args:
+        records (Iterable[dict])
+        output_path (str): path to the JSONL file.
+        queue_size (int, optional): maximum number of records waiting to be written. Defaults to 10000.
+
+    Returns:
+        int: number of records written.
+    """
+    lines = queue.Queue(maxsize=queue_size)
+    errors = []
+
+    def consume():
+        try:
+            with open(output_path, "w", encoding="utf-8") as f:
+                for line in iter(lines.get, _DONE):
+                    f.write(line)
+        except Exception as e:
+            errors.append(e)
+            # keep emptying the queue so that the producer doesn't block
+            for _ in iter(lines.get, _DONE):
+                pass
+
+    writer = threading.Thread(target=consume, daemon=True)
+    writer.start()
+
+    n_records = 0
+    try:
+        for record in records:
+            lines.put(json.dumps(record, ensure_ascii=False) + "\n")
+            n_records += 1
+    finally:
+        lines.put(_DONE)
+        writer.join()
+
+    if errors:
+        raise errors[0]
+
+    return n_records
+
+
+def _write_metrics_periodically(
+    records: Iterable[dict],
+    instrumentation: PipelineInstrumentation,
+    metrics_path: str,
+    interval: float,
+) -> Iterator[dict]:
+    """Passes records through, writing the pipeline's stats every `interval` seconds."""
+    last_write = time.monotonic()
+
+    for record in records:
+        yield record
+
+        if time.monotonic() - last_write >= interval:
+            instrumentation.write(metrics_path)
+            last_write = time.monotonic()
+
+
+def annotate_corpus(
+    nlp: spacy.language.Language,
+    input_path: str,
+    output_path: str,
+    id_field: str = "id",
+    text_field: str = "text",
+    batch_size: int = 1000,
+    n_process: int = 1,
+    queue_size: int = 10000,
+    token_budget: Optional[int] = None,
+    window_size: int = 10000,
+    cache_path: Optional[str] = None,
+    cache_max_bytes: int = 1 << 30,
+    cache_key_extra: str = "",
+    dedupe: bool = True,
+    sentence_level: bool = False,
+    metrics_path: Optional[str] = None,
+    metrics_interval: float = 60.0,
+    memory_window: Optional[int] = None,
+    snapshot_path: Optional[str] = None,
+    max_new_strings: int = 1_000_000,
+    output_format: str = "jsonl",
+    columnar_batch_size: int = 100_000,
+) -> int:
+    """
+    Annotate the records in a JSONL or CSV file (see `read_records`) with `nlp`, and write an
+    entity record for each one to a JSONL file, in input order (see `process_corpus`). If
+    `token_budget` is set, the padding ratio and docs/sec for each length bucket are logged.
+
+    If `cache_path` is set, results are cached in a `ResultCache` there, of at most
+    `cache_max_bytes`, so that texts processed by the same pipeline before are not processed
+    again. `cache_key_extra` is added to the pipeline fingerprint which results are cached under
+    (see `result_cache.pipeline_fingerprint`): set it to something which identifies the code, e.g.
+    a commit hash, so that changes to it don't return stale results. `dedupe` and
+    `sentence_level` are as for `process_corpus`.
+
+    If `metrics_path` is set, the pipeline's components are instrumented for the run (see
+    `instrumentation.instrument_pipeline`), and their stats are written there every
+    `metrics_interval` seconds and at the end, in the Prometheus text format if the path ends
+    with ".prom" and as JSON otherwise.
+
+    `memory_window`, `snapshot_path` and `max_new_strings` bound the memory used by the pipeline's
+    vocab over a long run, as for `process_corpus`.
+
+    If `output_format` is "parquet" or "arrow", `output_path` is instead a directory to write
+    mentions and documents files to (see `columnar.write_columnar`), in batches of
+    `columnar_batch_size` rows, with the fingerprint of the pipeline (including
+    `cache_key_extra`) in their metadata.
+
+    Returns:
+        int: number of records written.
+    """
+    logger.info(f"Annotating {input_path} with batch size {batch_size} on {n_process} processes")
+
+    if output_format != "jsonl" and output_format not in FORMATS:
+        raise ValueError(
+            f"output_format must be one of {['jsonl'] + list(FORMATS)}, not {output_format!r}"
+        )
+
+    bucket_stats = BucketStats()
+    fingerprint = pipeline_fingerprint(nlp, extra=cache_key_extra)
+    cache = (
+        ResultCache(cache_path, fingerprint, cache_max_bytes)
+        if cache_path
+        else None
+    )
+    records = read_records(input_path, id_field, text_field)
+    instrumentation = None
+
+    if metrics_path:
+        if n_process != 1:
+            logger.warning(
+                "Metrics are only recorded for docs processed in the main process"
+            )
+        instrumentation = instrument_pipeline(nlp)
+
+    try:
+        output_records = process_corpus(
+            nlp,
+            records,
+            batch_size,
+            n_process,
+            queue_size,
+            token_budget,
+            window_size,
+            bucket_stats,
+            cache,
+            dedupe,
+            sentence_level,
+            memory_window=memory_window,
+            snapshot_path=snapshot_path,
+            max_new_strings=max_new_strings,
+        )
+
+        if instrumentation is not None:
+            output_records = _write_metrics_periodically(
+                output_records, instrumentation, metrics_path, metrics_interval
+            )
+
+        if output_format == "jsonl":
+            n_records = write_records(output_records, output_path, queue_size)
+        else:
+            n_records = write_columnar(
+                output_records,
+                output_path,
+                output_format,
+                columnar_batch_size,
+                metadata={"pipeline_fingerprint": fingerprint},
+            )
+    finally:
+        if cache is not None:
+            cache.close()
+
+        if instrumentation is not None:
+            instrumentation.write(metrics_path)
+            uninstrument_pipeline(nlp)
+
+    logger.info(f"Wrote {n_records} records to {output_path}")
+
+    if cache is not None:
+        logger.info(f"Result cache: {cache.hits} hits, {cache.misses} misses")
+
+    for bucket, stats in bucket_stats.report().items():
+        logger.info(
+            f"Bucket {bucket} ({stats['min_tokens']}-{stats['max_tokens']} tokens): {stats['docs']} docs, "
+            f"padding ratio {stats['padding_ratio']:.2f}, {stats['docs_per_sec']:.1f} docs/sec"
+        )
+
+    return n_records
+
+
+def main(argv: Optional[Iterable[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Annotate a JSONL or CSV corpus with an hc_nlp pipeline, writing JSONL entity records or columnar files."
+    )
+    parser.add_argument("input_path", help="JSONL or CSV file of records")
+    parser.add_argument(
+        "output_path",
+        help="JSONL file to write entity records to, or directory for --output-format parquet or arrow",
+    )
+    parser.add_argument(
+        "--model",
+        default="en_core_web_sm",
+        help="name or path of the spaCy pipeline or hc_nlp snapshot to load (default: en_core_web_sm)",
+    )
+    parser.add_argument("--id-field", default="id")
+    parser.add_argument("--text-field", default="text")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--n-process", type=int, default=1)
+    parser.add_argument("--queue-size", type=int, default=10000)
+    parser.add_argument(
+        "--token-budget",
+        type=int,
+        default=None,
+        help="process docs in length-bucketed batches of at most this many padded tokens",
+    )
+    parser.add_argument("--window-size", type=int, default=10000)
+    parser.add_argument(
+        "--cache-path", default=None, help="SQLite file to cache results in"
+    )
+    parser.add_argument(
+        "--cache-max-mb",
+        type=int,
+        default=1024,
+        help="maximum size of the cached results in MB (default: 1024)",
+    )
+    parser.add_argument(
+        "--cache-key-extra",
+        default="",
+        help="added to the pipeline fingerprint results are cached under, e.g. a commit hash, so that code changes invalidate the cache",
+    )
+    parser.add_argument(
+        "--no-dedupe",
+        action="store_true",
+        help="process every record, even if its text is the same as another's",
+    )
+    parser.add_argument(
+        "--sentence-level",
+        action="store_true",
+        help="deduplicate and cache sentences rather than whole texts",
+    )
+    parser.add_argument(
+        "--metrics-path",
+        default=None,
+        help="write per-component timings and counters here (Prometheus text format if it ends with .prom, otherwise JSON)",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        type=float,
+        default=60.0,
+        help="seconds between writes of the metrics file (default: 60)",
+    )
+    parser.add_argument(
+        "--memory-window",
+        type=int,
+        default=None,
+        help="release strings added to the vocab every this many records, to keep memory use flat over long runs",
+    )
+    parser.add_argument(
+        "--max-new-strings",
+        type=int,
+        default=1_000_000,
+        help="without memory zones (spaCy < 3.8), reload the pipeline when a --model snapshot has gained this many strings (default: 1000000)",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=["jsonl"] + list(FORMATS),
+        default="jsonl",
+        help="write JSONL entity records, or Parquet or Arrow IPC files of mentions and documents (default: jsonl)",
+    )
+    parser.add_argument(
+        "--columnar-batch-size",
+        type=int,
+        default=100_000,
+        help="rows per Parquet row group or Arrow record batch (default: 100000)",
+    )
+    args = parser.parse_args(argv)
+
+    annotate_corpus(
+        load_pipeline(args.model),
+        args.input_path,
+        args.output_path,
+        id_field=args.id_field,
+        text_field=args.text_field,
+        batch_size=args.batch_size,
+        n_process=args.n_process,
+        queue_size=args.queue_size,
+        token_budget=args.token_budget,
+        window_size=args.window_size,
+        cache_path=args.cache_path,
+        cache_max_bytes=args.cache_max_mb << 20,
+        cache_key_extra=args.cache_key_extra,
+        dedupe=not args.no_dedupe,
+        sentence_level=args.sentence_level,
+        metrics_path=args.metrics_path,
+        metrics_interval=args.metrics_interval,
+        memory_window=args.memory_window,
+        snapshot_path=args.model if is_snapshot(args.model) else None,
+        max_new_strings=args.max_new_strings,
+        output_format=args.output_format,
+        columnar_batch_size=args.columnar_batch_size,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+"""
+A buffer for edits to `Doc.ents`, so that pipeline components can make many changes to a doc's
+entities and write them back with a single `Doc.set_ents` call.
+"""
+
+import spacy
+from spacy.attrs import ENT_TYPE
+import numpy as np
+from contextlib import contextmanager
+from typing import Iterable, Iterator, List, Optional, Union
+
+
+class EntityRecord:
+    """
+    A lightweight stand-in for an entity `Span` whose boundaries and label can be edited.
+    """
+
+    __slots__ = ("start", "end", "label", "kb_id", "ent_id")
+
+    def __init__(
+        self, start: int, end: int, label: int, kb_id: int = 0, ent_id: int = 0
+    ):
+        self.start = start
+        self.end = end
+        self.label = label
+        self.kb_id = kb_id
+        self.ent_id = ent_id
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+    def __repr__(self) -> str:
+        return f"EntityRecord({self.start}, {self.end}, {self.label})"
+
+
+class EntityEdits:
+    """
+    Queues removals, boundary changes, label remaps and additions of entities on a `Doc`, and
+    writes them back with one `Doc.set_ents` call on `commit`. Overlaps are checked as edits are
+    made using a token -> entity index, so no edit needs `Doc.ents` to be rebuilt.
+
+    Boundary changes and label remaps keep an entity's `kb_id` and `ent_id`.
+    """
+
+    def __init__(self, doc: spacy.tokens.Doc):
+        self.doc = doc
+        self.modified = False
+
+        # live records in insertion order (dict used as an ordered set), and the record
+        # covering each token
+        self._records = {}
+        self._token_records: List[Optional[EntityRecord]] = [None] * len(doc)
+
+        for ent in doc.ents:
+            self._insert(EntityRecord(ent.start, ent.end, ent.label, ent.kb_id, ent.id))
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __iter__(self) -> Iterator[EntityRecord]:
+        return iter(self.ents())
+
+    def ents(self) -> List[EntityRecord]:
+        """
+        Returns the current entities, sorted by their position in the doc.
+        """
+        return sorted(self._records, key=lambda record: record.start)
+
+    def ent_at(self, i: int) -> Optional[EntityRecord]:
+        """
+        Returns the current entity covering token `i`, or None if there isn't one.
+        """
+        return self._token_records[i]
+
+    def label_at(self, i: int) -> str:
+        """
+        Returns the label of the current entity covering token `i` (the buffered equivalent
+        of `token.ent_type_`), or an empty string if there isn't one.
+        """
+        record = self._token_records[i]
+
+        return self.doc.vocab.strings[record.label] if record is not None else ""
+
+    def token_labels(self) -> np.ndarray:
+        """
+        Returns the label hash of the current entity covering each token, or 0 for tokens outside
+        entities. Read from the doc's ENT_TYPE array if nothing has been edited yet.
+        """
+        if not self.modified:
+            return self.doc.to_array(ENT_TYPE)
+
+        labels = np.zeros(len(self.doc), dtype="uint64")
+        for record in self._records:
+            labels[record.start : record.end] = record.label
+
+        return labels
+
+    def label_(self, record: EntityRecord) -> str:
+        return self.doc.vocab.strings[record.label]
+
+    def span(self, record: EntityRecord) -> spacy.tokens.Span:
+        """
+        Returns a `Span` for the record. Custom span attributes are stored by character
+        offsets, so they are shared with the entity once the edits are committed.
+        """
+        return spacy.tokens.Span(
+            self.doc,
+            record.start,
+            record.end,
+            label=record.label,
+            kb_id=record.kb_id,
+            span_id=record.ent_id,
+        )
+
+    def overlaps(
+        self, start: int, end: int, ignore: Optional[EntityRecord] = None
+    ) -> bool:
+        """
+        Returns True if any token in `doc[start:end]` belongs to an entity other than `ignore`.
+        """
+        return any(
+            record is not None and record is not ignore
+            for record in self._token_records[start:end]
+        )
+
+    def remove(self, record: EntityRecord):
+        self._release(record)
+        del self._records[record]
+        self.modified = True
+
+    def set_bounds(self, record: EntityRecord, start: int, end: int):
+        """
+        Moves the boundaries of an entity to `doc[start:end]`.
+
+        Raises:
+            ValueError: if the new boundaries are empty, outside the doc, or overlap another entity.
+        """
+        self._check_bounds(start, end, ignore=record)
+        self._release(record)
+        record.start = start
+        record.end = end
+        self._claim(record)
+        self.modified = True
+
+    def set_label(self, record: EntityRecord, label: Union[str, int]):
+        if isinstance(label, str):
+            label = self.doc.vocab.strings.add(label)
+
+        if label != record.label:
+            record.label = label
+            self.modified = True
+
+    def add(
+        self,
+        start: int,
+        end: int,
+        label: Union[str, int],
+        kb_id: int = 0,
+        ent_id: int = 0,
+    ) -> EntityRecord:
+        """
+        Adds an entity spanning `doc[start:end]`.
+
+        Raises:
+            ValueError: if the boundaries are empty, outside the doc, or overlap another entity.
+        """
+        self._check_bounds(start, end)
+
+        if isinstance(label, str):
+            label = self.doc.vocab.strings.add(label)
+
+        record = EntityRecord(start, end, label, kb_id, ent_id)
+        self._insert(record)
+        self.modified = True
+
+        return record
+
+    def replace(self, records: Iterable[EntityRecord]):
+        """
+        Replaces the current entities with `records`. Records already in the buffer are kept as
+        they are, and any others are added.
+
+        Raises:
+            ValueError: if the new records overlap each other.
+        """
+        records = list(records)
+        kept = {record for record in records if record in self._records}
+
+        for record in list(self._records):
+            if record not in kept:
+                self.remove(record)
+
+        for record in records:
+            if record not in kept:
+                self._check_bounds(record.start, record.end)
+                self._insert(record)
+                self.modified = True
+
+    def commit(self) -> spacy.tokens.Doc:
+        """
+        Writes the entities back to the doc with a single `Doc.set_ents` call, if anything
+        has changed.
+        """
+        if self.modified:
+            self.doc.set_ents(
+                [self.span(record) for record in self.ents()], default="outside"
+            )
+            self.modified = False
+
+        return self.doc
+
+    def _check_bounds(
+        self, start: int, end: int, ignore: Optional[EntityRecord] = None
+    ):
+        if not 0 <= start < end <= len(self.doc):
+            raise ValueError(
+                f"Invalid entity boundaries {(start, end)} for doc of length {len(self.doc)}"
+            )
+
+        if self.overlaps(start, end, ignore=ignore):
+            raise ValueError(
+                f"Entity {(start, end)} overlaps an existing entity in the doc"
+            )
+
+    def _insert(self, record: EntityRecord):
+        self._records[record] = None
+        self._claim(record)
+
+    def _claim(self, record: EntityRecord):
+        self._token_records[record.start : record.end] = [record] * len(record)
+
+    def _release(self, record: EntityRecord):
+        self._token_records[record.start : record.end] = [None] * len(record)
+
+
+@contextmanager
+def edit_ents(
+    doc: spacy.tokens.Doc, edits: Optional[EntityEdits] = None
+) -> Iterator[EntityEdits]:
+    """
+    Yields `edits` if given, so that a caller can batch edits from several steps into one commit.
+    Otherwise yields a new `EntityEdits` for `doc`, which is committed on exit.
+    """
+    if edits is not None:
+        yield edits
+    else:
+        edits = EntityEdits(doc)
+        yield edits
+        edits.commit()
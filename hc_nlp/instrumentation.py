@@ -0,0 +1,508 @@
+"""
+Opt-in timing and counters for pipeline components. `instrument_pipeline` wraps the hc_nlp
+components of a pipeline (and optionally the other pipes) so that each call records its wall time
+in a histogram, along with the docs and tokens processed and, for a sample of docs, the entities
+going in and out. The rule-level counts
+kept by hc_nlp components in their `stats` dicts (e.g. entities removed by each `EntityFilter`
+rule) are exported alongside, as JSON or as a Prometheus text file.
+
+Stats are kept per process, so with `nlp.pipe(..., n_process=n)` for n > 1 only the parent
+process's calls are recorded.
+"""
+
+import json
+import os
+import time
+import numpy as np
+import spacy
+from spacy.language import Language
+from bisect import bisect_left
+from collections import deque
+from spacy.attrs import ENT_IOB
+from typing import Dict, Iterable, Iterator, Optional, Sequence
+from hc_nlp import logging
+
+logger = logging.get_logger(__name__)
+
+# upper bounds of the histogram buckets for seconds per doc: 10µs doubling up to ~10s
+SECONDS_BUCKETS = tuple(1e-5 * 2**k for k in range(21))
+
+# value of ENT_IOB for the first token of an entity
+_IOB_BEGIN = 3
+
+# entities in and out are counted for one doc in this many by default: counting them takes about
+# as long as a fast component, so counting every doc would cost more than the 1% overhead budget
+# (see `benchmarking.benchmark_instrumentation_overhead`)
+ENT_SAMPLE_EVERY = 16
+
+# factory of the pipes `instrument_pipeline` swaps in, and the components waiting to be added by
+# it, by id
+INSTRUMENTED_FACTORY = "hc_nlp_instrumented"
+_PENDING_COMPONENTS: Dict[int, "InstrumentedComponent"] = {}
+
+
+def count_ents(doc: spacy.tokens.Doc) -> int:
+    """The number of entities in a doc, counted without creating any spans."""
+    # IOB values are 0-3, and counting bytes is several times faster than comparing arrays
+    return doc.to_array(ENT_IOB).astype(np.uint8).tobytes().count(_IOB_BEGIN)
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram: recording a value is one binary search and an increment. Values above
+    the last bound go in an overflow bucket.
+    """
+
+    __slots__ = ("bounds", "counts", "count", "sum")
+
+    def __init__(self, bounds: Sequence[float] = SECONDS_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate the `q` quantile as the upper bound of the bucket it falls in, or infinity if
+        it's in the overflow bucket. Returns 0 if nothing has been recorded.
+        """
+        if not self.count:
+            return 0.0
+
+        target = q * self.count
+        cumulative = 0
+
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "bounds": list(self.bounds),
+            "counts": list(self.counts),
+        }
+
+
+class ComponentStats:
+    """
+    Docs, tokens and seconds per doc for one component, and entities in and out of the
+    `ent_docs` docs whose entities were counted.
+    """
+
+    __slots__ = ("name", "seconds", "docs", "tokens", "ent_docs", "ents_in", "ents_out")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.seconds = Histogram()
+        self.docs = 0
+        self.tokens = 0
+        self.ent_docs = 0
+        self.ents_in = 0
+        self.ents_out = 0
+
+    def record(self, seconds: float, n_tokens: int):
+        self.seconds.observe(seconds)
+        self.docs += 1
+        self.tokens += n_tokens
+
+    def record_ents(self, ents_in: int, ents_out: int):
+        self.ent_docs += 1
+        self.ents_in += ents_in
+        self.ents_out += ents_out
+
+    def to_dict(self) -> dict:
+        return {
+            "docs": self.docs,
+            "tokens": self.tokens,
+            "ent_docs": self.ent_docs,
+            "ents_in": self.ents_in,
+            "ents_out": self.ents_out,
+            "seconds": self.seconds.to_dict(),
+        }
+
+
+class InstrumentedComponent:
+    """
+    Wraps a pipeline component to record a `ComponentStats` in `metrics` for each doc it
+    processes. Any other attribute is looked up on the wrapped component, so e.g.
+    `nlp.get_pipe(name).apply_delta` and `nlp.get_pipe(name).stats` still work.
+
+    For components with a `pipe` method, time spent producing the input docs is excluded, and
+    the time for a batch is recorded against the first doc that comes out of it.
+
+    Entities in and out are counted for the first doc and then every `ent_sample_every`th one.
+    Components instrumented together see the same docs in the same order, so they count the
+    same docs, and if `previous` is the instrumented component just before this one in the
+    pipeline, the entities it returned are used as the entities in rather than counting them
+    again.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        component,
+        previous: Optional["InstrumentedComponent"] = None,
+        ent_sample_every: int = ENT_SAMPLE_EVERY,
+    ):
+        self.component = component
+        self.metrics = ComponentStats(name)
+        self.previous = previous
+        self.ent_sample_every = ent_sample_every
+        # pipeline holding the wrapped component while it's swapped out of its own (see `_install`)
+        self.originals: Optional[Language] = None
+        # docs passed in so far, which decides whether the next one's entities are counted
+        self._n_docs = 0
+        # the last doc returned by `__call__` with its entities counted, and their number
+        self._last_doc = None
+        self._last_ents = 0
+
+    def __getattr__(self, attr: str):
+        # only called for attributes not found on the wrapper
+        if attr == "component":
+            raise AttributeError(attr)
+
+        return getattr(self.component, attr)
+
+    @property
+    def rule_counts(self) -> Dict[str, float]:
+        """Numeric values of the `stats` dict of the wrapped component, if it has one."""
+        component_stats = getattr(self.component, "stats", None)
+
+        if not isinstance(component_stats, dict):
+            return {}
+
+        return {
+            key: value
+            for key, value in component_stats.items()
+            if isinstance(value, (int, float))
+        }
+
+    def _sample_ents_in(self, doc: spacy.tokens.Doc) -> Optional[int]:
+        """The entities in `doc` if it's one whose entities are counted, otherwise None."""
+        sampled = self._n_docs % self.ent_sample_every == 0
+        self._n_docs += 1
+
+        if not sampled:
+            return None
+
+        previous = self.previous
+        if previous is not None and previous._last_doc is doc:
+            return previous._last_ents
+
+        return count_ents(doc)
+
+    def __call__(self, doc: spacy.tokens.Doc, **kwargs) -> spacy.tokens.Doc:
+        ents_in = self._sample_ents_in(doc)
+
+        start = time.perf_counter()
+        doc = self.component(doc, **kwargs)
+        seconds = time.perf_counter() - start
+
+        self.metrics.record(seconds, len(doc))
+
+        if ents_in is not None:
+            ents_out = count_ents(doc)
+            self.metrics.record_ents(ents_in, ents_out)
+            self._last_doc = doc
+            self._last_ents = ents_out
+
+        return doc
+
+    def pipe(self, docs: Iterable[spacy.tokens.Doc], **kwargs) -> Iterator[spacy.tokens.Doc]:
+        if not hasattr(self.component, "pipe"):
+            for doc in docs:
+                yield self(doc)
+            return
+
+        # seconds spent waiting for input docs, and entities in each doc not yet yielded (None
+        # for docs whose entities aren't counted)
+        upstream_seconds = [0.0]
+        ents_in = deque()
+
+        def inputs():
+            docs_iter = iter(docs)
+
+            while True:
+                start = time.perf_counter()
+                doc = next(docs_iter, None)
+                upstream_seconds[0] += time.perf_counter() - start
+
+                if doc is None:
+                    return
+
+                ents_in.append(self._sample_ents_in(doc))
+                yield doc
+
+        outputs = self.component.pipe(inputs(), **kwargs)
+
+        while True:
+            upstream_before = upstream_seconds[0]
+            start = time.perf_counter()
+            doc = next(outputs, None)
+            seconds = time.perf_counter() - start - (upstream_seconds[0] - upstream_before)
+
+            if doc is None:
+                return
+
+            self.metrics.record(seconds, len(doc))
+
+            doc_ents_in = ents_in.popleft()
+            if doc_ents_in is not None:
+                self.metrics.record_ents(doc_ents_in, count_ents(doc))
+
+            yield doc
+
+
+def _is_hc_nlp_component(component) -> bool:
+    return type(component).__module__.startswith("hc_nlp.")
+
+
+def _prometheus_labels(**labels) -> str:
+    escaped = {
+        key: str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for key, value in labels.items()
+    }
+
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped.items()) + "}"
+
+
+class PipelineInstrumentation:
+    """
+    The instrumented components of a pipeline (see `instrument_pipeline`), and exports of their
+    stats.
+    """
+
+    def __init__(self, components: Dict[str, InstrumentedComponent]):
+        self.components = components
+
+    def to_dict(self) -> dict:
+        """JSON-serialisable snapshot of the stats and rule counts of each component."""
+        return {
+            "time": time.time(),
+            "components": {
+                name: dict(component.metrics.to_dict(), rules=component.rule_counts)
+                for name, component in self.components.items()
+            },
+        }
+
+    def to_prometheus(self) -> str:
+        """The stats in the Prometheus text exposition format."""
+        lines = [
+            "# HELP hc_nlp_component_seconds Wall time per doc of each pipeline component.",
+            "# TYPE hc_nlp_component_seconds histogram",
+        ]
+
+        for name, component in self.components.items():
+            histogram = component.metrics.seconds
+            cumulative = 0
+
+            for bound, count in zip(histogram.bounds + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(
+                    f"hc_nlp_component_seconds_bucket{_prometheus_labels(component=name, le=le)} {cumulative}"
+                )
+
+            labels = _prometheus_labels(component=name)
+            lines.append(f"hc_nlp_component_seconds_sum{labels} {histogram.sum!r}")
+            lines.append(f"hc_nlp_component_seconds_count{labels} {histogram.count}")
+
+        for field, description in [
+            ("docs", "Docs processed"),
+            ("tokens", "Tokens processed"),
+            ("ent_docs", "Docs with their entities counted"),
+            ("ents_in", "Entities in docs passed to"),
+            ("ents_out", "Entities in docs returned by"),
+        ]:
+            metric = f"hc_nlp_component_{field}_total"
+            lines.append(f"# HELP {metric} {description} each pipeline component.")
+            lines.append(f"# TYPE {metric} counter")
+
+            for name, component in self.components.items():
+                lines.append(
+                    f"{metric}{_prometheus_labels(component=name)} {getattr(component.metrics, field)}"
+                )
+
+        lines.append(
+            "# HELP hc_nlp_rule_hits_total Counts kept by hc_nlp components, by rule."
+        )
+        lines.append("# TYPE hc_nlp_rule_hits_total counter")
+
+        for name, component in self.components.items():
+            for rule, value in component.rule_counts.items():
+                lines.append(
+                    f"hc_nlp_rule_hits_total{_prometheus_labels(component=name, rule=rule)} {value!r}"
+                )
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        """
+        Write the stats to `path`, in the Prometheus text format if it ends with ".prom" and as
+        JSON otherwise. The file is replaced atomically, so it can be scraped at any time.
+        """
+        if path.endswith(".prom"):
+            data = self.to_prometheus()
+        else:
+            data = json.dumps(self.to_dict(), indent=2)
+
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+
+        os.replace(tmp_path, path)
+
+
+def instrument_pipeline(
+    nlp: spacy.language.Language,
+    spacy_pipes: bool = False,
+    ent_sample_every: int = ENT_SAMPLE_EVERY,
+) -> PipelineInstrumentation:
+    """
+    Wrap the hc_nlp components of `nlp` in place with `InstrumentedComponent`s, and the other
+    pipes too if `spacy_pipes`. Components which are already instrumented are kept as they are.
+    Pipes are swapped with `nlp.replace_pipe`, so until `uninstrument_pipeline` puts the
+    originals back, `nlp.config` has the `INSTRUMENTED_FACTORY` factory for them: uninstrument a
+    pipeline before saving it.
+
+    Args:
+        nlp (spacy.language.Language)
+        spacy_pipes (bool, optional): whether to instrument pipes which aren't from hc_nlp.
+            Defaults to False.
+        ent_sample_every (int, optional): count entities in and out for one doc in this many
+            (see `InstrumentedComponent`), or 1 to count them for every doc. Defaults to
+            `ENT_SAMPLE_EVERY`.
+
+    Returns:
+        PipelineInstrumentation
+    """
+    components = {}
+    previous = None
+
+    for name, component in nlp.components:
+        if not isinstance(component, InstrumentedComponent):
+            if not (spacy_pipes or _is_hc_nlp_component(component)):
+                previous = None
+                continue
+
+            component = InstrumentedComponent(name, component, previous, ent_sample_every)
+
+        components[name] = component
+        previous = component
+
+    _install(nlp, [component for component in components.values() if component.originals is None])
+    logger.debug(f"Instrumented pipeline components {list(components)}")
+
+    return PipelineInstrumentation(components)
+
+
+def uninstrument_pipeline(nlp: spacy.language.Language):
+    """Replace the instrumented components of `nlp` with the components they wrap."""
+    for name, component in nlp.components:
+        if isinstance(component, InstrumentedComponent):
+            _uninstall(nlp, name, component)
+
+
+@Language.factory(INSTRUMENTED_FACTORY, default_config={"key": 0})
+def _make_instrumented_component(nlp: Language, name: str, key: int):
+    # factories are only passed config values, so the component is handed over by `_install`
+    return _PENDING_COMPONENTS.pop(key)
+
+
+def _install(nlp: spacy.language.Language, components: Sequence[InstrumentedComponent]):
+    """
+    Swap the pipes of `nlp` wrapped by `components` for the `InstrumentedComponent`s, with
+    `nlp.replace_pipe`. The wrapped pipes are first copied, with their config, to a pipeline
+    sharing the vocab of `nlp`, kept as the `originals` of each component so that `_uninstall`
+    can put them back as they were.
+    """
+    if not components:
+        return
+
+    originals = Language(vocab=nlp.vocab)
+    disabled = set(nlp.disabled)
+
+    for component in components:
+        name = component.metrics.name
+        originals.add_pipe(name, source=nlp)
+
+        _PENDING_COMPONENTS[id(component)] = component
+        nlp.replace_pipe(name, INSTRUMENTED_FACTORY, config={"key": id(component)})
+        component.originals = originals
+
+        if name in disabled:
+            nlp.disable_pipe(name)
+
+
+def _uninstall(nlp: spacy.language.Language, name: str, component: InstrumentedComponent):
+    """Put the pipe wrapped by `component` back in `nlp` in its place, with its config."""
+    disabled = name in nlp.disabled
+    idx = nlp.component_names.index(name)
+    nlp.remove_pipe(name)
+
+    if idx < len(nlp.component_names):
+        nlp.add_pipe(name, source=component.originals, before=idx)
+    else:
+        nlp.add_pipe(name, source=component.originals)
+
+    if disabled:
+        nlp.disable_pipe(name)
+
+    component.originals = None
+
+
+def _merge_stats(component, counts: Dict[str, float]):
+    """Add `counts` to the `stats` of `component`."""
+    if not counts:
+        return
+
+    if hasattr(component, "merge_stats"):
+        component.merge_stats(counts)
+        return
+
+    component_stats = getattr(component, "stats", None)
+    if isinstance(component_stats, dict):
+        for key, value in counts.items():
+            component_stats[key] = component_stats.get(key, 0) + value
+
+
+def transfer_instrumentation(
+    source: spacy.language.Language, target: spacy.language.Language
+):
+    """
+    Move the instrumented components of `source` onto the components of the same name in
+    `target`, e.g. a fresh copy of the same pipeline, so that their stats keep accumulating in
+    the same `PipelineInstrumentation`. The counts in the `stats` of the components are carried
+    over too, with their `merge_stats` method if they have one (e.g. `HCPostprocess`, whose
+    `stats` are gathered from its sub-components). `source` is left uninstrumented.
+    """
+    moved = []
+
+    for name, component in source.components:
+        if not isinstance(component, InstrumentedComponent):
+            continue
+
+        _uninstall(source, name, component)
+        if name not in target.component_names:
+            continue
+
+        new_component = target.get_pipe(name)
+        _merge_stats(new_component, component.rule_counts)
+
+        component.component = new_component
+        component._last_doc = None
+        moved.append(component)
+
+    _install(target, moved)
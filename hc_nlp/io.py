@@ -90,8 +90,8 @@ def export_text_to_docbin(text: List[str], output_path: str, spacy_model):
 
     docbin = spacy.tokens.DocBin(store_user_data=True)
 
-    for item in tqdm(text):
-        docbin.add(spacy_model(item))
+    for doc in tqdm(spacy_model.pipe(text), total=len(text)):
+        docbin.add(doc)
 
     docbin_data = docbin.to_bytes()
 
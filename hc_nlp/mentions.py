@@ -0,0 +1,243 @@
+"""
+Compact entity output. Downstream of the pipeline only each entity's offsets, label, entity id and
+the span extensions set by hc_nlp components are needed, so rather than keeping processed `Doc`s
+(with their token arrays, tensors and `user_data`), they are turned into `EntityMention`s, or for
+large batches into a NumPy structured array or an Arrow record batch, and dropped straight away.
+None of these need pickling to be serialised.
+"""
+
+import numpy as np
+import spacy
+from spacy.attrs import ENT_ID, ENT_IOB, ENT_TYPE, IDX, LENGTH
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+# custom span attributes set by hc_nlp components, which are kept with each mention
+ENT_EXTENSIONS = ("alt_ent_text", "entity_co_occurrence", "entity_duplicate")
+
+# fields of an `EntityMention`, in order
+MENTION_FIELDS = (
+    "record_id",
+    "start_char",
+    "end_char",
+    "label",
+    "ent_id",
+) + ENT_EXTENSIONS
+
+# dtype of the structured arrays made by `mentions_to_array`. Strings are Python objects, so
+# that repeated labels and record ids are shared rather than padded to a fixed width.
+MENTION_DTYPE = np.dtype(
+    [
+        ("record_id", object),
+        ("start_char", np.int64),
+        ("end_char", np.int64),
+        ("label", object),
+        ("ent_id", object),
+        ("alt_ent_text", object),
+        ("entity_co_occurrence", object),
+        ("entity_duplicate", object),
+    ]
+)
+
+# value of ENT_IOB for the first and later tokens of an entity
+_IOB_INSIDE = 1
+_IOB_BEGIN = 3
+
+
+class EntityMention:
+    """One entity found in a record."""
+
+    __slots__ = MENTION_FIELDS
+
+    def __init__(
+        self,
+        record_id: Any,
+        start_char: int,
+        end_char: int,
+        label: str,
+        ent_id: str = "",
+        alt_ent_text: Any = None,
+        entity_co_occurrence: Any = None,
+        entity_duplicate: Any = None,
+    ):
+        self.record_id = record_id
+        self.start_char = start_char
+        self.end_char = end_char
+        self.label = label
+        self.ent_id = ent_id
+        self.alt_ent_text = alt_ent_text
+        self.entity_co_occurrence = entity_co_occurrence
+        self.entity_duplicate = entity_duplicate
+
+    def to_tuple(self) -> tuple:
+        return tuple(getattr(self, field) for field in MENTION_FIELDS)
+
+    def to_list(self) -> list:
+        """The mention without its record id, as an entry of `corpus.doc_to_record`'s "ents"."""
+        return [getattr(self, field) for field in MENTION_FIELDS[1:]]
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, EntityMention) and self.to_tuple() == other.to_tuple()
+
+    def __repr__(self) -> str:
+        return (
+            f"EntityMention({self.record_id!r}, {self.start_char}, {self.end_char}, "
+            f"{self.label!r})"
+        )
+
+
+def _extension_values(doc: spacy.tokens.Doc) -> Dict[Tuple[str, int, int], Any]:
+    """
+    Values of `ENT_EXTENSIONS` set on spans of `doc`, keyed by (name, start_char, end_char).
+    These are kept in `doc.user_data`, so are read from there rather than through `Span._`,
+    which would mean creating a `Span` and an `Underscore` for every entity.
+    """
+    if not doc.user_data:
+        return {}
+
+    values = {}
+    for key, value in doc.user_data.items():
+        if (
+            isinstance(key, tuple)
+            and len(key) >= 4
+            and key[0] == "._."
+            and key[1] in ENT_EXTENSIONS
+        ):
+            values[key[1], key[2], key[3]] = value
+
+    return values
+
+
+def _extension_defaults() -> Tuple[Dict[str, Any], List[str]]:
+    """
+    The default value of each of `ENT_EXTENSIONS` (None if it isn't registered), and the names
+    of any registered with a getter or method, whose values have to be read through `Span._`.
+    """
+    defaults = {}
+    computed = []
+
+    for name in ENT_EXTENSIONS:
+        if not spacy.tokens.Span.has_extension(name):
+            defaults[name] = None
+            continue
+
+        default, method, getter, _ = spacy.tokens.Span.get_extension(name)
+        defaults[name] = default
+        if method is not None or getter is not None:
+            computed.append(name)
+
+    return defaults, computed
+
+
+def doc_to_mentions(doc: spacy.tokens.Doc, record_id: Any) -> List[EntityMention]:
+    """
+    Returns an `EntityMention` for each entity in a doc. Entity boundaries, labels and ids are
+    read from the doc's token arrays without creating any spans.
+    """
+    array = doc.to_array([ENT_IOB, ENT_TYPE, ENT_ID, IDX, LENGTH])
+    if not len(array):
+        return []
+
+    iob = array[:, 0]
+    starts = np.flatnonzero(iob == _IOB_BEGIN)
+    if not len(starts):
+        return []
+
+    # an entity ends at the first token after its start which doesn't continue it
+    not_inside = np.append(np.flatnonzero(iob != _IOB_INSIDE), len(iob))
+    ends = not_inside[np.searchsorted(not_inside, starts, side="right")]
+
+    start_chars = array[starts, 3].tolist()
+    end_chars = (array[ends - 1, 3] + array[ends - 1, 4]).tolist()
+    label_hashes = array[starts, 1].tolist()
+    ent_id_hashes = array[starts, 2].tolist()
+
+    strings = doc.vocab.strings
+    names = {}
+    values = _extension_values(doc)
+    defaults, computed = _extension_defaults()
+
+    mentions = []
+    for idx, (start_char, end_char) in enumerate(zip(start_chars, end_chars)):
+        label_hash = label_hashes[idx]
+        if label_hash not in names:
+            names[label_hash] = strings[label_hash]
+
+        ent_id_hash = ent_id_hashes[idx]
+        if ent_id_hash not in names:
+            names[ent_id_hash] = strings[ent_id_hash] if ent_id_hash else ""
+
+        mention = EntityMention(
+            record_id,
+            start_char,
+            end_char,
+            names[label_hash],
+            names[ent_id_hash],
+            *(
+                values.get((name, start_char, end_char), defaults[name])
+                for name in ENT_EXTENSIONS
+            ),
+        )
+
+        for name in computed:
+            span = doc[int(starts[idx]) : int(ends[idx])]
+            setattr(mention, name, span._.get(name))
+
+        mentions.append(mention)
+
+    return mentions
+
+
+def pipe_mentions(
+    nlp: spacy.language.Language,
+    records: Iterable[Tuple[Any, str]],
+    **kwargs,
+) -> Iterator[List[EntityMention]]:
+    """
+    Run (id, text) records through `nlp.pipe`, yielding the mentions in each one in input order.
+    Each doc is dropped as soon as its mentions have been extracted.
+
+    Args:
+        nlp (spacy.language.Language)
+        records (Iterable[Tuple[Any, str]]): (id, text) records
+        **kwargs: passed to `nlp.pipe`, e.g. `batch_size` and `n_process`
+
+    Yields:
+        List[EntityMention]: the mentions in each record
+    """
+    texts_with_ids = ((text, record_id) for record_id, text in records)
+
+    for doc, record_id in nlp.pipe(texts_with_ids, as_tuples=True, **kwargs):
+        yield doc_to_mentions(doc, record_id)
+
+
+def mentions_to_array(mentions: Sequence[EntityMention]) -> np.ndarray:
+    """A structured array of mentions, with dtype `MENTION_DTYPE`."""
+    array = np.empty(len(mentions), dtype=MENTION_DTYPE)
+
+    for field in MENTION_FIELDS:
+        array[field] = [getattr(mention, field) for mention in mentions]
+
+    return array
+
+
+def mentions_to_arrow(mentions: Sequence[EntityMention]):
+    """
+    An Arrow record batch of mentions, with a column for each of `MENTION_FIELDS`. Needs pyarrow
+    to be installed.
+
+    Returns:
+        pyarrow.RecordBatch
+    """
+    try:
+        import pyarrow as pa
+    except ImportError as e:
+        raise ImportError(
+            "pyarrow is needed for Arrow output: install it with `pip install hc-nlp[columnar]`"
+        ) from e
+
+    return pa.RecordBatch.from_pydict(
+        {
+            field: [getattr(mention, field) for mention in mentions]
+            for field in MENTION_FIELDS
+        }
+    )
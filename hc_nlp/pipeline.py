@@ -1,20 +1,66 @@
 import spacy
 from spacy.pipeline import EntityRuler
+from spacy.matcher import Matcher, PhraseMatcher
 from spacy.language import Language
-import time
+from spacy.attrs import SHAPE, LENGTH, IS_LOWER, IS_UPPER, ENT_IOB, ENT_TYPE
+import numpy as np
 import copy
-from typing import Sequence
-from hc_nlp import constants, logging
+import itertools
+import os
+import re
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+from hc_nlp import constants, logging, thesaurus
+from hc_nlp.entity_edits import EntityEdits, EntityRecord, edit_ents
 
 logger = logging.get_logger(__name__)
 
+# while True, thesaurus matchers are created empty and their compiled state is expected to be
+# restored by `from_disk` (see `snapshot.load_snapshot`)
+_defer_thesaurus_loading = False
+
+
+@contextmanager
+def defer_thesaurus_loading():
+    """
+    Within this context, `thesaurus_matcher` and `rule_matcher` don't read or compile their
+    thesaurus and delta files, leaving it to `Language.from_disk` to restore their state.
+    """
+    global _defer_thesaurus_loading
+    previous = _defer_thesaurus_loading
+    _defer_thesaurus_loading = True
+
+    try:
+        yield
+    finally:
+        _defer_thesaurus_loading = previous
+
 
 @Language.factory(
     "thesaurus_matcher",
-    default_config={"overwrite_ents": False, "case_sensitive": False},
+    default_config={
+        "overwrite_ents": False,
+        "case_sensitive": False,
+        "cache_dir": None,
+        "batch_size": 1000,
+        "n_process": 1,
+        "backend": "phrase_matcher",
+        "delta_paths": [],
+    },
 )
 def thesaurus_matcher(
-    nlp, name, thesaurus_path: str, case_sensitive: bool, overwrite_ents: bool
+    nlp,
+    name,
+    thesaurus_path: str,
+    case_sensitive: bool,
+    overwrite_ents: bool,
+    cache_dir: Optional[str],
+    batch_size: int,
+    n_process: int,
+    backend: str,
+    delta_paths: Sequence[str],
 ):
     """
     Factory function for a ThesaurusMatcher.
@@ -25,27 +71,53 @@ def thesaurus_matcher(
     to implement a purely rule-based entity recognition system. After
     initialization, the component is typically added to the pipeline using
     `nlp.add_pipe`.
+
+    If `cache_dir` is set, the tokenized thesaurus is written there on first load
+    and read back on later loads with the same thesaurus file, tokenizer and
+    `case_sensitive` setting, skipping pattern tokenization. Entry labels and ids are
+    then memory-mapped from the cache, so worker processes share one copy of them.
+
+    Patterns are compiled in batches of `batch_size` using only the tokenizer (as
+    matching is on ORTH or LOWER), optionally spread over `n_process` processes.
+
+    `backend` selects how matching is done: "phrase_matcher" (default) uses a spaCy
+    `PhraseMatcher` over token sequences; "trie" uses a character-level Aho-Corasick
+    automaton over normalised text whose matches are snapped to token boundaries,
+    which keeps memory bounded for very large thesauri.
+
+    Delta files listed in `delta_paths` are applied in order after the thesaurus is
+    loaded (see `ThesaurusMatcher.apply_delta`), and cached in `cache_dir` if set.
+
+    The compiled state, including applied deltas, is saved by `nlp.to_disk`. Within
+    `defer_thesaurus_loading` the matcher is created empty, so that a saved pipeline can be
+    loaded without reading the thesaurus at all (see `snapshot.load_snapshot`).
     """
 
+    attr = "ORTH" if case_sensitive else "LOWER"
+    matcher_cls = (
+        thesaurus.TrieThesaurusMatcher
+        if backend == "trie"
+        else thesaurus.ThesaurusMatcher
+    )
+    ruler = matcher_cls(nlp, name, attr=attr, overwrite_ents=overwrite_ents)
+
+    if _defer_thesaurus_loading:
+        return ruler
+
     logger.info(f"Loading thesaurus from {thesaurus_path}")
-    other_pipes = [p for p in nlp.pipe_names if p != "tagger"]
 
     start = time.time()
 
-    # set config for new entityruler object
-    if case_sensitive:
-        with nlp.select_pipes(disable=other_pipes):
-            ruler = EntityRuler(nlp, overwrite_ents=overwrite_ents).from_disk(
-                thesaurus_path
-            )
-    else:
-        with nlp.select_pipes(disable=other_pipes):
-            ruler = EntityRuler(
-                nlp, overwrite_ents=overwrite_ents, phrase_matcher_attr="LOWER"
-            ).from_disk(thesaurus_path)
+    compiled = thesaurus.load_compiled_thesaurus(
+        nlp, thesaurus_path, attr, cache_dir, batch_size, n_process, backend
+    )
+    ruler.add_compiled(compiled)
+
+    for delta_path in delta_paths:
+        ruler.apply_delta(delta_path, cache_dir)
 
     end = time.time()
-    logger.info(f"{len(ruler)} term thesaurus imported in {int(end-start)}s")
+    logger.info(f"{len(ruler)} term thesaurus imported in {end-start:.1f}s")
 
     return ruler
 
@@ -62,6 +134,8 @@ class EntityFilter:
 
     These rules are applied so that if any of the tokens in an entity span don't look
     like entities, the whole span will be removed from `Doc.ents`.
+
+    The number of entities each rule removes or changes is counted in `EntityFilter.stats`.
     """
 
     def __init__(
@@ -92,6 +166,19 @@ class EntityFilter:
         self.remove_all_upper = remove_all_upper
         self.ent_labels_ignore = ent_labels_ignore
 
+        # memos from StringStore hashes to whether a shape contains "ddd" / whether
+        # a label is ignored, so that strings are only looked up once per vocab entry
+        self._shape_has_ddd = {}
+        self._label_ignored = {}
+
+        self.stats = {
+            "unlikely_removed": 0,
+            "the_year_removed": 0,
+            "the_year_trimmed": 0,
+            "n_years_removed": 0,
+            "royal_titles_added": 0,
+        }
+
     def _is_unlikely_entity(self, token: spacy.tokens.Token) -> bool:
         """
         Returns True if a token is likely not an entity, and False otherwise.
@@ -113,86 +200,137 @@ class EntityFilter:
         return False
 
     def _remove_the_year_from_date_entities(
-        self, doc: spacy.tokens.Doc
+        self, doc: spacy.tokens.Doc, edits: Optional[EntityEdits] = None
     ) -> spacy.tokens.Doc:
         """
         Removes phrase 'the year' from the start of any DATE entities.
         """
 
-        newdoc = copy.copy(doc)
-
-        for ent in newdoc.ents:
-            if (ent.label_ == "DATE") and ent.text.lower().startswith("the year"):
-                if ent.text.lower() == "the year":
-                    # remove entire entity
-                    newdoc.ents = [e for e in newdoc.ents if e != ent]
-                else:
-                    new_ent = spacy.tokens.Span(
-                        newdoc, ent.start + 2, ent.end, label="DATE"
-                    )
-
-                    newdoc.ents = [new_ent if e == ent else e for e in newdoc.ents]
+        with edit_ents(doc, edits) as edits:
+            for ent in edits.ents():
+                if edits.label_(ent) != "DATE":
+                    continue
+
+                ent_text = doc[ent.start : ent.end].text.lower()
+                if ent_text.startswith("the year"):
+                    if ent_text == "the year" or len(ent) <= 2:
+                        # remove entire entity
+                        edits.remove(ent)
+                        self.stats["the_year_removed"] += 1
+                    else:
+                        edits.set_bounds(ent, ent.start + 2, ent.end)
+                        self.stats["the_year_trimmed"] += 1
 
-        return newdoc
+        return doc
 
     def _remove_n_years_from_date_entities(
-        self, doc: spacy.tokens.Doc
+        self, doc: spacy.tokens.Doc, edits: Optional[EntityEdits] = None
     ) -> spacy.tokens.Doc:
         """
         Removes any DATE entities with the format 'n years'
         """
 
-        newdoc = copy.copy(doc)
-
-        for ent in newdoc.ents:
-            if (
-                (ent.label_ == "DATE")
-                and ("years" in ent.text.lower())
-                and ent[0].like_num
-            ):
-                newdoc.ents = [e for e in newdoc.ents if e != ent]
+        with edit_ents(doc, edits) as edits:
+            for ent in edits.ents():
+                if (
+                    (edits.label_(ent) == "DATE")
+                    and ("years" in doc[ent.start : ent.end].text.lower())
+                    and doc[ent.start].like_num
+                ):
+                    edits.remove(ent)
+                    self.stats["n_years_removed"] += 1
 
-        return newdoc
+        return doc
 
     def _add_royal_title_to_person_entities(
-        self, doc: spacy.tokens.Doc
+        self, doc: spacy.tokens.Doc, edits: Optional[EntityEdits] = None
     ) -> spacy.tokens.Doc:
-        newdoc = copy.copy(doc)
-
-        for ent in newdoc.ents:
-            if ent.label_ == "PERSON":
-                if (newdoc[ent.start - 1].text.lower() in constants.ROYAL_TITLES) and (
-                    not newdoc[ent.start - 1].ent_type_
+        with edit_ents(doc, edits) as edits:
+            for ent in edits.ents():
+                if (
+                    (edits.label_(ent) == "PERSON")
+                    and (ent.start > 0)
+                    and (doc[ent.start - 1].text.lower() in constants.ROYAL_TITLES)
+                    and (edits.ent_at(ent.start - 1) is None)
                 ):
-                    new_ent = spacy.tokens.Span(
-                        newdoc, ent.start - 1, ent.end, label="PERSON"
-                    )
+                    edits.set_bounds(ent, ent.start - 1, ent.end)
+                    self.stats["royal_titles_added"] += 1
 
-                    newdoc.ents = [new_ent if e == ent else e for e in newdoc.ents]
+        return doc
 
-        return newdoc
+    def _likely_entity_tokens(self, doc: spacy.tokens.Doc) -> np.ndarray:
+        """
+        Vectorised version of `not _is_unlikely_entity(token)` for every token in the doc.
+        """
+        token_attrs = doc.to_array([SHAPE, LENGTH, IS_LOWER, IS_UPPER])
+        shapes = token_attrs[:, 0]
+
+        unique_shapes = np.unique(shapes)
+        for shape in unique_shapes.tolist():
+            if shape not in self._shape_has_ddd:
+                self._shape_has_ddd[shape] = "ddd" in doc.vocab.strings[shape]
+        ddd_shapes = [s for s in unique_shapes.tolist() if self._shape_has_ddd[s]]
+
+        # tokens with 3+ consecutive digits could be years, so possibly DATE entities
+        has_ddd = np.isin(shapes, ddd_shapes)
+
+        unlikely = token_attrs[:, 1] <= self.max_token_length
+
+        # UPPERCASE and lowercase tokens assumed not to be entities
+        if self.remove_all_lower:
+            unlikely |= token_attrs[:, 2].astype(bool)
+
+        if self.remove_all_upper:
+            unlikely |= token_attrs[:, 3].astype(bool)
+
+        return has_ddd | ~unlikely
+
+    def _is_ignored_label(self, label: int) -> bool:
+        if label not in self._label_ignored:
+            self._label_ignored[label] = (
+                self.nlp.vocab.strings[label].upper() in self.ent_labels_ignore
+            )
+
+        return self._label_ignored[label]
 
     def __call__(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
         """
         Filter out entities which contain one or more token that doesn't look like
-        an entity.
+        an entity. The rules from `_is_unlikely_entity` are applied to all tokens at
+        once on arrays from `Doc.to_array`.
         """
-        likely_entity = []
-        for ent in doc.ents:
-            if ent.label_.upper() in self.ent_labels_ignore:
-                likely_entity.append(True)
-            else:
-                likely_entity.append(
-                    any([not self._is_unlikely_entity(tok) for tok in ent])
-                )
+        edits = EntityEdits(doc)
+        self.filter_edits(doc, edits)
+
+        # all of the filters are written to the doc at once
+        return edits.commit()
 
-        doc.ents = [ent for idx, ent in enumerate(doc.ents) if likely_entity[idx]]
+    def filter_edits(self, doc: spacy.tokens.Doc, edits: EntityEdits):
+        """
+        Applies the filter and the "the year", royal title and "n years" fixes to pending entity
+        edits, without writing them to the doc.
+        """
+        ents = edits.ents()
 
-        doc = self._remove_the_year_from_date_entities(doc)
-        doc = self._add_royal_title_to_person_entities(doc)
-        doc = self._remove_n_years_from_date_entities(doc)
+        if ents:
+            # number of likely entity tokens in each entity, from a cumulative sum
+            likely_cumsum = np.concatenate(
+                [[0], np.cumsum(self._likely_entity_tokens(doc))]
+            )
+            bounds = np.asarray([(ent.start, ent.end) for ent in ents])
+            keep = likely_cumsum[bounds[:, 1]] > likely_cumsum[bounds[:, 0]]
 
-        return doc
+            if self.ent_labels_ignore:
+                keep |= np.asarray([self._is_ignored_label(ent.label) for ent in ents])
+
+            for ent, k in zip(ents, keep.tolist()):
+                if not k:
+                    edits.remove(ent)
+                    self.stats["unlikely_removed"] += 1
+
+        self._remove_the_year_from_date_entities(doc, edits)
+        self._add_royal_title_to_person_entities(doc, edits)
+        self._remove_n_years_from_date_entities(doc, edits)
 
 
 def pattern_matcher(nlp, name: str, patterns: Sequence[dict]):
@@ -212,6 +350,56 @@ def pattern_matcher(nlp, name: str, patterns: Sequence[dict]):
     return ruler
 
 
+def combine_token_regexes(
+    patterns: Sequence[dict], extension: str
+) -> Tuple[List[dict], "re.Pattern"]:
+    """
+    Replaces `{"TEXT": {"REGEX": ...}}` token patterns with `{"_": {extension: key}}`, and compiles
+    all of the regexes into one pattern with a named group per distinct regex. A getter for the
+    `extension` Token attribute can then search tokens once with the combined regex rather than
+    once per regex (see `get_token_regex_key`).
+
+    Args:
+        patterns (Sequence[dict]): EntityRuler patterns.
+        extension (str): name of the Token extension attribute to match on.
+
+    Returns:
+        Tuple[List[dict], re.Pattern]: new patterns, and the combined regex.
+    """
+    patterns = copy.deepcopy(list(patterns))
+    regex_keys = {}
+
+    for pattern in patterns:
+        if not isinstance(pattern["pattern"], list):
+            continue
+
+        for token_spec in pattern["pattern"]:
+            text_spec = token_spec.get("TEXT")
+            if isinstance(text_spec, dict) and list(text_spec.keys()) == ["REGEX"]:
+                regex = text_spec["REGEX"]
+                if regex not in regex_keys:
+                    regex_keys[regex] = f"{extension}_{len(regex_keys)}"
+
+                del token_spec["TEXT"]
+                token_spec["_"] = {extension: regex_keys[regex]}
+
+    combined_regex = re.compile(
+        "|".join([f"(?P<{key}>{regex})" for regex, key in regex_keys.items()])
+    )
+
+    return patterns, combined_regex
+
+
+def get_token_regex_key(token: spacy.tokens.Token, combined_regex: "re.Pattern") -> str:
+    """
+    Returns the key of the regex from `combine_token_regexes` found in the token's text, or an
+    empty string if none are. If several regexes match, the leftmost match wins.
+    """
+    match = combined_regex.search(token.text)
+
+    return match.lastgroup if match else ""
+
+
 @Language.factory("pattern_matcher")
 class PatternMatcher:
     """
@@ -239,84 +427,520 @@ class PatternMatcher:
 
 @Language.factory("date_matcher")
 class DateMatcher(PatternMatcher):
-    def __init__(self, nlp, name):
+    """
+    Detects DATE entities of the form "... nth century", then dates matching
+    `constants.DATE_PATTERNS`.
+
+    Each of these steps is skipped for docs whose text can't contain a match (see
+    `constants.DATE_PRESCAN_REGEX` and `constants.CENTURY_PRESCAN_REGEX`). The REGEX token
+    patterns are searched for with one combined regex per token, through the Token attribute
+    `token._.date_regex`. Numbers of docs and skipped steps, and an estimate of the time saved
+    by skipping, are kept in `DateMatcher.stats`.
+
+    The start of century dates (e.g. "the late 19th century") is found from the dependency parse
+    by default. With `century_detection="patterns"` it is found from token sequences instead, so
+    the component can be used in pipelines without a parser.
+
+    Century dates are all added at once, after overlaps with existing entities have been
+    resolved using `century_overlap_policy`. Century dates that can't be added are counted in
+    `DateMatcher.stats["century_conflicts"]`, and those added in `stats["centuries_added"]`.
+    """
+
+    century_detection_modes = ("parser", "patterns")
+    century_overlap_policies = ("existing", "longest", "rule")
+
+    def __init__(
+        self,
+        nlp,
+        name,
+        century_detection: str = "parser",
+        century_overlap_policy: str = "existing",
+    ):
+        """
+        Initialise the DateMatcher.
+
+        Args:
+            century_detection (str, optional): how to find the start of century dates: "parser"
+                (from `token.children`), or "patterns" (from ordinals, connectors and modifiers in
+                `constants`, which doesn't need a parser). Defaults to "parser".
+            century_overlap_policy (str, optional): which entity to keep when a century date
+                overlaps existing entities: "existing" (keep the existing entities), "longest"
+                (keep the century date if it's longer than each of the entities it overlaps) or
+                "rule" (always keep the century date). Defaults to "existing".
+        """
         # TODO: inherit from pattern_matcher
-        super().__init__(nlp, name, constants.DATE_PATTERNS)
+        self.patterns, self._date_regex = combine_token_regexes(
+            constants.DATE_PATTERNS, "date_regex"
+        )
+        if not spacy.tokens.Token.has_extension("date_regex"):
+            spacy.tokens.Token.set_extension(
+                "date_regex",
+                getter=lambda token: get_token_regex_key(token, self._date_regex),
+            )
+
+        super().__init__(nlp, name, self.patterns)
         # self.ruler = EntityRuler(nlp)
         # self.ruler.add_patterns(constants.DATE_PATTERNS)
 
-    def _add_centuries_to_doc(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
+        if century_detection not in self.century_detection_modes:
+            raise ValueError(
+                f"century_detection must be one of {self.century_detection_modes}, not {century_detection}"
+            )
+
+        if century_overlap_policy not in self.century_overlap_policies:
+            raise ValueError(
+                f"century_overlap_policy must be one of {self.century_overlap_policies}, not {century_overlap_policy}"
+            )
+
+        self.century_detection = century_detection
+        self.century_overlap_policy = century_overlap_policy
+        self._ordinals = set(constants.ORDINALS)
+
+        self._date_prescan = re.compile(constants.DATE_PRESCAN_REGEX)
+        self._century_prescan = re.compile(constants.CENTURY_PRESCAN_REGEX)
+        # seconds per token, and tokens, of the century and pattern steps that were run
+        self._step_seconds = defaultdict(float)
+        self._step_tokens = defaultdict(int)
+        self.stats = {
+            "docs": 0,
+            "century_steps_skipped": 0,
+            "pattern_steps_skipped": 0,
+            "seconds_saved": 0.0,
+            "century_conflicts": 0,
+            "centuries_added": 0,
+        }
+
+    def _is_ordinal(self, token: spacy.tokens.Token) -> bool:
+        return (token.lower_ in self._ordinals) or all(
+            [string in self._ordinals for string in token.lower_.split("-")]
+        )
+
+    def _century_start_from_parse(self, doc: spacy.tokens.Doc, idx: int) -> int:
+        """
+        Returns the start of the century date ending in the word 'century' at `idx`, using
+        the immediate children of the token 'century' (and of 'nth' in "nth (and/or/to) mth
+        centuries").
+        """
+        try:
+            first_child = next(doc[idx].children)
+        except Exception:  # noqa: E722
+            # if the token has no children, use the ordinal token as first_child
+            first_child = doc[idx - 1]
+
+        # allow "nth (and|to|or) mth" century
+        if (doc[first_child.i - 1].lower_ in constants.CENTURY_CONNECTORS) and (
+            doc[first_child.i - 2].lower_ in constants.ORDINALS
+        ):
+            try:
+                # go back to the first child of "nth"
+                start = next(doc[first_child.i - 2].children).i
+
+                # if the child is after the 'nth' token, use the token instead of its child
+                if start > doc[first_child.i - 2].i:
+                    start = doc[first_child.i - 2].i
+            except Exception:
+                # if couldn't find children of 'nth', then just take 'nth' as start
+                start = doc[first_child.i - 2].i
+        else:
+            start = first_child.i
+
+        return start
+
+    def _extend_over_century_modifiers(self, doc: spacy.tokens.Doc, start: int) -> int:
+        """
+        Moves `start` left over up to `constants.CENTURY_MODIFIER_WINDOW` modifiers ("the",
+        "early", ...) or "<ordinal> <fraction> (of)" phrases, e.g. "second half of".
+        """
+        for _ in range(constants.CENTURY_MODIFIER_WINDOW):
+            if (start > 0) and (doc[start - 1].lower_ in constants.CENTURY_MODIFIERS):
+                start -= 1
+            elif (
+                (start > 2)
+                and (doc[start - 1].lower_ == "of")
+                and (doc[start - 2].lower_ in constants.CENTURY_FRACTIONS)
+                and self._is_ordinal(doc[start - 3])
+            ):
+                start -= 3
+            elif (
+                (start > 1)
+                and (doc[start - 1].lower_ in constants.CENTURY_FRACTIONS)
+                and self._is_ordinal(doc[start - 2])
+            ):
+                start -= 2
+            else:
+                break
+
+        return start
+
+    def _century_start_from_patterns(self, doc: spacy.tokens.Doc, idx: int) -> int:
+        """
+        Returns the start of the century date ending in the word 'century' at `idx` (with an
+        ordinal at `idx - 1`) using token sequences only: modifiers to the left of the ordinal,
+        then "nth (and/or/to)" and modifiers to the left of "nth".
+        """
+        start = self._extend_over_century_modifiers(doc, idx - 1)
+
+        # allow "nth (and|to|or) mth" century
+        if (
+            (start > 1)
+            and (doc[start - 1].lower_ in constants.CENTURY_CONNECTORS)
+            and self._is_ordinal(doc[start - 2])
+        ):
+            start = self._extend_over_century_modifiers(doc, start - 2)
+
+        return start
+
+    def _add_century_ents(self, edits: EntityEdits, candidates: Sequence[Tuple[int, int]]):
+        """
+        Adds century DATE entities from (start, end) candidates, longest first, resolving
+        overlaps with existing entities using `century_overlap_policy`. Candidates which are
+        invalid, overlap a longer candidate, or lose to existing entities are counted as conflicts.
+        """
+        added = set()
+
+        for start, end in sorted(set(candidates), key=lambda c: (c[0] - c[1], c[0])):
+            if not 0 <= start < end <= len(edits.doc):
+                # the start was found after the end
+                self.stats["century_conflicts"] += 1
+                continue
+
+            overlapping = {edits.ent_at(i) for i in range(start, end)} - {None}
+
+            if overlapping and (
+                (self.century_overlap_policy == "existing")
+                or (overlapping & added)
+                or (
+                    self.century_overlap_policy == "longest"
+                    and any(len(record) >= end - start for record in overlapping)
+                )
+            ):
+                self.stats["century_conflicts"] += 1
+                continue
+
+            for record in overlapping:
+                edits.remove(record)
+
+            added.add(edits.add(start, end, "DATE"))
+            self.stats["centuries_added"] += 1
+
+    def find_century_candidates(self, doc: spacy.tokens.Doc) -> List[Tuple[int, int]]:
+        """
+        Returns (start, end) for each date with the format "... nth century". Does this by finding
+        the word 'century' or 'centuries', checking that the previous word is an ordinal, and then
+        finding the start of the date using `century_detection` mode. It then checks for
+        occurrences of "nth (and/or/to) mth centuries", as well as "AD" or "BC" after the word
+        century/centuries.
         """
-        Adds dates with the format "... nth century" to `Doc.ents`. Does this by finding the word
-        'century' or 'centuries', checking that the previous word is an ordinal, and then returning all
-        the immediate children of the token 'century'. It then checks for occurrences of "nth (and/or/to)
-        mth centuries", as well as "AD" or "BC" after the word century/centuries.
+        candidates = []
+
+        for idx, token in enumerate(doc):
+            if token.lower_ not in ["century", "centuries"]:
+                continue
+
+            if self.century_detection == "patterns":
+                if (idx == 0) or not self._is_ordinal(doc[idx - 1]):
+                    continue
+
+                start = self._century_start_from_patterns(doc, idx)
+
+            else:
+                if not self._is_ordinal(doc[idx - 1]):
+                    continue
+
+                start = self._century_start_from_parse(doc, idx)
+
+            end = idx + 1
+
+            # add on 'AD' or 'BC' if present
+            if idx != len(doc) - 1:
+                if doc[idx + 1].text.upper() in ["AD", "BC"]:
+                    end += 1
+
+            candidates.append((start, end))
+
+        return candidates
+
+    def _add_centuries_to_doc(
+        self, doc: spacy.tokens.Doc, edits: Optional[EntityEdits] = None
+    ) -> spacy.tokens.Doc:
+        """
+        Adds dates with the format "... nth century" (see `find_century_candidates`) to
+        `Doc.ents`. The dates are added together once they've all been found (see
+        `_add_century_ents`).
         Args:
             doc (spacy.tokens.Doc)
+            edits (EntityEdits, optional): queue the new entities here instead of writing them to
+                the doc.
         Returns:
             spacy.tokens.Doc
         """
-        for idx, token in enumerate(doc):
-            if token.lower_ in ["century", "centuries"]:
-                if (doc[idx - 1].lower_ in constants.ORDINALS) or all(
-                    [
-                        string in constants.ORDINALS
-                        for string in doc[idx - 1].lower_.split("-")
-                    ]
-                ):
-                    try:
-                        first_child = next(token.children)
-                    except Exception:  # noqa: E722
-                        # if the token has no children, use the ordinal token as first_child
-                        first_child = doc[idx - 1]
-
-                    # allow "nth (and|to|or) mth" century
-                    if (doc[first_child.i - 1].lower_ in ["and", "to", "or"]) and (
-                        doc[first_child.i - 2].lower_ in constants.ORDINALS
-                    ):
-                        try:
-                            # go back to the first child of "nth"
-                            start = next(doc[first_child.i - 2].children).i
-
-                            # if the child is after the 'nth' token, use the token instead of its child
-                            if start > doc[first_child.i - 2].i:
-                                start = doc[first_child.i - 2].i
-                        except Exception:
-                            # if couldn't find children of 'nth', then just take 'nth' as start
-                            start = doc[first_child.i - 2].i
-                    else:
-                        start = first_child.i
-
-                    # print([c for c in doc[first_child.i - 2].children])
-
-                    end = idx + 1
-
-                    # add on 'AD' or 'BC' if present
-                    if idx != len(doc) - 1:
-                        if doc[idx + 1].text.upper() in ["AD", "BC"]:
-                            end += 1
-
-                    date_entity = spacy.tokens.Span(doc, start, end, label="DATE")
-                    try:
-                        doc.ents = list(doc.ents) + [date_entity]
-                    except Exception:
-                        # TODO: check for overlap instead of just failing
-                        # TODO: handle the specific spaCy error
-                        logger.warn(
-                            f"Failed to add DATE entity {date_entity.text} in pos {(start, end)} to text {doc.text}"
-                        )
+        with edit_ents(doc, edits) as edits:
+            self._add_century_ents(edits, self.find_century_candidates(doc))
+
         return doc
 
     def __call__(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
         """
-        Detects centuries then patterns from `constants.DATE_PATTERNS`.
+        Detects centuries then patterns from `constants.DATE_PATTERNS`, skipping either step if
+        the text of the doc means it can't find anything.
         Args:
             doc (spacy.tokens.Doc)
         Returns:
             spacy.tokens.Doc
         """
-        doc = self._add_centuries_to_doc(doc)
-        doc = self.ruler(doc)
+        self.stats["docs"] += 1
+
+        doc = self._run_step(
+            "century", self._century_prescan, self._add_centuries_to_doc, doc
+        )
+        doc = self._run_step("pattern", self._date_prescan, self.ruler, doc)
+
+        return doc
+
+    def _run_step(
+        self, step: str, prescan: "re.Pattern", func, doc: spacy.tokens.Doc
+    ) -> spacy.tokens.Doc:
+        """
+        Runs `func` on the doc if `prescan` is found in its text. Otherwise, counts the step as
+        skipped and estimates the time saved from the average time per token of the step.
+        """
+        if not prescan.search(doc.text):
+            self.stats[f"{step}_steps_skipped"] += 1
+            if self._step_tokens[step]:
+                self.stats["seconds_saved"] += (
+                    len(doc) * self._step_seconds[step] / self._step_tokens[step]
+                )
+
+            return doc
+
+        start = time.perf_counter()
+        doc = func(doc)
+        self._step_seconds[step] += time.perf_counter() - start
+        self._step_tokens[step] += len(doc)
+
+        return doc
+
+
+@Language.factory(
+    "rule_matcher",
+    default_config={
+        "thesaurus_path": None,
+        "case_sensitive": False,
+        "cache_dir": None,
+        "batch_size": 1000,
+        "n_process": 1,
+        "backend": "phrase_matcher",
+        "delta_paths": [],
+        "dates": True,
+        "century_detection": "parser",
+        "pattern_sources": {},
+        "priorities": {},
+        "overwrite_ents": False,
+    },
+)
+class RuleMatcher:
+    """
+    Runs the rule-based matchers of `thesaurus_matcher`, `date_matcher` and any number of
+    `pattern_matcher`s as one component. Token patterns from all of the pattern sources are
+    compiled into one Matcher, and phrase patterns into one PhraseMatcher, so each doc is scanned
+    once by each of these, once by the thesaurus and once for century dates, however many
+    pattern sources are configured.
+
+    Matches from all sources are resolved together and written to the doc with one `set_ents`
+    call. Matches from sources with higher priority win, then longer matches, then earlier ones.
+    Existing entities are only replaced if `overwrite_ents`. Sources are called "thesaurus",
+    "dates", and the names in `pattern_sources`. By default their priority is the order they
+    would usually appear in a pipeline: the thesaurus first, then dates, then `pattern_sources`
+    in order.
+
+    Numbers of matches and of entities added are counted in `RuleMatcher.stats`.
+    """
+
+    def __init__(
+        self,
+        nlp,
+        name: str,
+        thesaurus_path: Optional[str],
+        case_sensitive: bool,
+        cache_dir: Optional[str],
+        batch_size: int,
+        n_process: int,
+        backend: str,
+        delta_paths: Sequence[str],
+        dates: bool,
+        century_detection: str,
+        pattern_sources: Dict[str, Sequence[dict]],
+        priorities: Dict[str, int],
+        overwrite_ents: bool,
+    ):
+        """
+        Initialise the RuleMatcher.
+
+        Args:
+            thesaurus_path (Optional[str]): path to a thesaurus JSONL file, or None to not match
+                a thesaurus. `case_sensitive`, `cache_dir`, `batch_size`, `n_process`, `backend`
+                and `delta_paths` are as for `thesaurus_matcher`.
+            dates (bool): whether to match `constants.DATE_PATTERNS` and century dates, as
+                `date_matcher` does.
+            century_detection (str): see `DateMatcher`.
+            pattern_sources (Dict[str, Sequence[dict]]): EntityRuler patterns for each
+                `pattern_matcher` to include, by name.
+            priorities (Dict[str, int]): priority of each source, by name. Overrides the default
+                priorities, which go from len(sources) - 1 for the thesaurus down to 0.
+            overwrite_ents (bool): whether matches replace existing entities.
+        """
+        self.nlp = nlp
+        self.name = name
+        self.overwrite = overwrite_ents
+
+        sources = (["thesaurus"] if thesaurus_path else []) + (["dates"] if dates else [])
+        sources += list(pattern_sources.keys())
+        self.priorities = {
+            source: len(sources) - 1 - idx for idx, source in enumerate(sources)
+        }
+        self.priorities.update(priorities)
+
+        self.thesaurus = None
+        if thesaurus_path:
+            self.thesaurus = thesaurus_matcher(
+                nlp,
+                f"{name}_thesaurus",
+                thesaurus_path,
+                case_sensitive,
+                overwrite_ents,
+                cache_dir,
+                batch_size,
+                n_process,
+                backend,
+                delta_paths,
+            )
+
+        self.date_matcher = None
+        if dates:
+            self.date_matcher = DateMatcher(
+                nlp, f"{name}_dates", century_detection=century_detection
+            )
+            pattern_sources = {"dates": self.date_matcher.patterns, **pattern_sources}
+
+        self.matcher = Matcher(nlp.vocab)
+        self.phrase_matcher = PhraseMatcher(nlp.vocab)
+        # match key -> (priority, label hash, entity id)
+        self._match_keys: Dict[int, Tuple[int, int, str]] = {}
+        self.stats = {"matches": 0, "ents_added": 0}
+
+        for source, patterns in pattern_sources.items():
+            self._add_patterns(source, patterns)
+
+    def _add_patterns(self, source: str, patterns: Sequence[dict]):
+        """
+        Adds EntityRuler patterns to the combined Matcher and PhraseMatcher, with one match key
+        for each (label, id) pair in the source.
+        """
+        token_patterns = defaultdict(list)
+        phrase_patterns = defaultdict(list)
+
+        for pattern in patterns:
+            key = (pattern["label"], pattern.get("id", ""))
+            if isinstance(pattern["pattern"], str):
+                phrase_patterns[key].append(pattern["pattern"])
+            else:
+                token_patterns[key].append(pattern["pattern"])
+
+        for key in set(token_patterns) | set(phrase_patterns):
+            label, ent_id = key
+            match_key = f"{source}\t{label}\t{ent_id}"
+            self._match_keys[self.nlp.vocab.strings.add(match_key)] = (
+                self.priorities[source],
+                self.nlp.vocab.strings.add(label),
+                ent_id,
+            )
+
+            if key in token_patterns:
+                self.matcher.add(match_key, token_patterns[key])
+            if key in phrase_patterns:
+                self.phrase_matcher.add(
+                    match_key, list(self.nlp.tokenizer.pipe(phrase_patterns[key]))
+                )
+
+    def match(self, doc: spacy.tokens.Doc) -> List[Tuple[int, int, int, int, str]]:
+        """
+        Returns (priority, start, end, label hash, entity id) for each match from every source,
+        sorted so that the matches that take priority come first.
+        """
+        matches = []
+
+        if self.thesaurus is not None:
+            # use the same state throughout in case a delta is applied meanwhile
+            state = self.thesaurus._state
+            priority = self.priorities["thesaurus"]
+            matches += [
+                (priority, start, end, label_hash, state.ent_id(row))
+                for label_hash, start, end, row in self.thesaurus.match(doc, state)
+            ]
+
+        if self.date_matcher is not None and self.date_matcher._century_prescan.search(
+            doc.text
+        ):
+            priority = self.priorities["dates"]
+            date_hash = self.nlp.vocab.strings.add("DATE")
+            matches += [
+                (priority, start, end, date_hash, "")
+                for start, end in self.date_matcher.find_century_candidates(doc)
+                if 0 <= start < end <= len(doc)
+            ]
+
+        for match_key, start, end in itertools.chain(
+            self.matcher(doc), self.phrase_matcher(doc)
+        ):
+            priority, label_hash, ent_id = self._match_keys[match_key]
+            matches.append((priority, start, end, label_hash, ent_id))
+
+        # the sort is stable, so thesaurus matches stay in the thesaurus's own order of priority
+        return sorted(matches, key=lambda m: (-m[0], m[1] - m[2], m[1]))
+
+    def to_disk(self, path, exclude: Sequence[str] = tuple()):
+        """
+        Save the compiled thesaurus state, if there is a thesaurus. Token and phrase patterns
+        aren't saved as they're rebuilt from the config.
+        """
+        os.makedirs(path, exist_ok=True)
+
+        if self.thesaurus is not None:
+            self.thesaurus.to_disk(os.path.join(path, "thesaurus"), exclude=exclude)
+
+    def from_disk(self, path, exclude: Sequence[str] = tuple()) -> "RuleMatcher":
+        if self.thesaurus is not None:
+            self.thesaurus.from_disk(os.path.join(path, "thesaurus"), exclude=exclude)
+
+        return self
+
+    def __call__(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
+        """
+        Adds the matches from every source to `Doc.ents`, resolving overlaps once.
+        """
+        matches = self.match(doc)
+        self.stats["matches"] += len(matches)
+
+        if not matches:
+            return doc
+
+        edits = EntityEdits(doc)
+        added = set()
+
+        for _, start, end, label_hash, ent_id in matches:
+            overlapping = {edits.ent_at(i) for i in range(start, end)} - {None}
+
+            if overlapping and ((overlapping & added) or not self.overwrite):
+                continue
+
+            for record in overlapping:
+                edits.remove(record)
+
+            ent_id_hash = doc.vocab.strings.add(ent_id) if ent_id else 0
+            added.add(edits.add(start, end, label_hash, ent_id=ent_id_hash))
+
+        self.stats["ents_added"] += len(added)
+        edits.commit()
 
         return doc
 
@@ -332,11 +956,21 @@ class MapEntityTypes:
 
         self.mapping = mapping
         self.nlp = nlp
+        self.stats = {"labels_mapped": 0}
+
+        # StringStore hash -> hash for the labels which change, so that labels can be remapped
+        # on the ENT_TYPE array without looking up any strings
+        self._hash_mapping = {
+            nlp.vocab.strings.add(label): nlp.vocab.strings.add(new_label)
+            for label, new_label in mapping.items()
+            if label != new_label
+        }
 
     def __call__(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
         """
         Replace entities in `Doc.ents` with new entities based on the mapping specified when initialising
-        the class instance.
+        the class instance. Labels are remapped on the doc's ENT_TYPE array, and the doc is left
+        as it is if the mapping doesn't change any of its labels.
 
         Args:
             doc (spacy.tokens.Doc
@@ -344,17 +978,40 @@ class MapEntityTypes:
         Returns:
             spacy.tokens.Doc
         """
-        new_ents = []
-        for ent in list(doc.ents):
-            new_ent = spacy.tokens.Span(
-                doc, ent.start, ent.end, label=self.mapping.get(ent.label_, ent.label_)
-            )
-            new_ents.append(new_ent)
+        ent_attrs = doc.to_array([ENT_IOB, ENT_TYPE])
+        ent_types = ent_attrs[:, 1]
+        labels_to_map = [
+            label
+            for label in np.unique(ent_types).tolist()
+            if label in self._hash_mapping
+        ]
+
+        if not labels_to_map:
+            return doc
+
+        new_ent_types = ent_types.copy()
+        for label in labels_to_map:
+            new_ent_types[ent_types == label] = self._hash_mapping[label]
+
+        # count entities rather than tokens, from their first (B) tokens
+        self.stats["labels_mapped"] += int(
+            np.count_nonzero((new_ent_types != ent_types) & (ent_attrs[:, 0] == 3))
+        )
 
-        doc.ents = new_ents
+        ent_attrs[:, 1] = new_ent_types
+        doc.from_array([ENT_IOB, ENT_TYPE], ent_attrs)
 
         return doc
 
+    def map_edits(self, edits: EntityEdits):
+        """
+        Remaps the labels of pending entity edits, without writing them to the doc.
+        """
+        for ent in edits.ents():
+            if ent.label in self._hash_mapping:
+                edits.set_label(ent, self._hash_mapping[ent.label])
+                self.stats["labels_mapped"] += 1
+
 
 @Language.factory("entity_joiner")
 class EntityJoiner:
@@ -365,133 +1022,63 @@ class EntityJoiner:
     - for consecutive PERSON entities separated by an 'and' (e.g. 'Katharine and Charles Parsons'), sets the
     span attribute `ent._.alt_ent_text` to the full name of the first person ('Katharine Parsons',
     using the same example). Useful for entity linking.
+
+    The number of joins made by each of these is counted in `EntityJoiner.stats`.
     """
 
     def __init__(self, nlp, name):
         self.nlp = nlp
+        self.stats = {"same_label_joins": 0, "comma_loc_joins": 0, "person_joins": 0}
 
-    def _detect_joined_person_entities(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
+    def _detect_joined_person_entities(
+        self, doc: spacy.tokens.Doc, edits: Optional[EntityEdits] = None
+    ) -> spacy.tokens.Doc:
         """Detect two people in a row separated by an 'and', where the first person is only referred to by their
         first name. Set the attribute `ent._.alt_ent_text` for the first person to their first name, plus
         the surname of the next mentioned person.
 
         Args:
             doc (spacy.tokens.Doc)
+            edits (EntityEdits, optional): pending entity edits to read entities from.
 
         Returns:
             spacy.tokens.Doc: amended doc
         """
-        # set custom span attributes
-        if not spacy.tokens.Span.has_extension("alt_ent_text"):
-            spacy.tokens.Span.set_extension("alt_ent_text", default=None)
-
-        idx = 0
-        new_ents = []
-
-        while idx < len(doc.ents):
-            if idx + 1 == len(doc.ents):
-                new_ents.append(doc.ents[idx])
-                idx += 1
-                continue
-
-            if doc.ents[idx].end >= len(doc):
-                idx += 1
-                continue
+        with edit_ents(doc, edits) as edits:
+            edits.replace(self._sweep_joined_person_entities(doc, edits.ents()))
 
-            curr_ent = doc.ents[idx]
-            next_token = doc[curr_ent.end]
-            next_ent = doc.ents[idx + 1]
-
-            # two consecutive entities are labelled PERSON; separated only by 'and' or '&'; don't share the same last token (i.e. surname)
-            if (
-                (curr_ent.label_ == next_ent.label_ == "PERSON")
-                and (len(curr_ent) == 1)
-                and (next_token.text.lower() in {"and", "&"})
-                and (curr_ent.end + 1 == next_ent.start)
-                and (curr_ent[-1].text.lower() != next_ent[-1].text.lower())
-            ):
-                # assume lastname is all tokens but the first
-                lastname = next_ent[1:].text
-                curr_ent._.alt_ent_text = curr_ent.text + " " + lastname
-
-            new_ents.append(curr_ent)
-            idx += 1
-
-        newdoc = copy.copy(doc)
-        newdoc.ents = new_ents
-
-        return newdoc
+        return doc
 
     def _join_consecutive_ents_with_same_label(
-        self, doc: spacy.tokens.Doc, exclude_types: Sequence[str] = []
+        self,
+        doc: spacy.tokens.Doc,
+        exclude_types: Sequence[str] = [],
+        edits: Optional[EntityEdits] = None,
     ) -> spacy.tokens.Doc:
         """Join entities which occupy consecutive tokens and have the same label.
 
         Args:
             doc (spacy.tokens.Doc)
             exclude_types (Sequence[str]): entity labels for which consecutive tokens should not be joined.
+            edits (EntityEdits, optional): queue the joins here instead of writing them to the doc.
 
         Returns:
             spacy.tokens.Doc: amended doc
         """
-        idx = 0
-        new_ents = []
-
-        while idx < len(doc.ents):
-            # add last entity to new_ents as not included in above while loop
-            if idx + 1 == len(doc.ents):
-                new_ents.append(doc.ents[idx])
-                idx += 1
-                continue
-
-            if doc.ents[idx].end >= len(doc):
-                idx += 1
-                continue
-
-            curr_ent = doc.ents[idx]
-            next_token = doc[curr_ent.end]
-
-            if curr_ent.label_ == next_token.ent_type_:
-                # search for continuation of the same label for future tokens, starting with the one after
-                # the next token. For each token with a matching label found, increment the offset value by one.
-                # This is then used to set the end of joined_ent and increment the value of idx.
-                next_token_offset = 0
-                while ((curr_ent.end + 1 + next_token_offset) < len(doc)) and (
-                    curr_ent.label_
-                    == doc[curr_ent.end + 1 + next_token_offset].ent_type_
-                ):
-                    next_token_offset += 1
-
-                joined_ent_end = curr_ent.end + 1 + next_token_offset
-                joined_ent = spacy.tokens.Span(
-                    doc,
-                    curr_ent.start,
-                    joined_ent_end,
-                    curr_ent.label_,
+        with edit_ents(doc, edits) as edits:
+            edits.replace(
+                self._sweep_consecutive_ents_with_same_label(
+                    edits.ents(), edits.token_labels()
                 )
-                new_ents.append(joined_ent)
-
-                # find and go to next entity after the observed span is finished
-                ent_idxs_after_joined_ent = [
-                    i for (i, e) in enumerate(doc.ents) if e.start > joined_ent_end
-                ]
-
-                if len(ent_idxs_after_joined_ent) > 0:
-                    idx = min(ent_idxs_after_joined_ent)
-                else:
-                    break
-
-            else:
-                new_ents.append(curr_ent)
-                idx += 1
-
-        newdoc = copy.copy(doc)
-        newdoc.ents = new_ents
+            )
 
-        return newdoc
+        return doc
 
     def _join_comma_separated_locs(
-        self, doc: spacy.tokens.Doc, loc_ent_labels: Sequence[str] = ["LOC"]
+        self,
+        doc: spacy.tokens.Doc,
+        loc_ent_labels: Sequence[str] = ["LOC"],
+        edits: Optional[EntityEdits] = None,
     ) -> spacy.tokens.Doc:
         """
         Join pairs of consecutive LOC entities which are separated by only a comma, e.g. "[Brighton], [UK]" -> "[Brighton, UK]".
@@ -500,61 +1087,199 @@ class EntityJoiner:
         Args:
             doc (spacy.tokens.Doc):
             loc_ent_labels (Sequence[str], optional): entity label names for location entities. Defaults to ["LOC"].
+            edits (EntityEdits, optional): queue the joins here instead of writing them to the doc.
 
         Returns:
             spacy.tokens.Doc:
         """
-        idx = 0
-        new_ents = []
+        with edit_ents(doc, edits) as edits:
+            edits.replace(
+                self._sweep_comma_separated_locs(doc, edits.ents(), loc_ent_labels)
+            )
 
-        while idx < len(doc.ents):
-            # add last entity to new_ents as not included in above while loop
-            if idx + 1 == len(doc.ents):
-                new_ents.append(doc.ents[idx])
-                idx += 1
-                continue
+        return doc
 
-            # stop at token before last token (as operates on minimum 3 consecutive tokens)
-            if doc.ents[idx].end + 1 >= len(doc):
-                idx += 1
-                continue
+    def _sweep_consecutive_ents_with_same_label(
+        self, ents: Iterable[EntityRecord], token_labels: np.ndarray
+    ) -> Iterator[EntityRecord]:
+        """
+        Generator version of `_join_consecutive_ents_with_same_label`, over entities sorted by
+        position and the label of each token (e.g. from the ENT_TYPE array) before any joins.
+        """
+        n_tokens = len(token_labels)
+
+        # the end of the run of tokens with the same label that each token is in
+        run_ends = np.append(
+            np.flatnonzero(token_labels[1:] != token_labels[:-1]) + 1, n_tokens
+        )
+        token_run_ends = run_ends[
+            np.searchsorted(run_ends, np.arange(n_tokens), side="right")
+        ].tolist()
+        token_labels = token_labels.tolist()
 
-            curr_ent = doc.ents[idx]
-            next_ent = doc.ents[idx + 1]
-            next_token = doc[curr_ent.end]
-            token_after_next_token = doc[curr_ent.end + 1]
+        ents = iter(ents)
+        curr_ent = next(ents, None)
+
+        while curr_ent is not None:
+            next_ent = next(ents, None)
+
+            # the last entity has nothing after it to join onto
+            if next_ent is None:
+                yield curr_ent
+                return
+
+            if token_labels[curr_ent.end] == curr_ent.label:
+                # join on all following tokens with the same label
+                joined_ent_end = token_run_ends[curr_ent.end]
+                self.stats["same_label_joins"] += 1
+                yield EntityRecord(curr_ent.start, joined_ent_end, curr_ent.label)
+
+                # go to next entity after the observed span is finished, dropping the entities
+                # joined onto this one (and any entity starting straight after it)
+                while (next_ent is not None) and (next_ent.start <= joined_ent_end):
+                    next_ent = next(ents, None)
+
+            else:
+                yield curr_ent
+
+            curr_ent = next_ent
+
+    def _sweep_comma_separated_locs(
+        self,
+        doc: spacy.tokens.Doc,
+        ents: Iterable[EntityRecord],
+        loc_ent_labels: Sequence[str] = ["LOC"],
+    ) -> Iterator[EntityRecord]:
+        """
+        Generator version of `_join_comma_separated_locs`, over entities sorted by position.
+        """
+        loc_labels = {doc.vocab.strings[label] for label in loc_ent_labels}
+
+        # the current entity and the two after it, which are enough to find the label of the
+        # second token after the current entity
+        ents = iter(ents)
+        window = deque(itertools.islice(ents, 3))
+
+        while window:
+            curr_ent = window.popleft()
+
+            # the last entity has nothing after it to join onto
+            if not window:
+                yield curr_ent
+                return
+
+            next_ent = window[0]
+            token_after_next_token = curr_ent.end + 1
+
+            # operates on minimum 3 consecutive tokens, so entities ending at the token before
+            # the last token are dropped
+            if token_after_next_token >= len(doc):
+                pass
 
             # allow for extra spaces either side of the comma
-            if (
-                (curr_ent.label_ in loc_ent_labels)
-                and (next_token.text.strip() == ",")
-                and (next_ent.label_ in loc_ent_labels)
-                and (token_after_next_token.ent_type_ in loc_ent_labels)
+            elif (
+                (curr_ent.label in loc_labels)
+                and (doc[curr_ent.end].text.strip() == ",")
+                and (next_ent.label in loc_labels)
+                and any(
+                    (ent.start <= token_after_next_token < ent.end)
+                    and (ent.label in loc_labels)
+                    for ent in itertools.islice(window, 2)
+                )
             ):
+                self.stats["comma_loc_joins"] += 1
+                yield EntityRecord(curr_ent.start, next_ent.end, curr_ent.label)
+                window.popleft()
 
-                joined_loc_ent = spacy.tokens.Span(
-                    doc, curr_ent.start, next_ent.end, curr_ent.label_
-                )
-                new_ents.append(joined_loc_ent)
+            else:
+                yield curr_ent
 
-                idx += 2
+            window.extend(itertools.islice(ents, 3 - len(window)))
 
-            else:
-                new_ents.append(curr_ent)
-                idx += 1
+    def _sweep_joined_person_entities(
+        self, doc: spacy.tokens.Doc, ents: Iterable[EntityRecord]
+    ) -> Iterator[EntityRecord]:
+        """
+        Generator version of `_detect_joined_person_entities`, over entities sorted by position.
+        Entities are passed through unchanged.
+        """
+        # set custom span attributes
+        if not spacy.tokens.Span.has_extension("alt_ent_text"):
+            spacy.tokens.Span.set_extension("alt_ent_text", default=None)
+
+        person_label = doc.vocab.strings["PERSON"]
+        curr_ent = None
+
+        for next_ent in ents:
+            # two consecutive entities are labelled PERSON; separated only by 'and' or '&'; don't share the same last token (i.e. surname)
+            if (
+                (curr_ent is not None)
+                and (curr_ent.label == next_ent.label == person_label)
+                and (len(curr_ent) == 1)
+                and (doc[curr_ent.end].text.lower() in {"and", "&"})
+                and (curr_ent.end + 1 == next_ent.start)
+                and (
+                    doc[curr_ent.end - 1].text.lower()
+                    != doc[next_ent.end - 1].text.lower()
+                )
+            ):
+                # assume lastname is all tokens but the first
+                lastname = doc[next_ent.start + 1 : next_ent.end].text
+                first_person = doc[curr_ent.start : curr_ent.end]
+                first_person._.alt_ent_text = first_person.text + " " + lastname
+                self.stats["person_joins"] += 1
 
-        newdoc = copy.copy(doc)
-        newdoc.ents = new_ents
+            if curr_ent is not None:
+                yield curr_ent
 
-        return newdoc
+            curr_ent = next_ent
+
+        if curr_ent is not None:
+            yield curr_ent
 
     def __call__(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
-        newdoc = copy.copy(doc)
-        newdoc = self._join_consecutive_ents_with_same_label(newdoc)
-        newdoc = self._join_comma_separated_locs(newdoc)
-        newdoc = self._detect_joined_person_entities(newdoc)
+        """
+        Runs the three passes as one forward sweep over the doc's entities, by chaining their
+        generator versions, and writes the result to the doc once.
+        """
+        edits = EntityEdits(doc)
+        self.join_edits(doc, edits)
+
+        return edits.commit()
+
+    def join_edits(self, doc: spacy.tokens.Doc, edits: EntityEdits):
+        """
+        Applies the three passes to pending entity edits as one forward sweep, without writing
+        them to the doc.
+        """
+        ents = self._sweep_consecutive_ents_with_same_label(
+            edits.ents(), edits.token_labels()
+        )
+        ents = self._sweep_comma_separated_locs(doc, ents)
+        ents = self._sweep_joined_person_entities(doc, ents)
+        edits.replace(ents)
+
+
+class EntityTextIndex:
+    """
+    Per-document index from lowercased entity text to the positions of entities in `Doc.ents`
+    with that text, grouped by label.
+    """
+
+    def __init__(self, doc: spacy.tokens.Doc):
+        self.ents = doc.ents
+        self.texts = [ent.text.lower() for ent in self.ents]
+        self.labels = [ent.label_ for ent in self.ents]
+
+        self._positions = {}
+        for idx, (label, text) in enumerate(zip(self.labels, self.texts)):
+            self._positions.setdefault(label, {}).setdefault(text, []).append(idx)
 
-        return newdoc
+    def positions(self, text: str, label: str) -> List[int]:
+        """
+        Returns the positions of entities with lowercased text `text` and label `label`.
+        """
+        return self._positions.get(label, {}).get(text, [])
 
 
 @Language.factory("duplicate_entity_detector")
@@ -571,6 +1296,8 @@ class DuplicateEntityDetector:
     E.g. in a document with 'Joseph Henry' (PERSON) followed by 'Henry' (PERSON) or 'Joseph' (PERSON) later on in
     the passage, the `span._.entity_co_occurrence` attribute will be set to the same string value for both entities
     and the `span._.entity_duplicate` attribute will be set to False for the first mention and True for the second.
+
+    The number of duplicates marked for each type is counted in `DuplicateEntityDetector.stats`.
     """
 
     def __init__(self, nlp, name, types_ignore: Sequence[str] = []):
@@ -582,6 +1309,8 @@ class DuplicateEntityDetector:
         """
 
         self.types_ignore = {"PERSON", "ORG", "LOC"}.intersection(set(types_ignore))
+        self.org_legal_suffixes = {s.lower() for s in constants.ORG_LEGAL_SUFFIXES}
+        self.stats = {"PERSON_duplicates": 0, "ORG_duplicates": 0, "LOC_duplicates": 0}
 
         # set custom span attributes
         if not spacy.tokens.Span.has_extension("entity_co_occurrence"):
@@ -590,8 +1319,29 @@ class DuplicateEntityDetector:
         if not spacy.tokens.Span.has_extension("entity_duplicate"):
             spacy.tokens.Span.set_extension("entity_duplicate", default=False)
 
+    def _person_names(self, ent: spacy.tokens.Span) -> Optional[Tuple[str, str]]:
+        """
+        Returns the first name and last name of a PERSON entity, or None if it only has one word.
+        Assumes first name is only one word and all other words make up the last name.
+        """
+        # Check for alternative entity text (i.e. firstname + lastname) which will have
+        # been inserted if EntityJoiner was applied before DuplicateEntityDetector in the
+        # pipeline.
+        if (
+            spacy.tokens.Span.has_extension("alt_ent_text")
+            and ent._.alt_ent_text is not None
+        ):
+            ent_text_split = ent._.alt_ent_text.split(" ")
+            if len(ent_text_split) > 1:
+                return ent_text_split[0], " ".join(ent_text_split[1:])
+
+        elif len(ent) > 1:
+            return ent[0].text, ent[1:].text
+
+        return None
+
     def _detect_duplicate_person_mentions(
-        self, doc: spacy.tokens.Doc
+        self, doc: spacy.tokens.Doc, index: Optional[EntityTextIndex] = None
     ) -> spacy.tokens.Doc:
         """
         Detect duplicate person mentions of the pattern "Firstname Lastname" then "Lastname".
@@ -600,67 +1350,106 @@ class DuplicateEntityDetector:
 
         Args:
             doc (spacy.tokens.Doc)
+            index (EntityTextIndex, optional): index of the doc's entities, if already built.
 
         Returns:
             spacy.tokens.Doc
         """
-        newdoc = copy.copy(doc)
-        co_occurrence_string = (
-            lambda firstname, lastname: f"{firstname.lower()}_{lastname.lower()}"
+        index = index or EntityTextIndex(doc)
+
+        # for each lowercased first or last name: the latest PERSON entity with that name, and
+        # the PERSON entities with that name which haven't been mentioned again yet
+        latest_person = {}
+        unmentioned_persons = defaultdict(list)
+
+        co_occurrence_strings = {}
+        mentioned_person = {}
+        mentioned_persons = set()
+
+        for idx, ent in enumerate(index.ents):
+            # entities (of any label) with text equal to the firstname or lastname of a PERSON
+            # entity before them are later mentions of the latest such person
+            text = index.texts[idx]
+            if text in latest_person:
+                mentioned_person[idx] = latest_person[text]
+                mentioned_persons.update(unmentioned_persons.pop(text, []))
+
+            names = self._person_names(ent) if index.labels[idx] == "PERSON" else None
+            if names is None:
+                continue
+
+            firstname, lastname = names
+            co_occurrence_strings[idx] = f"{firstname.lower()}_{lastname.lower()}"
+
+            for name in {firstname.lower(), lastname.lower()}:
+                latest_person[name] = idx
+                unmentioned_persons[name].append(idx)
+
+        for idx, person_idx in mentioned_person.items():
+            e = spacy.tokens.Span(
+                doc,
+                start=index.ents[idx].start,
+                end=index.ents[idx].end,
+                label="PERSON",
+            )
+            e._.entity_co_occurrence = co_occurrence_strings[person_idx]
+            e._.entity_duplicate = True
+
+        self.stats["PERSON_duplicates"] += len(mentioned_person)
+
+        # a mentioned person's own co-occurrence string takes precedence over one from an
+        # earlier person that it is a mention of
+        for idx in mentioned_persons:
+            index.ents[idx]._.entity_co_occurrence = co_occurrence_strings[idx]
+
+        return doc
+
+    def _mark_duplicate_mentions(
+        self, index: EntityTextIndex, label: str, main_mentions: Dict[int, str]
+    ):
+        """
+        Mark entities with `label` as duplicates of the main mentions of an entity in the doc.
+
+        Args:
+            index (EntityTextIndex): index of the doc's entities.
+            label (str): label of the entities.
+            main_mentions (Dict[int, str]): positions in `Doc.ents` of main mentions, in order,
+                mapped to the lowercased text of their duplicate mentions.
+        """
+        co_occurrence_string = lambda idx: "_".join(
+            [i.lower() for i in index.ents[idx].text.split(" ")]
         )
 
-        for idx, ent in enumerate(newdoc.ents):
-            found_entity_co_occurrence = False
+        # main mentions are applied in order, so each duplicate ends up with the co-occurrence
+        # string of the last main mention with its text
+        latest_main_mention = {}
+        mentioned = []
 
-            # Check for alternative entity text (i.e. firstname + lastname) which will have
-            # been inserted if EntityJoiner was applied before DuplicateEntityDetector in the
-            # pipeline.
-            if (
-                spacy.tokens.Span.has_extension("alt_ent_text")
-                and ent._.alt_ent_text is not None
-            ):
-                len_ent = len(ent._.alt_ent_text.split(" "))
-            else:
-                len_ent = len(ent)
+        for idx, duplicate_text in main_mentions.items():
+            if index.positions(duplicate_text, label):
+                latest_main_mention[duplicate_text] = idx
+                mentioned.append(idx)
 
-            if (ent.label_ == "PERSON") and (len_ent > 1):
-                # Assumes first name is only one word and all other words make up the last name.
-                if (
-                    spacy.tokens.Span.has_extension("alt_ent_text")
-                    and ent._.alt_ent_text is not None
-                ):
-                    ent_text_split = ent._.alt_ent_text.split(" ")
-                    firstname = ent_text_split[0]
-                    lastname = " ".join(ent_text_split[1:])
-                else:
-                    firstname = ent[0].text
-                    lastname = ent[1:].text
-
-                # find other entities with text equal to firstname or lastname. Only look at entities in the
-                # doc that occur after the current entity.
-                for e in newdoc.ents[idx + 1 :]:
-                    if (e != ent) and (
-                        (e.text.lower() == lastname.lower())
-                        or (e.text.lower() == firstname.lower())
-                    ):
-                        found_entity_co_occurrence = True
-
-                        e = spacy.tokens.Span(
-                            newdoc, start=e.start, end=e.end, label="PERSON"
-                        )
-                        e._.entity_co_occurrence = co_occurrence_string(
-                            firstname, lastname
-                        )
-                        e._.entity_duplicate = True
-
-                if found_entity_co_occurrence:
-                    ent._.entity_co_occurrence = co_occurrence_string(
-                        firstname, lastname
-                    )
-
-        return newdoc
-
-    def _detect_duplicate_org_mentions(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
+        duplicate_of = {}
+        for duplicate_text, main_idx in latest_main_mention.items():
+            for idx in index.positions(duplicate_text, label):
+                duplicate_of[idx] = main_idx
+
+        for idx, main_idx in duplicate_of.items():
+            e = index.ents[idx]
+            e._.entity_co_occurrence = co_occurrence_string(main_idx)
+            e._.entity_duplicate = True
+
+        self.stats[f"{label}_duplicates"] += len(duplicate_of)
+
+        for idx in mentioned:
+            # unless the entity is a duplicate of a later main mention
+            if duplicate_of.get(idx, idx) <= idx:
+                index.ents[idx]._.entity_co_occurrence = co_occurrence_string(idx)
+
+    def _detect_duplicate_org_mentions(
+        self, doc: spacy.tokens.Doc, index: Optional[EntityTextIndex] = None
+    ) -> spacy.tokens.Doc:
         """Detect duplicate organisation mentions where one ORG entity in the doc is of the form "<company name> <legal suffix>",
         and there are other ORG entities of the form "<company name>".
 
@@ -669,44 +1458,30 @@ class DuplicateEntityDetector:
 
         Args:
             doc (spacy.tokens.Doc)
+            index (EntityTextIndex, optional): index of the doc's entities, if already built.
 
         Returns:
             spacy.tokens.Doc
         """
+        index = index or EntityTextIndex(doc)
+
+        # Find other entities matching just org without suffix.
+        # Enforce that these are already predicted to be ORGs to avoid overwriting places and people
+        # which might have organisations named after them.
+        main_mentions = {
+            idx: ent[0:-1].text.lower()
+            for idx, ent in enumerate(index.ents)
+            if (index.labels[idx] == "ORG")
+            and (len(ent) > 1)
+            and (ent[-1].text.lower() in self.org_legal_suffixes)
+        }
+        self._mark_duplicate_mentions(index, "ORG", main_mentions)
 
-        newdoc = copy.copy(doc)
-        co_occurrence_string = lambda ent: "_".join(
-            [i.lower() for i in ent.text.split(" ")]
-        )
+        return doc
 
-        for idx, ent in enumerate(newdoc.ents):
-            found_co_occurrence = False
-
-            if (ent.label_ == "ORG") and (len(ent) > 1):
-                if ent[-1].text.lower() in [
-                    s.lower() for s in constants.ORG_LEGAL_SUFFIXES
-                ]:
-                    org_without_suffix = ent[0:-1]
-
-                    # Find other entities matching just org without suffix.
-                    # Enforce that these are already predicted to be ORGs to avoid overwriting places and people
-                    # which might have organisations named after them.
-                    for e in newdoc.ents:
-                        if (
-                            (e != ent)
-                            and (e.label_ == "ORG")
-                            and (e.text.lower() == org_without_suffix.text.lower())
-                        ):
-                            found_co_occurrence = True
-                            e._.entity_co_occurrence = co_occurrence_string(ent)
-                            e._.entity_duplicate = True
-
-                    if found_co_occurrence:
-                        ent._.entity_co_occurrence = co_occurrence_string(ent)
-
-        return newdoc
-
-    def _detect_duplicate_loc_mentions(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
+    def _detect_duplicate_loc_mentions(
+        self, doc: spacy.tokens.Doc, index: Optional[EntityTextIndex] = None
+    ) -> spacy.tokens.Doc:
         """Detect duplicate location (LOC) mentions where one LOC entity in the doc is of the form "<place>, <surrounding place>",
         and there are other LOC entities of the form "<place>".
 
@@ -715,47 +1490,112 @@ class DuplicateEntityDetector:
 
         Args:
             doc (spacy.tokens.Doc)
+            index (EntityTextIndex, optional): index of the doc's entities, if already built.
 
         Returns:
             spacy.tokens.Doc
         """
+        index = index or EntityTextIndex(doc)
 
-        newdoc = copy.copy(doc)
-        co_occurrence_string = lambda ent: "_".join(
-            [i.lower() for i in ent.text.split(" ")]
-        )
-
-        for idx, ent in enumerate(newdoc.ents):
-            found_co_occurrence = False
-
-            if (ent.label_ == "LOC") and (len(ent) > 1) and ("," in ent.text):
-                loc_first_part = ent.text.split(",")[0]
-
-                for e in newdoc.ents:
-                    if (
-                        (e != ent)
-                        and (e.label_ == "LOC")
-                        and (e.text.lower() == loc_first_part.lower())
-                    ):
-                        found_co_occurrence = True
-                        e._.entity_co_occurrence = co_occurrence_string(ent)
-                        e._.entity_duplicate = True
+        main_mentions = {
+            idx: index.texts[idx].split(",")[0]
+            for idx, ent in enumerate(index.ents)
+            if (index.labels[idx] == "LOC") and (len(ent) > 1) and ("," in ent.text)
+        }
+        self._mark_duplicate_mentions(index, "LOC", main_mentions)
 
-                if found_co_occurrence:
-                    ent._.entity_co_occurrence = co_occurrence_string(ent)
-
-        return newdoc
+        return doc
 
     def __call__(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
-        newdoc = copy.copy(doc)
+        # the index only depends on the entities, which aren't changed, so is built once
+        index = EntityTextIndex(doc)
 
         if "PERSON" not in self.types_ignore:
-            newdoc = self._detect_duplicate_person_mentions(newdoc)
+            doc = self._detect_duplicate_person_mentions(doc, index)
 
         if "ORG" not in self.types_ignore:
-            newdoc = self._detect_duplicate_org_mentions(newdoc)
+            doc = self._detect_duplicate_org_mentions(doc, index)
 
         if "LOC" not in self.types_ignore:
-            newdoc = self._detect_duplicate_loc_mentions(newdoc)
+            doc = self._detect_duplicate_loc_mentions(doc, index)
+
+        return doc
+
+
+@Language.factory("hc_postprocess")
+class HCPostprocess:
+    """
+    Runs `entity_filter`, `entity_joiner`, `map_entity_types` and `duplicate_entity_detector`
+    as one component, with the same output as adding them to a pipeline in that order. The
+    filter, joins and label mapping are applied in turn to one buffer of entity edits, which is
+    written to the doc once before duplicate mentions are marked.
+    """
+
+    def __init__(
+        self,
+        nlp,
+        name: str,
+        max_token_length: int = 1,
+        remove_all_lower: bool = True,
+        remove_all_upper: bool = False,
+        ent_labels_ignore: Sequence[str] = [],
+        mapping: dict = constants.SPACY_TO_HC_ENTITY_MAPPING,
+        types_ignore: Sequence[str] = [],
+    ):
+        """
+        Initialise the HCPostprocess component. Arguments are passed on to `EntityFilter`
+        (`max_token_length`, `remove_all_lower`, `remove_all_upper`, `ent_labels_ignore`),
+        `MapEntityTypes` (`mapping`) and `DuplicateEntityDetector` (`types_ignore`).
+        """
+        self.entity_filter = EntityFilter(
+            nlp,
+            "entity_filter",
+            max_token_length=max_token_length,
+            remove_all_lower=remove_all_lower,
+            remove_all_upper=remove_all_upper,
+            ent_labels_ignore=ent_labels_ignore,
+        )
+        self.entity_joiner = EntityJoiner(nlp, "entity_joiner")
+        self.map_entity_types = MapEntityTypes(nlp, "map_entity_types", mapping=mapping)
+        self.duplicate_entity_detector = DuplicateEntityDetector(
+            nlp, "duplicate_entity_detector", types_ignore=types_ignore
+        )
+
+    def __call__(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
+        edits = EntityEdits(doc)
+        self.entity_filter.filter_edits(doc, edits)
+        self.entity_joiner.join_edits(doc, edits)
+        self.map_entity_types.map_edits(edits)
+        doc = edits.commit()
+
+        return self.duplicate_entity_detector(doc)
+
+    def _named_components(self) -> Dict[str, Any]:
+        return {
+            "entity_filter": self.entity_filter,
+            "entity_joiner": self.entity_joiner,
+            "map_entity_types": self.map_entity_types,
+            "duplicate_entity_detector": self.duplicate_entity_detector,
+        }
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        """The `stats` of each of the components, prefixed with their names."""
+        return {
+            f"{name}.{key}": value
+            for name, component in self._named_components().items()
+            for key, value in component.stats.items()
+        }
+
+    def merge_stats(self, stats: Dict[str, float]):
+        """
+        Add counts from the `stats` of another `HCPostprocess`, e.g. one this has replaced, to
+        the `stats` of each of the components.
+        """
+        components = self._named_components()
 
-        return newdoc
+        for key, value in stats.items():
+            name, _, counter = key.partition(".")
+            if name in components:
+                component_stats = components[name].stats
+                component_stats[counter] = component_stats.get(counter, 0) + value
@@ -0,0 +1,267 @@
+"""
+An on-disk cache of pipeline results, so that re-running a pipeline over a corpus only processes
+texts which are new or have changed. Results are keyed by a hash of the text and a fingerprint of
+the pipeline, and stored in SQLite.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import spacy
+from typing import Dict, Iterable, List
+from hc_nlp import logging
+
+logger = logging.get_logger(__name__)
+
+# config keys of hc_nlp components which point to files whose contents affect their output
+FILE_CONFIG_KEYS = ("thesaurus_path", "delta_paths")
+
+# key in `nlp.meta` of the fingerprint of the thesaurus and delta files a snapshot was saved with
+FINGERPRINT_META_KEY = "hc_nlp_fingerprint"
+
+# SQLite limits the number of variables in a query
+_QUERY_CHUNK_SIZE = 500
+
+
+def text_hash(text: str) -> str:
+    """
+    Returns the hash of a text for the cache. The text isn't normalised in any way, as entity
+    offsets depend on the exact text.
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _config_file_paths(config) -> Iterable[str]:
+    """Paths of files in `FILE_CONFIG_KEYS` anywhere in a (nested) component config."""
+    if isinstance(config, dict):
+        for key, value in config.items():
+            if key in FILE_CONFIG_KEYS and value:
+                yield from [value] if isinstance(value, str) else value
+            else:
+                yield from _config_file_paths(value)
+
+
+def hc_nlp_version() -> str:
+    """The installed version of hc_nlp, or "" if it isn't installed (e.g. run from a checkout)."""
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        # Python < 3.8
+        return ""
+
+    try:
+        return version("hc-nlp")
+    except PackageNotFoundError:
+        return ""
+
+
+def config_files_fingerprint(nlp: spacy.language.Language) -> str:
+    """
+    Content hash of the thesaurus and delta files of the hc_nlp components of a pipeline. For
+    snapshots (see `snapshot.save_snapshot`) this is the hash taken when the snapshot was saved,
+    as their thesauri are saved with them and the files may not be available where they're loaded.
+    """
+    if FINGERPRINT_META_KEY in nlp.meta:
+        return nlp.meta[FINGERPRINT_META_KEY]
+
+    h = hashlib.sha256()
+
+    for path in _config_file_paths(nlp.config.get("components", {})):
+        h.update(path.encode())
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+
+    return h.hexdigest()
+
+
+def pipeline_fingerprint(nlp: spacy.language.Language, extra: str = "") -> str:
+    """
+    Content hash identifying the output of a pipeline. Covers the spaCy and hc_nlp versions, the
+    name and version of the model, the config of every component, and the contents of the
+    thesaurus and delta files of hc_nlp components (see `config_files_fingerprint`).
+
+    Changes to code within a version (or to an hc_nlp checkout that isn't installed) aren't
+    covered, so pass something which identifies the code (e.g. a commit hash) in `extra` if it
+    changes between runs.
+
+    Args:
+        nlp (spacy.language.Language)
+        extra (str, optional): anything else which affects the output. Defaults to "".
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha256()
+    h.update(
+        f"{spacy.__version__}|{hc_nlp_version()}|{nlp.meta.get('name')}|{nlp.meta.get('version')}|{extra}".encode()
+    )
+    h.update(nlp.config.to_str().encode())
+    h.update(config_files_fingerprint(nlp).encode())
+
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    SQLite-backed cache from (text hash, pipeline fingerprint) to the entities found in the text
+    (the "ents" of a record from `corpus.doc_to_record`).
+
+    When the results stored take up more than `max_bytes`, the least recently used ones are
+    evicted until they take up 90% of it.
+    """
+
+    def __init__(self, path: str, fingerprint: str, max_bytes: int = 1 << 30):
+        """
+        Open (or create) a cache.
+
+        Args:
+            path (str): path to the SQLite database.
+            fingerprint (str): pipeline fingerprint, e.g. from `pipeline_fingerprint`.
+            max_bytes (int, optional): maximum size of the stored results. Defaults to 1GB.
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results (text_hash TEXT, fingerprint TEXT, ents TEXT, "
+            "size INTEGER, last_used INTEGER, PRIMARY KEY (text_hash, fingerprint))"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+        )
+        self._conn.commit()
+
+        self._n_bytes, self._clock = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0), COALESCE(MAX(last_used), 0) FROM results"
+        ).fetchone()
+
+    def __len__(self) -> int:
+        return self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    @property
+    def n_bytes(self) -> int:
+        """Total size of the stored results."""
+        return self._n_bytes
+
+    def _tick(self) -> int:
+        self._clock += 1
+
+        return self._clock
+
+    def get_many(self, text_hashes: Iterable[str]) -> Dict[str, List[list]]:
+        """
+        Returns the cached entities for each of `text_hashes` found in the cache, and marks them
+        as recently used.
+        """
+        text_hashes = list(dict.fromkeys(text_hashes))
+        found = {}
+
+        for start in range(0, len(text_hashes), _QUERY_CHUNK_SIZE):
+            chunk = text_hashes[start : start + _QUERY_CHUNK_SIZE]
+            rows = self._conn.execute(
+                f"SELECT text_hash, ents FROM results WHERE fingerprint = ? "
+                f"AND text_hash IN ({','.join('?' * len(chunk))})",
+                [self.fingerprint] + chunk,
+            ).fetchall()
+            found.update({text_hash: json.loads(ents) for text_hash, ents in rows})
+
+        if found:
+            clock = self._tick()
+            self._conn.executemany(
+                "UPDATE results SET last_used = ? WHERE text_hash = ? AND fingerprint = ?",
+                [(clock, text_hash, self.fingerprint) for text_hash in found],
+            )
+            self._conn.commit()
+
+        self.hits += len(found)
+        self.misses += len(text_hashes) - len(found)
+
+        return found
+
+    def put_many(self, results: Dict[str, List[list]]):
+        """
+        Store the entities for each text hash in `results`, evicting old results if the cache
+        is full.
+        """
+        if not results:
+            return
+
+        clock = self._tick()
+        rows = []
+        for text_hash, ents in results.items():
+            ents_json = json.dumps(ents, ensure_ascii=False)
+            rows.append((text_hash, self.fingerprint, ents_json, len(ents_json), clock))
+
+        self._n_bytes -= self._sizes([row[0] for row in rows])
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)", rows
+        )
+        self._n_bytes += sum(row[3] for row in rows)
+        self._conn.commit()
+
+        if self._n_bytes > self.max_bytes:
+            self.evict(int(self.max_bytes * 0.9))
+
+    def _sizes(self, text_hashes: List[str]) -> int:
+        """Total size of the stored results for `text_hashes`."""
+        total = 0
+
+        for start in range(0, len(text_hashes), _QUERY_CHUNK_SIZE):
+            chunk = text_hashes[start : start + _QUERY_CHUNK_SIZE]
+            total += self._conn.execute(
+                f"SELECT COALESCE(SUM(size), 0) FROM results WHERE fingerprint = ? "
+                f"AND text_hash IN ({','.join('?' * len(chunk))})",
+                [self.fingerprint] + chunk,
+            ).fetchone()[0]
+
+        return total
+
+    def evict(self, target_bytes: int):
+        """
+        Delete the least recently used results (for any fingerprint) until the stored results
+        take up at most `target_bytes`.
+        """
+        n_evicted = 0
+
+        while self._n_bytes > target_bytes:
+            rows = self._conn.execute(
+                "SELECT rowid, size FROM results ORDER BY last_used LIMIT ?",
+                (_QUERY_CHUNK_SIZE,),
+            ).fetchall()
+            if not rows:
+                break
+
+            rowids = []
+            for rowid, size in rows:
+                if self._n_bytes <= target_bytes:
+                    break
+
+                rowids.append(rowid)
+                self._n_bytes -= size
+
+            self._conn.execute(
+                f"DELETE FROM results WHERE rowid IN ({','.join('?' * len(rowids))})",
+                rowids,
+            )
+            n_evicted += len(rowids)
+
+        self._conn.commit()
+        logger.info(f"Evicted {n_evicted} results from cache {self.path}")
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self) -> "ResultCache":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
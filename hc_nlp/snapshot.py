@@ -0,0 +1,159 @@
+"""
+Pipeline snapshots: a fully configured hc_nlp pipeline saved to one directory with `nlp.to_disk`,
+including the compiled state of its thesaurus matchers, so that worker processes and containers can
+load it without reading or compiling any thesaurus.
+
+Run `python -m hc_nlp.snapshot pipes.json output_dir --model en_core_web_lg` to build a pipeline,
+save it as a snapshot and print how long building it and loading the snapshot take. `pipes.json`
+is a list of pipes to add to the model, each a dict with "factory" and optionally "name" and
+"config".
+"""
+
+import argparse
+import json
+import os
+import time
+import spacy
+import srsly
+from typing import Callable, Iterable, Optional, Sequence
+from hc_nlp import logging
+from hc_nlp.pipeline import defer_thesaurus_loading
+from hc_nlp.result_cache import FINGERPRINT_META_KEY, config_files_fingerprint
+
+logger = logging.get_logger(__name__)
+
+
+def build_pipeline(model: str, pipes: Sequence[dict]) -> spacy.language.Language:
+    """
+    Load a spaCy model and add pipes to it.
+
+    Args:
+        model (str): name or path of the spaCy model
+        pipes (Sequence[dict]): pipes to add in order, each with "factory" and optionally "name"
+            and "config".
+
+    Returns:
+        spacy.language.Language
+    """
+    nlp = spacy.load(model)
+
+    for pipe in pipes:
+        nlp.add_pipe(
+            pipe["factory"], name=pipe.get("name"), config=pipe.get("config", {})
+        )
+
+    return nlp
+
+
+def save_snapshot(nlp: spacy.language.Language, path: str):
+    """
+    Save a pipeline as a snapshot. The fingerprint of its thesaurus and delta files is kept in
+    the snapshot's meta, so that results cached for the pipeline are still found when it's
+    loaded from the snapshot (see `result_cache.pipeline_fingerprint`). `nlp.meta` itself is
+    left unchanged.
+    """
+    fingerprint = config_files_fingerprint(nlp)
+    nlp.to_disk(path)
+
+    meta_path = os.path.join(path, "meta.json")
+    meta = srsly.read_json(meta_path)
+    meta[FINGERPRINT_META_KEY] = fingerprint
+    srsly.write_json(meta_path, meta)
+    logger.info(f"Saved pipeline snapshot to {path}")
+
+
+def is_snapshot(path: str) -> bool:
+    """Whether `path` is a directory written by `save_snapshot`."""
+    meta_path = os.path.join(path, "meta.json")
+
+    return os.path.exists(meta_path) and FINGERPRINT_META_KEY in srsly.read_json(
+        meta_path
+    )
+
+
+def load_snapshot(path: str, **kwargs) -> spacy.language.Language:
+    """
+    Load a snapshot written by `save_snapshot`. Thesaurus matchers are restored from their
+    compiled state in the snapshot, so their thesaurus and delta files are never read.
+
+    Args:
+        path (str): snapshot directory
+        **kwargs: passed to `spacy.load`
+
+    Returns:
+        spacy.language.Language
+    """
+    with defer_thesaurus_loading():
+        return spacy.load(path, **kwargs)
+
+
+def load_pipeline(name_or_path: str, **kwargs) -> spacy.language.Language:
+    """
+    Load a snapshot with `load_snapshot` if `name_or_path` is one, and otherwise with
+    `spacy.load`.
+    """
+    if is_snapshot(name_or_path):
+        return load_snapshot(name_or_path, **kwargs)
+
+    return spacy.load(name_or_path, **kwargs)
+
+
+def measure_snapshot_startup(
+    build: Callable[[], spacy.language.Language], path: str
+) -> dict:
+    """
+    Build a pipeline, save it as a snapshot and load it again, timing building and loading.
+
+    Args:
+        build (Callable[[], spacy.language.Language]): builds the pipeline
+        path (str): directory to save the snapshot to
+
+    Returns:
+        dict: with keys "build_seconds", "save_seconds", "load_seconds" and "speedup" (build time
+            over load time).
+    """
+    start = time.perf_counter()
+    nlp = build()
+    build_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    save_snapshot(nlp, path)
+    save_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load_snapshot(path)
+    load_seconds = time.perf_counter() - start
+
+    return {
+        "build_seconds": build_seconds,
+        "save_seconds": save_seconds,
+        "load_seconds": load_seconds,
+        "speedup": build_seconds / load_seconds,
+    }
+
+
+def main(argv: Optional[Iterable[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Build an hc_nlp pipeline and save it as a snapshot which loads without compiling any thesaurus."
+    )
+    parser.add_argument(
+        "pipes_path",
+        help='JSON list of pipes to add, e.g. [{"factory": "thesaurus_matcher", "config": {...}}]',
+    )
+    parser.add_argument("output_path", help="directory to save the snapshot to")
+    parser.add_argument(
+        "--model",
+        default="en_core_web_sm",
+        help="name or path of the spaCy pipeline to add pipes to (default: en_core_web_sm)",
+    )
+    args = parser.parse_args(argv)
+
+    pipes = srsly.read_json(args.pipes_path)
+    timings = measure_snapshot_startup(
+        lambda: build_pipeline(args.model, pipes), args.output_path
+    )
+    print(json.dumps(timings, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1344 @@
+"""
+Compiling, caching and matching term thesauri for the `thesaurus_matcher` component.
+
+A thesaurus is a JSONL file with one `{"label": ..., "pattern": ..., "id": ...}` phrase
+pattern per line. Compiling it means tokenizing every pattern and keeping the sequence
+of token attribute hashes (e.g. `LOWER`) that the `PhraseMatcher` matches on. The
+compiled state can be written to a binary artifact so that later loads skip
+tokenization entirely.
+"""
+
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from typing import Dict, List, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+import spacy
+import srsly
+from spacy.matcher import PhraseMatcher
+from spacy.strings import hash_string
+from spacy.tokens import Span
+
+from hc_nlp import logging
+
+logger = logging.get_logger(__name__)
+
+# bump whenever the layout of the compiled artifact changes so old caches are ignored
+COMPILED_FORMAT_VERSION = 4
+COMPILED_SUFFIX = ".thesaurus"
+ID_STORE_SUFFIX = ".ids"
+REMOVED_ROWS_SUFFIX = ".removed"
+# files written by `ThesaurusMatcher.to_disk`
+MATCHER_STATE_FILE = "state.msgpack"
+MATCHER_STEP_PREFIX = "step"
+BACKENDS = ("phrase_matcher", "trie")
+
+
+def read_thesaurus(thesaurus_path: str) -> List[dict]:
+    """
+    Read phrase patterns from a thesaurus JSONL file. Token patterns (lists) are skipped
+    as the thesaurus matcher only handles exact phrases.
+
+    Args:
+        thesaurus_path (str): path to a JSONL file of {"label", "pattern", "id"} records
+
+    Returns:
+        List[dict]: thesaurus entries
+    """
+    entries = []
+    n_skipped = 0
+
+    for entry in srsly.read_jsonl(thesaurus_path):
+        if isinstance(entry.get("pattern"), str):
+            entries.append(entry)
+        else:
+            n_skipped += 1
+
+    if n_skipped:
+        logger.warning(
+            f"Skipped {n_skipped} non-phrase patterns in thesaurus {thesaurus_path}"
+        )
+
+    return entries
+
+
+DELTA_OPS = ("add", "remove", "change")
+
+
+def read_delta(delta_path: str) -> Tuple[Set[str], List[dict]]:
+    """
+    Read a thesaurus delta file: JSONL with one `{"op": ..., "label": ..., "pattern":
+    ..., "id": ...}` record per line, keyed by `id`. `op` is one of:
+    - "add": add the entry;
+    - "remove": remove all entries with the id (label and pattern are not needed);
+    - "change": replace all entries with the id by the entries given for it in the
+    delta (several "change" records with the same id are all added).
+
+    Args:
+        delta_path (str): path to the delta JSONL file
+
+    Returns:
+        Tuple[Set[str], List[dict]]: ids whose existing entries should be removed, and
+            thesaurus entries to add
+    """
+    removed_ids = set()
+    added_entries = []
+
+    for record in srsly.read_jsonl(delta_path):
+        op = record.get("op")
+
+        if op not in DELTA_OPS:
+            raise ValueError(
+                f"Unknown op {op} in thesaurus delta {delta_path}. Options are {DELTA_OPS}"
+            )
+
+        if "id" not in record:
+            raise ValueError(
+                f"Record {record} in thesaurus delta {delta_path} has no id"
+            )
+
+        if op in ("remove", "change"):
+            removed_ids.add(record["id"])
+
+        if op in ("add", "change"):
+            added_entries.append(
+                {k: record[k] for k in ("label", "pattern", "id") if k in record}
+            )
+
+    return removed_ids, added_entries
+
+
+def _update_hash_from_file(h, path: str):
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+
+
+def thesaurus_fingerprint(
+    nlp, thesaurus_path: str, attr: str, backend: str = "phrase_matcher"
+) -> str:
+    """
+    Content hash identifying a compiled thesaurus. Covers the thesaurus file itself,
+    the tokenizer settings of `nlp`, the matcher attribute (which encodes whether
+    matching is case-sensitive), the matcher backend and the spaCy version.
+
+    Args:
+        nlp: spaCy model whose tokenizer is used to compile the thesaurus
+        thesaurus_path (str): path to the thesaurus JSONL file
+        attr (str): token attribute matched on, e.g. "LOWER" or "ORTH"
+        backend (str, optional): see `load_compiled_thesaurus`
+
+    Returns:
+        str: hex digest
+    """
+    h = hashlib.sha256()
+    h.update(
+        f"{COMPILED_FORMAT_VERSION}|{spacy.__version__}|{nlp.lang}|{attr}|{backend}".encode()
+    )
+    h.update(nlp.tokenizer.to_bytes(exclude=["vocab"]))
+    _update_hash_from_file(h, thesaurus_path)
+
+    return h.hexdigest()
+
+
+def delta_fingerprint(base_fingerprint: str, delta_path: str) -> str:
+    """
+    Content hash identifying the compiled form of a delta applied on top of the
+    compiled thesaurus (with any earlier deltas) identified by `base_fingerprint`.
+    """
+    h = hashlib.sha256(base_fingerprint.encode())
+    _update_hash_from_file(h, delta_path)
+
+    return h.hexdigest()
+
+
+def _write_atomically(path: str, data: bytes):
+    """
+    Write a compiled artifact so that concurrent workers never read a partial file. The
+    temporary file has a unique name, so processes and threads writing the same artifact
+    at once each publish a complete copy.
+    """
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(path) or ".",
+        prefix=os.path.basename(path) + ".",
+        suffix=".tmp",
+        delete=False,
+    ) as f:
+        f.write(data)
+
+    try:
+        # NamedTemporaryFile is only readable by its owner, unlike other written files
+        os.chmod(f.name, 0o644)
+        os.replace(f.name, path)
+    except BaseException:
+        os.remove(f.name)
+        raise
+
+
+def _padded(n_bytes: int) -> int:
+    """Round up to a multiple of 8 bytes so that following arrays stay aligned."""
+    return (n_bytes + 7) // 8 * 8
+
+
+class IdStore:
+    """
+    Label and id of every thesaurus entry, packed into one flat buffer with fixed
+    offsets instead of one Python string per entry. When opened from a file the buffer
+    is memory-mapped, so worker processes share its pages, and an id is only decoded
+    into a string when it is looked up.
+
+    Rows are also indexed by id: `id_hashes` holds the 64-bit string hash of every id
+    in sorted order, and `id_order` the row each one belongs to, so that `find_rows`
+    is a binary search rather than a scan of the store.
+
+    Layout (integers little-endian):
+        magic (8 bytes) | n_entries (u64) | n_labels (u64)
+        | label_offsets (u64 * (n_labels + 1)) | label_idx (u32 * n_entries, padded to 8)
+        | id_offsets (u64 * (n_entries + 1)) | id_hashes (u64 * n_entries)
+        | id_order (u32 * n_entries, padded to 8) | label bytes | id bytes
+    """
+
+    MAGIC = b"HCIDS002"
+
+    def __init__(self, buffer, path: Optional[str] = None):
+        self.path = path
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+
+        if bytes(self._view[:8]) != self.MAGIC:
+            raise ValueError("Buffer is not a thesaurus id store")
+
+        n_entries, n_labels = (int(i) for i in np.frombuffer(buffer, "<u8", 2, 8))
+        pos = 24
+        label_offsets = np.frombuffer(buffer, "<u8", n_labels + 1, pos)
+        pos += 8 * (n_labels + 1)
+        self.label_idx = np.frombuffer(buffer, "<u4", n_entries, pos)
+        pos += _padded(4 * n_entries)
+        self._id_offsets = np.frombuffer(buffer, "<u8", n_entries + 1, pos)
+        pos += 8 * (n_entries + 1)
+        self._id_hashes = np.frombuffer(buffer, "<u8", n_entries, pos)
+        pos += 8 * n_entries
+        self._id_order = np.frombuffer(buffer, "<u4", n_entries, pos)
+        pos += _padded(4 * n_entries)
+
+        labels_blob = bytes(self._view[pos : pos + int(label_offsets[-1])])
+        self.labels = [
+            labels_blob[int(a) : int(b)].decode("utf-8")
+            for a, b in zip(label_offsets[:-1], label_offsets[1:])
+        ]
+        self._ids_start = pos + int(label_offsets[-1])
+
+    def __len__(self) -> int:
+        return len(self.label_idx)
+
+    def label(self, row: int) -> str:
+        return self.labels[self.label_idx[row]]
+
+    def ent_id(self, row: int) -> str:
+        start = self._ids_start + int(self._id_offsets[row])
+        end = self._ids_start + int(self._id_offsets[row + 1])
+
+        return str(self._view[start:end], "utf-8")
+
+    def find_rows(self, ids: Set[str]) -> List[int]:
+        """
+        Rows of all entries whose id is in `ids`, in ascending order. Looks the ids up
+        in the hash index, so only the rows found (and any hash collisions) are decoded.
+        """
+        if not ids or not len(self):
+            return []
+
+        hashes = np.asarray(sorted({hash_string(ent_id) for ent_id in ids}), dtype="<u8")
+        starts = np.searchsorted(self._id_hashes, hashes, side="left")
+        ends = np.searchsorted(self._id_hashes, hashes, side="right")
+
+        return sorted(
+            row
+            for start, end in zip(starts.tolist(), ends.tolist())
+            for row in self._id_order[start:end].tolist()
+            if self.ent_id(row) in ids
+        )
+
+    @staticmethod
+    def pack(
+        labels: Sequence[str], label_idx: Sequence[int], ids: Sequence[str]
+    ) -> bytes:
+        """
+        Pack labels, the label index of each entry and the id of each entry into the
+        id store layout.
+        """
+        encoded_labels = [label.encode("utf-8") for label in labels]
+        encoded_ids = [ent_id.encode("utf-8") for ent_id in ids]
+        label_idx = np.asarray(label_idx, dtype="<u4")
+        label_idx_bytes = label_idx.tobytes()
+        id_hashes = np.asarray([hash_string(ent_id) for ent_id in ids], dtype="<u8")
+        id_order = np.argsort(id_hashes, kind="stable").astype("<u4")
+        id_order_bytes = id_order.tobytes()
+
+        return b"".join(
+            [
+                IdStore.MAGIC,
+                np.asarray([len(ids), len(labels)], dtype="<u8").tobytes(),
+                np.cumsum(
+                    [0] + [len(b) for b in encoded_labels], dtype="<u8"
+                ).tobytes(),
+                label_idx_bytes.ljust(_padded(len(label_idx_bytes)), b"\0"),
+                np.cumsum([0] + [len(b) for b in encoded_ids], dtype="<u8").tobytes(),
+                id_hashes[id_order].tobytes(),
+                id_order_bytes.ljust(_padded(len(id_order_bytes)), b"\0"),
+                b"".join(encoded_labels),
+                b"".join(encoded_ids),
+            ]
+        )
+
+    @classmethod
+    def from_entries(cls, entries: Sequence[dict]) -> "IdStore":
+        """In-memory id store for thesaurus entries, see `read_thesaurus`."""
+        labels = sorted({entry["label"] for entry in entries})
+        label_lookup = {label: idx for idx, label in enumerate(labels)}
+
+        return cls.from_bytes(
+            cls.pack(
+                labels,
+                [label_lookup[entry["label"]] for entry in entries],
+                [entry.get("id", "") for entry in entries],
+            )
+        )
+
+    def to_bytes(self) -> bytes:
+        return bytes(self._view)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "IdStore":
+        return cls(data)
+
+    def to_disk(self, path: str):
+        _write_atomically(path, self.to_bytes())
+
+    @classmethod
+    def open(cls, path: str) -> "IdStore":
+        """Memory-map an id store file, read-only."""
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return cls(buffer, path=path)
+
+    def __reduce__(self):
+        # processes that unpickle a memory-mapped store map the same file again
+        # rather than receiving a copy of it
+        if self.path is not None:
+            return (IdStore.open, (self.path,))
+
+        return (IdStore.from_bytes, (self.to_bytes(),))
+
+
+class _CompiledArtifact(ABC):
+    """
+    Serialisation shared by the compiled forms of a thesaurus. Subclasses hold an
+    `IdStore` as `ids` and implement `_to_msg` and `_from_msg` for everything else.
+    """
+
+    ids: IdStore
+    # set by `load_compiled_thesaurus` when the artifact is cached
+    fingerprint: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @abstractmethod
+    def _to_msg(self) -> dict:
+        """Everything except `ids`, as a msgpack-serialisable dict."""
+
+    @classmethod
+    @abstractmethod
+    def _from_msg(cls, msg: dict, ids: IdStore):
+        """Inverse of `_to_msg`."""
+
+    def to_bytes(self) -> bytes:
+        return srsly.msgpack_dumps(dict(self._to_msg(), ids=self.ids.to_bytes()))
+
+    @classmethod
+    def from_bytes(cls, data: bytes):
+        msg = srsly.msgpack_loads(data)
+
+        return cls._from_msg(msg, IdStore.from_bytes(msg["ids"]))
+
+    def to_disk(self, path: str):
+        """
+        Write the compiled thesaurus to `path`, and its id store alongside it so that
+        it can be memory-mapped by `from_disk`.
+        """
+        self.ids.to_disk(path + ID_STORE_SUFFIX)
+        _write_atomically(path, srsly.msgpack_dumps(self._to_msg()))
+
+    @classmethod
+    def from_disk(cls, path: str):
+        with open(path, "rb") as f:
+            msg = srsly.msgpack_loads(f.read())
+
+        return cls._from_msg(msg, IdStore.open(path + ID_STORE_SUFFIX))
+
+
+def _check_format(msg: dict):
+    if msg.get("format") != COMPILED_FORMAT_VERSION:
+        raise ValueError(
+            f"Compiled thesaurus has format {msg.get('format')}, expected {COMPILED_FORMAT_VERSION}"
+        )
+
+
+class CompiledThesaurus(_CompiledArtifact):
+    """
+    Tokenized form of a thesaurus: for each entry the sequence of token attribute
+    hashes that make up its pattern, plus an `IdStore` with its label and id.
+    Keywords are stored concatenated in a single array with one length per entry.
+    """
+
+    def __init__(
+        self, attr: str, lengths: np.ndarray, keywords: np.ndarray, ids: IdStore
+    ):
+        self.attr = attr
+        self.lengths = lengths
+        self.keywords = keywords
+        self.ids = ids
+
+    def iter_entries(self):
+        """
+        Yields (row, label, keyword) for each entry, where keyword is a tuple of
+        attribute hashes.
+        """
+        offsets = np.concatenate([[0], np.cumsum(self.lengths, dtype="uint64")])
+        keywords = self.keywords.tolist()
+
+        for row in range(len(self)):
+            yield (
+                row,
+                self.ids.label(row),
+                tuple(keywords[int(offsets[row]) : int(offsets[row + 1])]),
+            )
+
+    def _to_msg(self) -> dict:
+        return {
+            "format": COMPILED_FORMAT_VERSION,
+            "attr": self.attr,
+            "lengths": self.lengths,
+            "keywords": self.keywords,
+        }
+
+    @classmethod
+    def _from_msg(cls, msg: dict, ids: IdStore) -> "CompiledThesaurus":
+        _check_format(msg)
+
+        return cls(msg["attr"], msg["lengths"], msg["keywords"], ids)
+
+
+# token attributes that only depend on the lexeme, so can be computed by the tokenizer
+# alone. Anything else needs (some of) the pipeline to have been run on the patterns.
+LEXICAL_ATTRS = {
+    "ORTH",
+    "TEXT",
+    "LOWER",
+    "NORM",
+    "SHAPE",
+    "PREFIX",
+    "SUFFIX",
+    "LENGTH",
+}
+
+# annotations that a pipe must assign (see `Language.get_pipe_meta`) to produce
+# each non-lexical attribute. POS and MORPH can also be mapped from tags by an
+# attribute_ruler.
+ATTR_ASSIGNED_BY = {
+    "TAG": ("token.tag",),
+    "POS": ("token.pos", "token.tag"),
+    "MORPH": ("token.morph", "token.tag"),
+    "LEMMA": ("token.lemma",),
+    "DEP": ("token.dep",),
+}
+
+
+def pipes_required_for_attr(nlp, attr: str) -> List[str]:
+    """
+    Work out which pipes of `nlp` have to run over patterns so that their tokens have
+    `attr` set. Lexical attributes only need the tokenizer, so return no pipes. For
+    other attributes, return the pipeline up to the last pipe that assigns the
+    attribute, skipping any pipes which set entities.
+
+    Args:
+        nlp: spaCy model
+        attr (str): token attribute, e.g. "LOWER" or "LEMMA"
+
+    Returns:
+        List[str]: names of the pipes to enable
+    """
+    attr = attr.upper()
+
+    if attr in LEXICAL_ATTRS or attr.startswith("IS_") or attr.startswith("LIKE_"):
+        return []
+
+    if attr not in ATTR_ASSIGNED_BY:
+        raise ValueError(f"Can't work out how to compile patterns for attribute {attr}")
+
+    last_idx = -1
+    for idx, name in enumerate(nlp.pipe_names):
+        assigns = nlp.get_pipe_meta(name).assigns
+        if any(a in assigns for a in ATTR_ASSIGNED_BY[attr]) or (
+            attr in ("POS", "MORPH") and name == "attribute_ruler"
+        ):
+            last_idx = idx
+
+    if last_idx == -1:
+        raise ValueError(
+            f"No component in the spaCy model assigns {attr}, which is needed to compile the thesaurus"
+        )
+
+    return [
+        name
+        for name in nlp.pipe_names[: last_idx + 1]
+        if "doc.ents" not in nlp.get_pipe_meta(name).assigns
+    ]
+
+
+def _pattern_docs(
+    nlp, texts: Sequence[str], attr: str, batch_size: int, n_process: int
+):
+    """
+    Yield a Doc for each pattern text, running only what is needed to set `attr`.
+    """
+    pipes = pipes_required_for_attr(nlp, attr)
+    logger.debug(
+        f"Compiling {len(texts)} patterns on attribute {attr} using {['tokenizer'] + pipes}"
+    )
+
+    if not pipes and n_process == 1:
+        yield from nlp.tokenizer.pipe(texts, batch_size=batch_size)
+        return
+
+    with nlp.select_pipes(enable=pipes):
+        yield from nlp.pipe(texts, batch_size=batch_size, n_process=n_process)
+
+
+def compile_thesaurus(
+    nlp,
+    entries: Sequence[dict],
+    attr: str,
+    batch_size: int = 1000,
+    n_process: int = 1,
+) -> CompiledThesaurus:
+    """
+    Tokenize the patterns of thesaurus entries in batches and record the token attribute
+    hashes the PhraseMatcher will match on. Only the pipes needed to set `attr` are run
+    (none for lexical attributes such as LOWER), see `pipes_required_for_attr`.
+
+    Args:
+        nlp: spaCy model
+        entries (Sequence[dict]): thesaurus entries, see `read_thesaurus`
+        attr (str): token attribute to match on, e.g. "LOWER"
+        batch_size (int, optional): number of patterns per batch. Defaults to 1000.
+        n_process (int, optional): number of processes to compile patterns with.
+            Defaults to 1.
+
+    Returns:
+        CompiledThesaurus
+    """
+    keywords = []
+    lengths = []
+
+    for doc in _pattern_docs(
+        nlp, [entry["pattern"] for entry in entries], attr, batch_size, n_process
+    ):
+        keywords.append(doc.to_array(attr).astype("uint64"))
+        lengths.append(len(doc))
+
+    return CompiledThesaurus(
+        attr,
+        np.asarray(lengths, dtype="uint32"),
+        np.concatenate(keywords) if keywords else np.zeros(0, dtype="uint64"),
+        IdStore.from_entries(entries),
+    )
+
+
+_WHITESPACE_RUN = re.compile(r"\s+")
+_NEEDS_COLLAPSE = re.compile(r"\s{2,}|[^\S ]")
+
+
+def normalise_text(text: str, case_sensitive: bool) -> Tuple[str, Optional[List[int]]]:
+    """
+    Normalise text for the trie backend: lowercase it unless `case_sensitive`, and
+    collapse each run of whitespace to a single space.
+
+    Args:
+        text (str)
+        case_sensitive (bool)
+
+    Returns:
+        Tuple[str, Optional[List[int]]]: normalised text, and the offset in `text` of
+            each character of the normalised text. The offsets are None if whitespace
+            didn't need collapsing, in which case they are the identity.
+    """
+    if not case_sensitive:
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # some characters lowercase to more than one character: keep them as they
+            # are so that offsets still line up
+            lowered = "".join(c.lower() if len(c.lower()) == 1 else c for c in text)
+        text = lowered
+
+    if not _NEEDS_COLLAPSE.search(text):
+        return text, None
+
+    pieces = []
+    offsets = []
+    pos = 0
+
+    for match in _WHITESPACE_RUN.finditer(text):
+        pieces.append(text[pos : match.start()])
+        offsets.extend(range(pos, match.start()))
+        pieces.append(" ")
+        offsets.append(match.start())
+        pos = match.end()
+
+    pieces.append(text[pos:])
+    offsets.extend(range(pos, len(text)))
+
+    return "".join(pieces), offsets
+
+
+class TrieAutomaton(_CompiledArtifact):
+    """
+    Aho-Corasick automaton over the normalised characters of thesaurus patterns, stored
+    in flat arrays rather than as one Python object per pattern. The goto function is
+    kept in compressed sparse row form: the transitions out of state `s` are
+    `edge_chars[edge_offsets[s]:edge_offsets[s + 1]]` (sorted) with targets at the
+    same positions in `edge_targets`.
+
+    For each state, `out` is the row of the first thesaurus entry ending there (-1 if
+    none), `fail` is the failure link, `dict_link` is the nearest state along the failure
+    links with an output, and `depth` is the number of characters from the root. For each
+    row, `out_next` is the row of the next entry with the same pattern and a different
+    label (-1 if none), so that as with the `PhraseMatcher` backend there is one match for
+    each label a pattern has.
+    """
+
+    ARRAYS = (
+        "edge_offsets",
+        "edge_chars",
+        "edge_targets",
+        "fail",
+        "dict_link",
+        "out",
+        "out_next",
+        "depth",
+    )
+
+    def __init__(
+        self, case_sensitive: bool, arrays: Dict[str, np.ndarray], ids: IdStore
+    ):
+        self.case_sensitive = case_sensitive
+        self.arrays = arrays
+        self.ids = ids
+
+        # memoryviews index to Python ints much faster than numpy arrays do
+        for name in self.ARRAYS:
+            setattr(self, name, memoryview(arrays[name]))
+
+    def _goto(self, state: int, char: int) -> int:
+        lo = self.edge_offsets[state]
+        hi = self.edge_offsets[state + 1]
+        idx = bisect_left(self.edge_chars, char, lo, hi)
+
+        if idx < hi and self.edge_chars[idx] == char:
+            return self.edge_targets[idx]
+
+        return -1
+
+    def find(self, text: str):
+        """
+        Find all occurrences of thesaurus patterns in `text`, in linear time in the
+        length of the text plus the number of matches.
+
+        Yields:
+            Tuple[int, int, int]: start char, end char and row of matching entry
+        """
+        norm_text, offsets = normalise_text(text, self.case_sensitive)
+        fail = self.fail
+        dict_link = self.dict_link
+        out = self.out
+        out_next = self.out_next
+        depth = self.depth
+        state = 0
+
+        for idx, char in enumerate(norm_text):
+            char = ord(char)
+
+            while True:
+                next_state = self._goto(state, char)
+                if next_state >= 0:
+                    state = next_state
+                    break
+                if state == 0:
+                    break
+                state = fail[state]
+
+            output_state = state if out[state] >= 0 else dict_link[state]
+
+            while output_state >= 0:
+                start = idx + 1 - depth[output_state]
+                if offsets is not None:
+                    start_char, end_char = offsets[start], offsets[idx] + 1
+                else:
+                    start_char, end_char = start, idx + 1
+
+                row = out[output_state]
+                while row >= 0:
+                    yield start_char, end_char, row
+                    row = out_next[row]
+
+                output_state = dict_link[output_state]
+
+    def _to_msg(self) -> dict:
+        return {
+            "format": COMPILED_FORMAT_VERSION,
+            "case_sensitive": self.case_sensitive,
+            "arrays": self.arrays,
+        }
+
+    @classmethod
+    def _from_msg(cls, msg: dict, ids: IdStore) -> "TrieAutomaton":
+        _check_format(msg)
+
+        return cls(msg["case_sensitive"], msg["arrays"], ids)
+
+
+def build_trie_automaton(
+    entries: Sequence[dict], case_sensitive: bool
+) -> TrieAutomaton:
+    """
+    Compile thesaurus entries into an Aho-Corasick automaton on normalised text (see
+    `normalise_text`). No tokenization is needed. As for the `PhraseMatcher` backend
+    (see `ThesaurusMatcher._add_compiled_to_state`), there is an output for the first
+    entry with each (label, normalised pattern) pair, and later entries with the same
+    label and pattern are ignored.
+
+    Args:
+        entries (Sequence[dict]): thesaurus entries, see `read_thesaurus`
+        case_sensitive (bool)
+
+    Returns:
+        TrieAutomaton
+    """
+    # build the trie with dicts first, then flatten it into arrays
+    goto = [{}]
+    out = [-1]
+    depth = [0]
+    out_next = np.full(len(entries), -1, dtype="int32")
+    # last row in the output chain of each state, and the labels in the chain
+    out_last = {}
+    out_labels = defaultdict(set)
+
+    for row, entry in enumerate(entries):
+        pattern, _ = normalise_text(entry["pattern"].strip(), case_sensitive)
+        state = 0
+
+        for char in pattern:
+            char = ord(char)
+            next_state = goto[state].get(char)
+
+            if next_state is None:
+                next_state = len(goto)
+                goto[state][char] = next_state
+                goto.append({})
+                out.append(-1)
+                depth.append(depth[state] + 1)
+
+            state = next_state
+
+        if state == 0 or entry["label"] in out_labels[state]:
+            continue
+
+        if out[state] == -1:
+            out[state] = row
+        else:
+            out_next[out_last[state]] = row
+
+        out_last[state] = row
+        out_labels[state].add(entry["label"])
+
+    # failure and dictionary suffix links, breadth first so that the failure state of
+    # each state has been processed before the state itself
+    n_states = len(goto)
+    fail = [0] * n_states
+    dict_link = [-1] * n_states
+    queue = deque(goto[0].values())
+
+    while queue:
+        state = queue.popleft()
+
+        for char, next_state in goto[state].items():
+            queue.append(next_state)
+            fail_state = fail[state]
+
+            while fail_state and char not in goto[fail_state]:
+                fail_state = fail[fail_state]
+
+            fail[next_state] = goto[fail_state].get(char, 0)
+            fail_target = fail[next_state]
+            dict_link[next_state] = (
+                fail_target if out[fail_target] >= 0 else dict_link[fail_target]
+            )
+
+    edge_offsets = np.zeros(n_states + 1, dtype="int64")
+    edge_offsets[1:] = np.cumsum([len(transitions) for transitions in goto])
+    edge_chars = np.zeros(edge_offsets[-1], dtype="uint32")
+    edge_targets = np.zeros(edge_offsets[-1], dtype="int32")
+
+    for state, transitions in enumerate(goto):
+        chars = sorted(transitions)
+        lo = edge_offsets[state]
+        edge_chars[lo : lo + len(chars)] = chars
+        edge_targets[lo : lo + len(chars)] = [transitions[c] for c in chars]
+
+    return TrieAutomaton(
+        case_sensitive,
+        {
+            "edge_offsets": edge_offsets,
+            "edge_chars": edge_chars,
+            "edge_targets": edge_targets,
+            "fail": np.asarray(fail, dtype="int32"),
+            "dict_link": np.asarray(dict_link, dtype="int32"),
+            "out": np.asarray(out, dtype="int32"),
+            "out_next": out_next,
+            "depth": np.asarray(depth, dtype="int32"),
+        },
+        IdStore.from_entries(entries),
+    )
+
+
+def load_compiled_thesaurus(
+    nlp,
+    thesaurus_path: str,
+    attr: str,
+    cache_dir: Optional[str] = None,
+    batch_size: int = 1000,
+    n_process: int = 1,
+    backend: str = "phrase_matcher",
+) -> Union[CompiledThesaurus, TrieAutomaton]:
+    """
+    Get the compiled form of a thesaurus, reading it from `cache_dir` if it has been
+    compiled before with the same file, tokenizer, attribute and backend, and writing it
+    there otherwise.
+
+    Args:
+        nlp: spaCy model
+        thesaurus_path (str): path to the thesaurus JSONL file
+        attr (str): token attribute to match on
+        cache_dir (Optional[str], optional): directory for compiled artifacts. If None,
+            the thesaurus is always compiled from scratch. Defaults to None.
+        batch_size (int, optional): see `compile_thesaurus`
+        n_process (int, optional): see `compile_thesaurus`
+        backend (str, optional): "phrase_matcher" to compile for `ThesaurusMatcher`, or
+            "trie" for `TrieThesaurusMatcher`. Defaults to "phrase_matcher".
+
+    Returns:
+        Union[CompiledThesaurus, TrieAutomaton]: depending on `backend`
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown thesaurus backend {backend}. Options are {BACKENDS}")
+
+    def _compile():
+        entries = read_thesaurus(thesaurus_path)
+
+        if backend == "trie":
+            return build_trie_automaton(entries, case_sensitive=(attr != "LOWER"))
+
+        return compile_thesaurus(nlp, entries, attr, batch_size, n_process)
+
+    if cache_dir is None:
+        return _compile()
+
+    fingerprint = thesaurus_fingerprint(nlp, thesaurus_path, attr, backend)
+    cache_path = os.path.join(cache_dir, fingerprint + COMPILED_SUFFIX)
+    compiled_cls = TrieAutomaton if backend == "trie" else CompiledThesaurus
+
+    if os.path.exists(cache_path):
+        try:
+            compiled = compiled_cls.from_disk(cache_path)
+            compiled.fingerprint = fingerprint
+            logger.info(f"Loaded compiled thesaurus from {cache_path}")
+            return compiled
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable compiled thesaurus {cache_path}: {e}")
+
+    compiled = _compile()
+    os.makedirs(cache_dir, exist_ok=True)
+    compiled.to_disk(cache_path)
+    # use the file that was just written so this process shares its pages too
+    compiled.ids = IdStore.open(cache_path + ID_STORE_SUFFIX)
+    compiled.fingerprint = fingerprint
+    logger.info(f"Wrote compiled thesaurus to {cache_path}")
+
+    return compiled
+
+
+class _MatcherState:
+    """
+    Everything matching depends on besides the PhraseMatcher itself. `apply_delta`
+    builds a new state and swaps it in with a single assignment, so documents being
+    processed at the time never see a half-applied update.
+
+    Rows are numbered across all id stores: store i holds rows `store_offsets[i]` to
+    `store_offsets[i] + len(stores[i]) - 1`.
+
+    `steps` records each compiled artifact added, with the rows removed just before it, so
+    that the state can be written out and rebuilt in the same order.
+    """
+
+    __slots__ = (
+        "steps",
+        "stores",
+        "store_offsets",
+        "removed_rows",
+        "rows",
+        "automata",
+        "label_hashes",
+    )
+
+    def __init__(self):
+        self.steps: List[Tuple[Tuple[int, ...], "_CompiledArtifact"]] = []
+        self.stores: List[IdStore] = []
+        self.store_offsets: List[int] = []
+        self.removed_rows: frozenset = frozenset()
+        # phrase_matcher backend: (label hash, keyword) -> row
+        self.rows: Dict[Tuple[int, Tuple[int, ...]], int] = {}
+        # trie backend: automata, and label hashes for the labels of each one's store
+        self.automata: List[TrieAutomaton] = []
+        self.label_hashes: List[List[int]] = []
+
+    def copy(self) -> "_MatcherState":
+        new_state = _MatcherState()
+        new_state.steps = list(self.steps)
+        new_state.stores = list(self.stores)
+        new_state.store_offsets = list(self.store_offsets)
+        new_state.removed_rows = self.removed_rows
+        new_state.rows = dict(self.rows)
+        new_state.automata = list(self.automata)
+        new_state.label_hashes = list(self.label_hashes)
+
+        return new_state
+
+    def n_rows(self) -> int:
+        return sum(len(store) for store in self.stores)
+
+    def add_store(self, ids: IdStore) -> int:
+        """Register an id store, returning the row number of its first entry."""
+        offset = self.n_rows()
+        self.stores.append(ids)
+        self.store_offsets.append(offset)
+
+        return offset
+
+    def ent_id(self, row: int) -> str:
+        idx = bisect_right(self.store_offsets, row) - 1
+
+        return self.stores[idx].ent_id(row - self.store_offsets[idx])
+
+    def find_rows(self, ids: Set[str]) -> List[int]:
+        """Rows of all current (not removed) entries whose id is in `ids`."""
+        return [
+            offset + row
+            for store, offset in zip(self.stores, self.store_offsets)
+            for row in store.find_rows(ids)
+            if offset + row not in self.removed_rows
+        ]
+
+
+class ThesaurusMatcher:
+    """
+    Adds spans to `Doc.ents` using exact phrase matches from a compiled thesaurus,
+    setting `ent.ent_id_` to the id of the matching thesaurus entry. Overlapping
+    matches are resolved in the same way as spaCy's `EntityRuler`: longer matches win,
+    then earlier ones, and existing entities are only replaced if `overwrite_ents`.
+    Where the same span matches several entries, the first in the thesaurus wins.
+
+    Entry labels and ids are kept in `IdStore`s (memory-mapped when the thesaurus was
+    loaded from a cache) and matches refer to entries by row number, so an id is only
+    decoded when an entity is created for it.
+
+    Changes to the thesaurus can be applied to a loaded matcher with `apply_delta`.
+
+    Numbers of matches and of entities added are counted in `ThesaurusMatcher.stats`.
+    """
+
+    def __init__(
+        self,
+        nlp,
+        name: str = "thesaurus_matcher",
+        attr: str = "LOWER",
+        overwrite_ents: bool = False,
+    ):
+        self.nlp = nlp
+        self.name = name
+        self.attr = attr
+        self.overwrite = overwrite_ents
+        self.phrase_matcher = PhraseMatcher(nlp.vocab, attr=attr)
+        # identifies the compiled state for caching deltas; None if not cached
+        self.fingerprint: Optional[str] = None
+        self._state = _MatcherState()
+        self.stats = {"matches": 0, "ents_added": 0}
+
+    def __len__(self) -> int:
+        """The number of thesaurus entries in the matcher."""
+        state = self._state
+
+        return state.n_rows() - len(state.removed_rows)
+
+    def ent_id(self, row: int) -> str:
+        """Look up the id of the thesaurus entry in `row`."""
+        return self._state.ent_id(row)
+
+    def add_compiled(self, compiled: CompiledThesaurus):
+        """
+        Add the entries of a compiled thesaurus to the matcher without tokenizing
+        anything.
+        """
+        state = self._state.copy()
+        self._add_step(state, compiled)
+        self._state = state
+
+        if compiled.fingerprint is not None:
+            self.fingerprint = compiled.fingerprint
+
+    def _add_step(
+        self,
+        state: _MatcherState,
+        compiled: CompiledThesaurus,
+        removed_rows: Sequence[int] = (),
+    ):
+        """Remove `removed_rows` from `state`, then add the entries of `compiled` to it."""
+        state.removed_rows = state.removed_rows.union(removed_rows)
+        self._add_compiled_to_state(state, compiled)
+        state.steps.append((tuple(removed_rows), compiled))
+
+    def _add_compiled_to_state(self, state: _MatcherState, compiled: CompiledThesaurus):
+        if compiled.attr != self.attr:
+            raise ValueError(
+                f"Thesaurus was compiled for attribute {compiled.attr} but matcher uses {self.attr}"
+            )
+
+        offset = state.add_store(compiled.ids)
+        keywords_by_label = defaultdict(list)
+
+        for row, label, keyword in compiled.iter_entries():
+            if not keyword:
+                continue
+
+            label_hash = self.nlp.vocab.strings.add(label)
+            keywords_by_label[label].append(keyword)
+            key = (label_hash, keyword)
+
+            # first entry wins if a label/pattern pair appears more than once, unless
+            # that entry has been removed. The trie backend keeps the same entries (see
+            # `build_trie_automaton`).
+            if key not in state.rows or state.rows[key] in state.removed_rows:
+                state.rows[key] = offset + row
+
+        # adding to the PhraseMatcher in place is safe for documents matched with the
+        # old state: matches with keys it doesn't know about are discarded
+        for label, keywords in keywords_by_label.items():
+            self.phrase_matcher.add(label, keywords)
+
+    def _compile_entries(self, entries: Sequence[dict]) -> CompiledThesaurus:
+        return compile_thesaurus(self.nlp, entries, self.attr)
+
+    def _clear_matcher(self):
+        self.phrase_matcher = PhraseMatcher(self.nlp.vocab, attr=self.attr)
+
+    def _compiled_cls(self):
+        return CompiledThesaurus
+
+    def apply_delta(self, delta_path: str, cache_dir: Optional[str] = None):
+        """
+        Apply a delta file of added, removed and changed entries (see `read_delta`) to
+        the matcher without rebuilding it. Only the added entries are tokenized. The new
+        state is swapped in atomically, so it is safe to call while documents are being
+        processed in other threads.
+
+        If `cache_dir` is set and the matcher was loaded from a cache, the compiled
+        delta is cached there too, keyed by the fingerprint of the matcher's state and
+        the delta file, so that loading the same thesaurus and deltas again doesn't
+        recompile anything.
+
+        Note that if a removed entry shared its label and pattern with another entry,
+        that other entry only matches again once the thesaurus is fully rebuilt.
+
+        Args:
+            delta_path (str): path to the delta JSONL file
+            cache_dir (Optional[str], optional): directory for compiled artifacts.
+                Defaults to None.
+        """
+        start = time.time()
+        fingerprint = None
+        compiled = None
+
+        if cache_dir is not None and self.fingerprint is not None:
+            fingerprint = delta_fingerprint(self.fingerprint, delta_path)
+            cache_path = os.path.join(cache_dir, fingerprint + COMPILED_SUFFIX)
+
+            if os.path.exists(cache_path):
+                try:
+                    compiled = self._compiled_cls().from_disk(cache_path)
+                    with open(cache_path + REMOVED_ROWS_SUFFIX, "rb") as f:
+                        msg = srsly.msgpack_loads(f.read())
+                    _check_format(msg)
+                    removed_rows = msg["removed_rows"].tolist()
+                except Exception as e:
+                    logger.warning(
+                        f"Ignoring unreadable compiled delta {cache_path}: {e}"
+                    )
+                    compiled = None
+
+        if compiled is None:
+            removed_ids, added_entries = read_delta(delta_path)
+            removed_rows = self._state.find_rows(removed_ids)
+            compiled = self._compile_entries(added_entries)
+
+            if fingerprint is not None:
+                os.makedirs(cache_dir, exist_ok=True)
+                compiled.to_disk(cache_path)
+                compiled.ids = IdStore.open(cache_path + ID_STORE_SUFFIX)
+                _write_atomically(
+                    cache_path + REMOVED_ROWS_SUFFIX,
+                    srsly.msgpack_dumps(
+                        {
+                            "format": COMPILED_FORMAT_VERSION,
+                            "removed_rows": np.asarray(removed_rows, dtype="int64"),
+                        }
+                    ),
+                )
+
+        state = self._state.copy()
+        self._add_step(state, compiled, removed_rows)
+        self._state = state
+        self.fingerprint = fingerprint
+
+        logger.info(
+            f"Applied thesaurus delta {delta_path} (-{len(removed_rows)} +{len(compiled)} entries) in {time.time()-start:.1f}s"
+        )
+
+    def to_disk(self, path, exclude: Sequence[str] = tuple()):
+        """
+        Write the compiled state of the matcher to the directory `path`: each compiled artifact
+        added to it, in order, and the rows removed by deltas. Called by `Language.to_disk`.
+        """
+        path = str(path)
+        os.makedirs(path, exist_ok=True)
+        state = self._state
+
+        for idx, (_, compiled) in enumerate(state.steps):
+            compiled.to_disk(os.path.join(path, f"{MATCHER_STEP_PREFIX}{idx}{COMPILED_SUFFIX}"))
+
+        _write_atomically(
+            os.path.join(path, MATCHER_STATE_FILE),
+            srsly.msgpack_dumps(
+                {
+                    "format": COMPILED_FORMAT_VERSION,
+                    "attr": self.attr,
+                    "fingerprint": self.fingerprint,
+                    "removed_rows": [
+                        np.asarray(removed_rows, dtype="int64")
+                        for removed_rows, _ in state.steps
+                    ],
+                }
+            ),
+        )
+
+    def from_disk(self, path, exclude: Sequence[str] = tuple()) -> "ThesaurusMatcher":
+        """
+        Replace the state of the matcher with one written by `to_disk`, without tokenizing
+        anything. Entry labels and ids are memory-mapped from `path`. Called by
+        `Language.from_disk`.
+        """
+        path = str(path)
+
+        with open(os.path.join(path, MATCHER_STATE_FILE), "rb") as f:
+            msg = srsly.msgpack_loads(f.read())
+        _check_format(msg)
+
+        if msg["attr"] != self.attr:
+            raise ValueError(
+                f"Thesaurus matcher was saved with attribute {msg['attr']} but matcher uses {self.attr}"
+            )
+
+        self._clear_matcher()
+        state = _MatcherState()
+        for idx, removed_rows in enumerate(msg["removed_rows"]):
+            compiled = self._compiled_cls().from_disk(
+                os.path.join(path, f"{MATCHER_STEP_PREFIX}{idx}{COMPILED_SUFFIX}")
+            )
+            self._add_step(state, compiled, removed_rows.tolist())
+
+        self._state = state
+        self.fingerprint = msg["fingerprint"]
+
+        return self
+
+    @staticmethod
+    def _sort_matches(matches) -> List[Tuple[int, int, int, int]]:
+        return sorted(matches, key=lambda m: (m[2] - m[1], -m[1], -m[3]), reverse=True)
+
+    def match(
+        self, doc: spacy.tokens.Doc, state: Optional[_MatcherState] = None
+    ) -> List[Tuple[int, int, int, int]]:
+        """
+        Returns (label hash, start, end, row) for each thesaurus match, sorted so that
+        the matches that take priority come first.
+        """
+        state = state or self._state
+        matches = self.phrase_matcher(doc)
+
+        if not matches:
+            return []
+
+        attr_values = doc.to_array(self.attr).tolist()
+        final_matches = set()
+
+        for label_hash, start, end in matches:
+            row = state.rows.get((label_hash, tuple(attr_values[start:end])))
+
+            if row is not None and row not in state.removed_rows:
+                final_matches.add((label_hash, start, end, row))
+
+        return self._sort_matches(final_matches)
+
+    def set_annotations(
+        self, doc: spacy.tokens.Doc, matches, state: Optional[_MatcherState] = None
+    ):
+        state = state or self._state
+        entities = list(doc.ents)
+        new_entities = []
+        seen_tokens = set()
+
+        for label_hash, start, end, row in matches:
+            if any(t.ent_type for t in doc[start:end]) and not self.overwrite:
+                continue
+
+            # check for end - 1 here because boundaries are inclusive
+            if start not in seen_tokens and end - 1 not in seen_tokens:
+                ent_id = state.ent_id(row)
+
+                if ent_id:
+                    span = Span(doc, start, end, label=label_hash, span_id=ent_id)
+                else:
+                    span = Span(doc, start, end, label=label_hash)
+
+                new_entities.append(span)
+                entities = [
+                    e for e in entities if not (e.start < end and e.end > start)
+                ]
+                seen_tokens.update(range(start, end))
+
+        self.stats["ents_added"] += len(new_entities)
+        doc.ents = entities + new_entities
+
+    def __call__(self, doc: spacy.tokens.Doc) -> spacy.tokens.Doc:
+        # use the same state throughout in case a delta is applied meanwhile
+        state = self._state
+        matches = self.match(doc, state)
+        self.stats["matches"] += len(matches)
+
+        if matches:
+            self.set_annotations(doc, matches, state)
+
+        return doc
+
+
+class TrieThesaurusMatcher(ThesaurusMatcher):
+    """
+    ThesaurusMatcher backed by a character-level `TrieAutomaton` instead of a
+    `PhraseMatcher`, for thesauri too large to keep as spaCy Docs. Matches are found on
+    normalised text (see `normalise_text`) and only kept if they start and end on token
+    boundaries. Overlaps are resolved as in `ThesaurusMatcher`. Each applied delta
+    adds a small automaton which is scanned alongside the main one.
+    """
+
+    def __init__(
+        self,
+        nlp,
+        name: str = "thesaurus_matcher",
+        attr: str = "LOWER",
+        overwrite_ents: bool = False,
+    ):
+        if attr not in ("LOWER", "ORTH"):
+            raise ValueError(
+                f"The trie thesaurus backend can only match on LOWER or ORTH, not {attr}"
+            )
+
+        self.nlp = nlp
+        self.name = name
+        self.attr = attr
+        self.overwrite = overwrite_ents
+        self.fingerprint = None
+        self._state = _MatcherState()
+        self.stats = {"matches": 0, "ents_added": 0}
+
+    def _add_compiled_to_state(self, state: _MatcherState, compiled: TrieAutomaton):
+        if compiled.case_sensitive != (self.attr == "ORTH"):
+            raise ValueError(
+                f"Thesaurus automaton case sensitivity does not match attribute {self.attr}"
+            )
+
+        state.add_store(compiled.ids)
+        state.automata.append(compiled)
+        state.label_hashes.append(
+            [self.nlp.vocab.strings.add(label) for label in compiled.ids.labels]
+        )
+
+    def _compile_entries(self, entries: Sequence[dict]) -> TrieAutomaton:
+        return build_trie_automaton(entries, case_sensitive=(self.attr == "ORTH"))
+
+    def _clear_matcher(self):
+        pass
+
+    def _compiled_cls(self):
+        return TrieAutomaton
+
+    def match(
+        self, doc: spacy.tokens.Doc, state: Optional[_MatcherState] = None
+    ) -> List[Tuple[int, int, int, int]]:
+        """
+        Returns (label hash, start, end, row) for each thesaurus match, sorted so that
+        the matches that take priority come first.
+        """
+        state = state or self._state
+        token_starts = {}
+        token_ends = {}
+
+        for token in doc:
+            token_starts[token.idx] = token.i
+            token_ends[token.idx + len(token)] = token.i + 1
+
+        final_matches = set()
+
+        for automaton, label_hashes, offset in zip(
+            state.automata, state.label_hashes, state.store_offsets
+        ):
+            label_idx = automaton.ids.label_idx
+
+            for start_char, end_char, row in automaton.find(doc.text):
+                start = token_starts.get(start_char)
+                end = token_ends.get(end_char)
+
+                if start is None or end is None or offset + row in state.removed_rows:
+                    continue
+
+                final_matches.add(
+                    (label_hashes[label_idx[row]], start, end, offset + row)
+                )
+
+        return self._sort_matches(final_matches)
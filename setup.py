@@ -19,5 +19,6 @@ setuptools.setup(
     ],
     python_requires=">=3.6",
     install_requires=["spacy>=3.0.0", "spacy-transformers>=1.0.1"],
+    extras_require={"columnar": ["pyarrow"]},
     packages=["hc_nlp"],
 )
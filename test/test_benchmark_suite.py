@@ -0,0 +1,97 @@
+from hc_nlp import benchmark_suite
+import json
+import os
+import pytest
+
+labelstudio_path = os.path.join(os.path.dirname(__file__), "2020-11-25-11-43-02.zip")
+small_suite = dict(
+    labelstudio_path=labelstudio_path,
+    thesaurus_sizes=[200, 100],
+    doc_lengths=[20],
+    densities=[0.5],
+    n_synthetic_docs=2,
+    repeats=1,
+)
+
+
+def test_summarise_latencies():
+    summary = benchmark_suite.summarise_latencies([0.1] * 99 + [1.0])
+
+    assert summary["n_docs"] == 100
+    assert summary["docs_per_sec"] == pytest.approx(100 / 10.9)
+    assert summary["p50_seconds"] == 0.1
+    assert 0.1 < summary["p99_seconds"] <= 1.0
+    assert summary["peak_rss_mb"] > 0
+
+
+def test_run_suite():
+    results = benchmark_suite.run_suite(**small_suite)
+    benchmarks = results["benchmarks"]
+
+    for name in benchmark_suite.COMPONENTS:
+        assert benchmarks[f"labelstudio/{name}"]["docs_per_sec"] > 0
+        assert f"synthetic/{name}/tokens=20/density=0.5" in benchmarks
+
+    assert benchmarks["labelstudio/end_to_end"]["n_docs"] == len(
+        benchmark_suite.labelstudio_texts(labelstudio_path)
+    )
+    assert benchmarks["thesaurus/100/load"]["load_seconds"] > 0
+    assert benchmarks["thesaurus/200/match"]["p99_seconds"] > 0
+    assert results["meta"]["model"] == "en_core_web_sm"
+
+
+def test_compare_to_baseline():
+    baseline = {
+        "benchmarks": {
+            "a": {"docs_per_sec": 100, "p99_seconds": 0.01, "peak_rss_mb": 100},
+            "b": {"load_seconds": 1.0},
+        }
+    }
+    results = {
+        "benchmarks": {
+            "a": {"docs_per_sec": 70, "p99_seconds": 0.011, "peak_rss_mb": 100},
+            "b": {"load_seconds": 1.5},
+            "c": {"docs_per_sec": 1},
+        }
+    }
+
+    regressions = benchmark_suite.compare_to_baseline(results, baseline, tolerance=0.2)
+
+    assert len(regressions) == 2
+    assert regressions[0].startswith("a: docs_per_sec")
+    assert regressions[1].startswith("b: load_seconds")
+    assert benchmark_suite.compare_to_baseline(results, baseline, tolerance=0.6) == []
+
+
+def test_main_writes_and_compares_baseline(tmp_path):
+    baseline_path = str(tmp_path / "baseline.json")
+    argv = ["--baseline", baseline_path, "--tolerance", "1000"]
+    for key, value in small_suite.items():
+        argv += [f"--{key.replace('_', '-')}"] + [
+            str(v) for v in (value if isinstance(value, list) else [value])
+        ]
+
+    assert benchmark_suite.main(argv) == 0
+    with open(baseline_path) as f:
+        assert "labelstudio/end_to_end" in json.load(f)["benchmarks"]
+
+    output_path = str(tmp_path / "results.json")
+    assert benchmark_suite.main(argv + ["--output", output_path]) == 0
+    with open(output_path) as f:
+        assert "benchmarks" in json.load(f)
+
+    # the Label Studio export isn't shipped with the package, so has to be given
+    with pytest.raises(SystemExit):
+        benchmark_suite.main(["--baseline", baseline_path])
+
+
+def test_run_memory_soak():
+    soak = benchmark_suite.run_memory_soak(
+        2000, memory_window=200, max_new_strings=500, n_samples=4
+    )
+
+    assert [sample["docs"] for sample in soak["samples"]] == [500, 1000, 1500, 2000]
+    # new strings (several per doc) are released, so the vocab doesn't grow with the docs
+    strings = [sample["strings"] for sample in soak["samples"]]
+    assert max(strings) - min(strings) < 2000
+    assert soak["rss_growth_mb"] < 50
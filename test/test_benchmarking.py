@@ -0,0 +1,77 @@
+from hc_nlp import benchmarking
+import spacy
+
+
+def test_make_synthetic_doc():
+    nlp = spacy.blank("en")
+    doc = benchmarking.make_synthetic_doc(nlp, 100, seed=1)
+
+    assert len(doc.ents) >= 100
+    assert {ent.label_ for ent in doc.ents} == {"PERSON", "LOC", "FAC", "ORG", "DATE"}
+    assert [ent.text for ent in doc.ents] == [
+        ent.text for ent in benchmarking.make_synthetic_doc(nlp, 100, seed=1).ents
+    ]
+
+
+def test_scaling_exponent():
+    sizes = [10, 100, 1000]
+
+    assert round(benchmarking.scaling_exponent(sizes, [s * 0.5 for s in sizes]), 6) == 1
+    assert round(benchmarking.scaling_exponent(sizes, [s**2 for s in sizes]), 6) == 2
+
+
+def test_benchmark_entity_joiner():
+    results = benchmarking.benchmark_entity_joiner(sizes=[50, 100], repeats=1)
+
+    assert results["sizes"] == [50, 100]
+    assert len(results["seconds"]) == 2
+    assert isinstance(results["scaling_exponent"], float)
+
+
+def test_benchmark_duplicate_entity_detector():
+    results = benchmarking.benchmark_duplicate_entity_detector(
+        sizes=[50, 100], repeats=1
+    )
+
+    assert results["sizes"] == [50, 100]
+    assert len(results["seconds"]) == 2
+
+
+def test_benchmark_hc_postprocess():
+    results = benchmarking.benchmark_hc_postprocess(n_ents=20, n_docs=5, repeats=1)
+
+    assert results["seconds_per_doc_chained"] > 0
+    assert results["speedup"] > 0
+
+
+def test_benchmark_snapshot_startup():
+    results = benchmarking.benchmark_snapshot_startup(n_entries=200)
+
+    assert results["build_seconds"] > 0
+    assert results["load_seconds"] > 0
+
+
+def test_benchmark_instrumentation_overhead():
+    # raises if the overhead is 1% or more
+    results = benchmarking.benchmark_instrumentation_overhead(n_docs=20, repeats=3)
+
+    assert results["seconds_per_doc"] > 0
+    assert 0 <= results["overhead"] < 0.01
+
+
+def test_make_scaled_doc():
+    nlp = spacy.blank("en")
+    sparse = benchmarking.make_scaled_doc(nlp, 500, 0.1)
+    dense = benchmarking.make_scaled_doc(nlp, 500, 1.0)
+
+    assert len(sparse) >= 500
+    assert len(dense) >= 500
+    assert len(dense.ents) > len(sparse.ents)
+    assert len(benchmarking.make_scaled_doc(nlp, 50, 0.0).ents) == 0
+
+
+def test_benchmark_mention_memory():
+    results = benchmarking.benchmark_mention_memory(n_ents=5, n_docs=20)
+
+    assert results["mention_bytes_per_record"] > 0
+    assert results["ratio"] > 1
@@ -0,0 +1,78 @@
+from hc_nlp import columnar, corpus
+from hc_nlp.benchmark_suite import make_soak_pipeline, soak_texts
+from hc_nlp.mentions import MENTION_FIELDS
+import srsly
+import pytest
+
+pa = pytest.importorskip("pyarrow")
+
+
+@pytest.fixture(scope="module")
+def records():
+    return list(
+        corpus.process_corpus(make_soak_pipeline(), soak_texts(50), dedupe=False)
+    )
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_write_columnar(tmp_path, records, format):
+    output_dir = str(tmp_path / "output")
+    n_records = columnar.write_columnar(
+        records, output_dir, format, batch_size=16, metadata={"fingerprint": "abc"}
+    )
+    paths = columnar.output_paths(output_dir, format)
+
+    assert n_records == len(records)
+
+    mentions = columnar.read_table(paths["mentions"])
+    assert mentions.schema.names == list(MENTION_FIELDS)
+    assert pa.types.is_dictionary(mentions.schema.field("label").type)
+    assert mentions.to_pylist() == [
+        dict(zip(MENTION_FIELDS, [record["id"]] + ent))
+        for record in records
+        for ent in record["ents"]
+    ]
+
+    documents = columnar.read_table(paths["documents"], columns=["n_ents"])
+    assert documents.column_names == ["n_ents"]
+    assert documents.column("n_ents").to_pylist() == [
+        len(record["ents"]) for record in records
+    ]
+
+    labels = columnar.read_table(paths["mentions"], columns=["label"])
+    assert set(labels.column("label").to_pylist()) == {"PERSON", "LOC"}
+    assert columnar.read_metadata(paths["mentions"]) == {"fingerprint": "abc"}
+
+
+def test_write_columnar_batches(tmp_path, records):
+    output_dir = str(tmp_path / "output")
+    columnar.write_columnar(records, output_dir, "parquet", batch_size=40)
+    paths = columnar.output_paths(output_dir, "parquet")
+
+    n_mentions = sum(len(record["ents"]) for record in records)
+    metadata = pa.parquet.ParquetFile(paths["mentions"]).metadata
+    assert metadata.num_row_groups == -(-n_mentions // 40)
+
+
+def test_output_paths():
+    with pytest.raises(ValueError):
+        columnar.output_paths("output", "csv")
+
+
+def test_annotate_corpus_columnar(tmp_path):
+    input_path = str(tmp_path / "records.jsonl")
+    srsly.write_jsonl(
+        input_path, [{"id": record_id, "text": text} for record_id, text in soak_texts(5)]
+    )
+    output_dir = str(tmp_path / "output")
+
+    assert (
+        corpus.annotate_corpus(
+            make_soak_pipeline(), input_path, output_dir, output_format="arrow"
+        )
+        == 5
+    )
+
+    paths = columnar.output_paths(output_dir, "arrow")
+    assert columnar.read_table(paths["documents"]).num_rows == 5
+    assert "pipeline_fingerprint" in columnar.read_metadata(paths["mentions"])
@@ -0,0 +1,241 @@
+from hc_nlp import corpus
+import spacy
+import json
+import pytest
+
+texts = [
+    "This phrase was written in February 2021.",
+    "Made c.1200 - 1220.",
+    "No dates here.",
+    "Used from 1805 to 1860, then on 03/12/2000.",
+]
+
+
+processed_texts = []
+
+
+@spacy.Language.component("count_docs")
+def count_docs(doc):
+    processed_texts.append(doc.text)
+
+    return doc
+
+
+def _nlp():
+    nlp = spacy.blank("en")
+    nlp.add_pipe("date_matcher", config={"century_detection": "patterns"})
+
+    return nlp
+
+
+def test_read_records(tmp_path):
+    jsonl_path = str(tmp_path / "records.jsonl")
+    with open(jsonl_path, "w") as f:
+        for idx, text in enumerate(texts):
+            f.write(json.dumps({"uid": str(idx), "body": text}) + "\n")
+
+    csv_path = str(tmp_path / "records.csv")
+    with open(csv_path, "w") as f:
+        f.write("uid,body\n")
+        for idx, text in enumerate(texts):
+            f.write(f'{idx},"{text}"\n')
+
+    for path in (jsonl_path, csv_path):
+        assert list(corpus.read_records(path, "uid", "body")) == [
+            (str(idx), text) for idx, text in enumerate(texts)
+        ]
+
+
+def test_prefetch():
+    assert list(corpus.prefetch(range(100), max_size=3)) == list(range(100))
+
+    def fail():
+        yield 1
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        list(corpus.prefetch(fail(), max_size=3))
+
+
+@pytest.mark.parametrize("n_process", [1, 2])
+def test_process_corpus(n_process):
+    nlp = _nlp()
+    records = [(str(idx), text) for idx, text in enumerate(texts * 5)]
+
+    results = list(
+        corpus.process_corpus(
+            nlp, iter(records), batch_size=3, n_process=n_process, queue_size=2
+        )
+    )
+
+    assert [r["id"] for r in results] == [record_id for record_id, _ in records]
+    assert results[:4] == [
+        corpus.doc_to_record(nlp(text), str(idx)) for idx, text in enumerate(texts)
+    ]
+    assert results[1]["ents"][0][:4] == [5, 18, "DATE", ""]
+
+
+def test_annotate_corpus(tmp_path):
+    input_path = str(tmp_path / "records.jsonl")
+    output_path = str(tmp_path / "output.jsonl")
+
+    with open(input_path, "w") as f:
+        for idx, text in enumerate(texts):
+            f.write(json.dumps({"id": idx, "text": text}) + "\n")
+
+    n_records = corpus.annotate_corpus(_nlp(), input_path, output_path, batch_size=2)
+
+    with open(output_path) as f:
+        output = [json.loads(line) for line in f]
+
+    assert n_records == len(texts)
+    assert [r["id"] for r in output] == list(range(len(texts)))
+    assert [len(r["ents"]) for r in output] == [0, 1, 0, 2]
+
+
+def test_length_bucketed_batches():
+    lengths = [3, 40, 5, 0, 33, 6, 4, 2, 100]
+    batches = list(corpus.length_bucketed_batches(lengths, token_budget=12))
+
+    # every doc is in one batch, and all docs in a batch are in the same bucket
+    assert sorted(idx for _, batch in batches for idx in batch) == list(
+        range(len(lengths))
+    )
+    for bucket, batch in batches:
+        assert {corpus.length_bucket(lengths[idx]) for idx in batch} == {bucket}
+        assert (len(batch) == 1) or (
+            len(batch) * max(lengths[idx] for idx in batch) <= 12
+        )
+
+    assert [batch for _, batch in batches] == [[3], [7, 0], [6, 2], [5], [4], [1], [8]]
+
+
+def test_process_corpus_bucketed():
+    nlp = _nlp()
+    records = [(str(idx), text) for idx, text in enumerate(texts * 5)]
+    bucket_stats = corpus.BucketStats()
+
+    results = list(
+        corpus.process_corpus(
+            nlp,
+            iter(records),
+            token_budget=30,
+            window_size=7,
+            bucket_stats=bucket_stats,
+            dedupe=False,
+        )
+    )
+
+    assert results == list(corpus.process_corpus(nlp, iter(records)))
+
+    report = bucket_stats.report()
+    assert sum(stats["docs"] for stats in report.values()) == len(records)
+    assert all(0 <= stats["padding_ratio"] < 0.5 for stats in report.values())
+    assert all(stats["docs_per_sec"] > 0 for stats in report.values())
+
+    with pytest.raises(ValueError):
+        list(corpus.process_corpus(nlp, iter(records), n_process=2, token_budget=30))
+
+
+def test_process_corpus_dedupe():
+    nlp = _nlp()
+    nlp.add_pipe("count_docs")
+    records = [(str(idx), text) for idx, text in enumerate(texts * 3 + [""])]
+
+    expected = list(corpus.process_corpus(nlp, records, dedupe=False))
+    processed_texts.clear()
+
+    assert list(corpus.process_corpus(nlp, records, window_size=8)) == expected
+    # each text is processed at most once per window it appears in
+    assert len(processed_texts) <= len(texts) * 2 + 1
+
+
+def test_process_corpus_dedupe_single_pipe_call(monkeypatch):
+    nlp = _nlp()
+    records = [(str(idx), text) for idx, text in enumerate(texts * 10)]
+    expected = list(corpus.process_corpus(nlp, records, dedupe=False))
+
+    pipe_calls = []
+    pipe = nlp.pipe
+
+    def counting_pipe(*args, **kwargs):
+        # with as_tuples, nlp.pipe calls itself again without
+        if kwargs.get("as_tuples"):
+            pipe_calls.append(1)
+
+        return pipe(*args, **kwargs)
+
+    monkeypatch.setattr(nlp, "pipe", counting_pipe)
+
+    # texts from all 10 windows go through one nlp.pipe call, so with n_process > 1 worker
+    # processes are only started once
+    assert list(corpus.process_corpus(nlp, records, window_size=4)) == expected
+    assert len(pipe_calls) == 1
+
+
+def test_process_corpus_sentence_level():
+    nlp = _nlp()
+    boilerplate = "Made c.1200 - 1220."
+    records = [
+        ("a", "Used from 1805 to 1860. " + boilerplate),
+        ("b", boilerplate + " On 03/12/2000."),
+        ("c", "No dates here."),
+    ]
+
+    results = list(corpus.process_corpus(nlp, records, sentence_level=True))
+
+    assert results == list(corpus.process_corpus(nlp, records, dedupe=False))
+    assert [
+        [records[idx][1][ent[0] : ent[1]] for ent in result["ents"]]
+        for idx, result in enumerate(results)
+    ] == [["1805 to 1860", "c.1200 - 1220"], ["c.1200 - 1220", "03/12/2000"], []]
+
+
+def test_process_corpus_memory_window(tmp_path):
+    from hc_nlp.benchmark_suite import make_soak_pipeline, soak_texts
+    from hc_nlp.instrumentation import InstrumentedComponent, instrument_pipeline
+    from hc_nlp.snapshot import save_snapshot
+
+    records = list(soak_texts(300))
+    expected = list(
+        corpus.process_corpus(make_soak_pipeline(), records, dedupe=False)
+    )
+
+    nlp = make_soak_pipeline()
+    snapshot_path = str(tmp_path / "snapshot")
+    save_snapshot(nlp, snapshot_path)
+    n_strings = len(nlp.vocab.strings)
+    config = nlp.config.to_str()
+    metrics = instrument_pipeline(nlp)
+    fresh_pipelines = []
+
+    results = list(
+        corpus.process_corpus(
+            nlp,
+            records,
+            dedupe=False,
+            memory_window=50,
+            snapshot_path=snapshot_path,
+            max_new_strings=100,
+            on_refresh=fresh_pipelines.append,
+        )
+    )
+
+    # span extensions set by EntityJoiner and DuplicateEntityDetector are kept
+    assert results == expected
+    assert results[0]["ents"][1][5:] == ["visitor0_quibble0", True]
+    # later windows are processed by fresh pipelines without the new strings, to which the
+    # instrumentation and the counts of the components are moved
+    assert len(fresh_pipelines) > 1
+    current = fresh_pipelines[-1]
+    assert len(current.vocab.strings) < n_strings + 1000
+    assert metrics.components["entity_joiner"].metrics.docs == len(records)
+    assert current.get_pipe("entity_joiner").stats["comma_loc_joins"] == len(records)
+
+    assert isinstance(current.get_pipe("entity_joiner"), InstrumentedComponent)
+
+    # the pipeline passed in is left uninstrumented, with its config
+    assert not any(
+        isinstance(component, InstrumentedComponent) for _, component in nlp.components
+    )
+    assert nlp.config.to_str() == config
@@ -0,0 +1,118 @@
+from hc_nlp import pipeline
+from hc_nlp.entity_edits import EntityEdits, edit_ents
+import spacy
+import pytest
+
+nlp = spacy.blank("en")
+
+
+def _ent_tuples(doc):
+    return [(ent.start, ent.end, ent.label_, ent.ent_id_) for ent in doc.ents]
+
+
+def _make_doc():
+    doc = nlp("King George visited Brighton and Hove in the year 1850")
+    doc.ents = [
+        spacy.tokens.Span(doc, 1, 2, "PERSON", span_id="george"),
+        spacy.tokens.Span(doc, 3, 4, "LOC"),
+        spacy.tokens.Span(doc, 5, 6, "LOC"),
+        spacy.tokens.Span(doc, 7, 10, "DATE"),
+    ]
+
+    return doc
+
+
+def test_entity_edits_commit():
+    doc = _make_doc()
+    edits = EntityEdits(doc)
+    person, brighton, hove, date = edits.ents()
+
+    edits.set_bounds(person, 0, 2)
+    edits.remove(hove)
+    edits.set_bounds(brighton, 3, 6)
+    edits.set_label(brighton, "GPE")
+    edits.set_bounds(date, 9, 10)
+    edits.add(8, 9, "DATE")
+
+    assert edits.label_at(4) == "GPE"
+    assert edits.ent_at(6) is None
+
+    # nothing is written to the doc until the edits are committed
+    assert len(doc.ents) == 4
+    assert edits.commit() is doc
+    assert _ent_tuples(doc) == [
+        (0, 2, "PERSON", "george"),
+        (3, 6, "GPE", ""),
+        (8, 9, "DATE", ""),
+        (9, 10, "DATE", ""),
+    ]
+
+
+def test_entity_edits_validate_overlaps():
+    doc = _make_doc()
+    edits = EntityEdits(doc)
+    person, brighton, hove, date = edits.ents()
+
+    assert edits.overlaps(2, 4)
+    assert not edits.overlaps(3, 4, ignore=brighton)
+
+    with pytest.raises(ValueError):
+        edits.add(2, 4, "LOC")
+
+    with pytest.raises(ValueError):
+        edits.set_bounds(brighton, 3, 6)
+
+    with pytest.raises(ValueError):
+        edits.add(4, 4, "LOC")
+
+    # failed edits leave the buffer unchanged
+    assert not edits.modified
+    assert [(ent.start, ent.end) for ent in edits] == [(1, 2), (3, 4), (5, 6), (7, 10)]
+
+
+def test_edit_ents_batches_into_given_edits():
+    doc = _make_doc()
+    edits = EntityEdits(doc)
+
+    with edit_ents(doc, edits) as same_edits:
+        same_edits.remove(same_edits.ents()[0])
+
+    assert same_edits is edits
+    assert len(doc.ents) == 4
+
+    with edit_ents(doc) as new_edits:
+        new_edits.remove(new_edits.ents()[0])
+
+    assert len(doc.ents) == 3
+
+
+def test_components_keep_ent_ids():
+    doc = _make_doc()
+    doc.ents = [
+        (
+            spacy.tokens.Span(doc, 3, 4, "GPE", span_id="brighton")
+            if ent.start == 3
+            else ent
+        )
+        for ent in doc.ents
+    ]
+
+    doc = pipeline.EntityFilter(nlp, "entity_filter")(doc)
+    doc = pipeline.MapEntityTypes(nlp, "map_entity_types")(doc)
+
+    # the royal title is added to the PERSON entity, and "the year" removed from the DATE
+    assert _ent_tuples(doc) == [
+        (0, 2, "PERSON", "george"),
+        (3, 4, "LOC", "brighton"),
+        (5, 6, "LOC", ""),
+        (9, 10, "DATE", ""),
+    ]
+
+
+def test_entity_filter_royal_title_at_doc_start():
+    doc = nlp("George met the King")
+    doc.ents = [spacy.tokens.Span(doc, 0, 1, "PERSON")]
+
+    doc = pipeline.EntityFilter(nlp, "entity_filter")(doc)
+
+    assert _ent_tuples(doc) == [(0, 1, "PERSON", "")]
@@ -0,0 +1,232 @@
+from hc_nlp import corpus, instrumentation, pipeline
+import spacy
+import json
+import srsly
+import pytest
+
+text = "Katharine and Charles Parsons met x in Brighton , UK in the 19th century ."
+
+
+@pytest.fixture
+def nlp():
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns(
+        [
+            {"label": "PERSON", "pattern": "Katharine"},
+            {"label": "PERSON", "pattern": "Charles Parsons"},
+            {"label": "ORG", "pattern": "x"},
+            {"label": "LOC", "pattern": "Brighton"},
+            {"label": "LOC", "pattern": "UK"},
+        ]
+    )
+    nlp.add_pipe("entity_filter")
+    nlp.add_pipe("entity_joiner")
+    nlp.add_pipe("date_matcher", config={"century_detection": "patterns"})
+    nlp.add_pipe("map_entity_types")
+    nlp.add_pipe("duplicate_entity_detector")
+
+    return nlp
+
+
+def _ents(doc):
+    return [(ent.start, ent.end, ent.label_) for ent in doc.ents]
+
+
+def test_histogram():
+    histogram = instrumentation.Histogram(bounds=[1, 2, 4])
+
+    assert histogram.quantile(0.5) == 0
+
+    for value in [0.5, 1.5, 1.5, 3, 10]:
+        histogram.observe(value)
+
+    assert histogram.counts == [1, 2, 1, 1]
+    assert histogram.count == 5
+    assert histogram.sum == pytest.approx(16.5)
+    assert histogram.quantile(0.5) == 2
+    assert histogram.quantile(0.99) == float("inf")
+
+
+def test_count_ents(nlp):
+    doc = nlp(text)
+
+    assert instrumentation.count_ents(doc) == len(doc.ents)
+
+
+def test_instrument_pipeline(nlp):
+    expected = _ents(nlp(text))
+    config = nlp.config.to_str()
+    metrics = instrumentation.instrument_pipeline(nlp)
+
+    assert list(metrics.components) == [
+        "entity_filter",
+        "entity_joiner",
+        "date_matcher",
+        "map_entity_types",
+        "duplicate_entity_detector",
+    ]
+    # attributes of the wrapped components are still available
+    assert nlp.get_pipe("entity_filter").max_token_length == 1
+
+    doc = nlp(text)
+    assert _ents(doc) == expected
+
+    stats = metrics.to_dict()["components"]
+    assert stats["entity_filter"]["docs"] == 1
+    assert stats["entity_filter"]["tokens"] == len(doc)
+    assert stats["entity_filter"]["ents_in"] == 5
+    assert stats["entity_filter"]["ents_out"] == 4
+    assert stats["entity_joiner"]["ents_in"] == 4
+    assert stats["duplicate_entity_detector"]["ents_out"] == len(doc.ents)
+    assert stats["entity_filter"]["seconds"]["count"] == 1
+
+    # rule counts are cumulative, so include the first, uninstrumented, call
+    assert stats["entity_filter"]["rules"]["unlikely_removed"] == 2
+    assert stats["entity_joiner"]["rules"]["person_joins"] == 2
+    assert stats["entity_joiner"]["rules"]["comma_loc_joins"] == 2
+    assert stats["date_matcher"]["rules"]["centuries_added"] == 2
+
+    instrumentation.uninstrument_pipeline(nlp)
+    assert not any(
+        isinstance(component, instrumentation.InstrumentedComponent)
+        for _, component in nlp.pipeline
+    )
+    # the original components are put back with their config
+    assert nlp.config.to_str() == config
+    assert _ents(nlp(text)) == expected
+
+
+def test_instrument_pipeline_keeps_disabled_pipes(nlp):
+    nlp.disable_pipe("entity_joiner")
+    names = nlp.component_names
+    metrics = instrumentation.instrument_pipeline(nlp)
+
+    assert nlp.component_names == names
+    assert nlp.disabled == ["entity_joiner"]
+    nlp(text)
+    assert metrics.components["entity_joiner"].metrics.docs == 0
+    assert metrics.components["entity_filter"].metrics.docs == 1
+
+    instrumentation.uninstrument_pipeline(nlp)
+    assert nlp.component_names == names
+    assert nlp.disabled == ["entity_joiner"]
+
+
+def test_instrument_spacy_pipes(nlp):
+    nlp.add_pipe("sentencizer", first=True)
+    metrics = instrumentation.instrument_pipeline(nlp, spacy_pipes=True, ent_sample_every=1)
+
+    assert list(metrics.components)[:3] == ["sentencizer", "entity_ruler", "entity_filter"]
+
+    docs = list(nlp.pipe([text] * 5, batch_size=2))
+
+    assert all(len(list(doc.sents)) == 1 for doc in docs)
+    for component in metrics.components.values():
+        assert component.metrics.docs == 5
+
+    assert metrics.components["entity_ruler"].metrics.ents_out == 25
+
+
+def test_instrument_pipeline_samples_ents(nlp):
+    metrics = instrumentation.instrument_pipeline(nlp, ent_sample_every=2)
+    n_ents = len(nlp(text).ents)
+
+    for _ in range(4):
+        nlp(text)
+    list(nlp.pipe([text] * 5))
+
+    # entities are counted for docs 1, 3, 5, 7 and 9 of the 10
+    stats = metrics.to_dict()["components"]
+    assert stats["entity_filter"]["docs"] == 10
+    assert stats["entity_filter"]["ent_docs"] == 5
+    assert stats["entity_filter"]["ents_in"] == 25
+    assert stats["entity_filter"]["ents_out"] == 20
+    assert stats["entity_joiner"]["ents_in"] == 20
+    assert stats["duplicate_entity_detector"]["ent_docs"] == 5
+    assert stats["duplicate_entity_detector"]["ents_out"] == 5 * n_ents
+
+
+def test_write_metrics(nlp, tmp_path):
+    metrics = instrumentation.instrument_pipeline(nlp)
+    nlp(text)
+
+    json_path = str(tmp_path / "metrics.json")
+    metrics.write(json_path)
+    assert srsly.read_json(json_path)["components"]["entity_joiner"]["rules"] == {
+        "same_label_joins": 0,
+        "comma_loc_joins": 1,
+        "person_joins": 1,
+    }
+
+    prom_path = str(tmp_path / "metrics.prom")
+    metrics.write(prom_path)
+    with open(prom_path) as f:
+        lines = f.read().splitlines()
+
+    assert (
+        'hc_nlp_rule_hits_total{component="entity_joiner",rule="person_joins"} 1'
+        in lines
+    )
+    assert (
+        'hc_nlp_component_seconds_bucket{component="entity_filter",le="+Inf"} 1'
+        in lines
+    )
+    assert 'hc_nlp_component_docs_total{component="date_matcher"} 1' in lines
+
+
+def test_annotate_corpus_metrics(nlp, tmp_path):
+    input_path = str(tmp_path / "records.jsonl")
+    srsly.write_jsonl(input_path, [{"id": idx, "text": text} for idx in range(3)])
+    metrics_path = str(tmp_path / "metrics.json")
+
+    corpus.annotate_corpus(
+        nlp,
+        input_path,
+        str(tmp_path / "output.jsonl"),
+        dedupe=False,
+        metrics_path=metrics_path,
+    )
+
+    with open(metrics_path) as f:
+        stats = json.load(f)["components"]
+
+    assert stats["entity_filter"]["docs"] == 3
+    assert not any(
+        isinstance(component, instrumentation.InstrumentedComponent)
+        for _, component in nlp.pipeline
+    )
+
+
+def test_refresh_pipeline_keeps_hc_postprocess_counts(tmp_path):
+    from hc_nlp.snapshot import save_snapshot
+
+    nlp = spacy.blank("en")
+    ruler = nlp.add_pipe("entity_ruler")
+    ruler.add_patterns(
+        [
+            {"label": "PERSON", "pattern": "Katharine"},
+            {"label": "PERSON", "pattern": "Charles Parsons"},
+            {"label": "LOC", "pattern": "Brighton"},
+            {"label": "LOC", "pattern": "UK"},
+        ]
+    )
+    nlp.add_pipe("hc_postprocess")
+    snapshot_path = str(tmp_path / "snapshot")
+    save_snapshot(nlp, snapshot_path)
+
+    metrics = instrumentation.instrument_pipeline(nlp)
+    nlp(text)
+    counts = metrics.components["hc_postprocess"].rule_counts
+    assert counts["entity_joiner.person_joins"] == 1
+
+    fresh = corpus.refresh_pipeline(nlp, snapshot_path)
+    assert fresh is not nlp
+    assert metrics.components["hc_postprocess"].rule_counts == counts
+    assert isinstance(nlp.get_pipe("hc_postprocess"), pipeline.HCPostprocess)
+
+    fresh(text)
+    counts_after = metrics.to_dict()["components"]["hc_postprocess"]["rules"]
+    assert counts_after["entity_joiner.person_joins"] == 2
+    assert counts_after["entity_joiner.comma_loc_joins"] == 2
+    assert metrics.components["hc_postprocess"].metrics.docs == 2
@@ -0,0 +1,95 @@
+from hc_nlp import benchmarking, mentions
+from hc_nlp.mentions import EntityMention
+import hc_nlp.pipeline  # noqa: F401
+import spacy
+import pickle
+import pytest
+
+
+@pytest.fixture
+def nlp():
+    nlp = spacy.blank("en")
+    nlp.add_pipe("entity_joiner")
+    nlp.add_pipe("duplicate_entity_detector")
+
+    return nlp
+
+
+def _process(nlp, doc):
+    for _, component in nlp.pipeline:
+        doc = component(doc)
+
+    return doc
+
+
+def test_doc_to_mentions_matches_spans(nlp):
+    for seed, n_ents in enumerate([0, 1, 10, 100]):
+        doc = _process(nlp, benchmarking.make_synthetic_doc(nlp, n_ents, seed))
+        if seed == 1:
+            doc.ents = [
+                spacy.tokens.Span(doc, ent.start, ent.end, ent.label_, span_id=f"id{idx}")
+                for idx, ent in enumerate(doc.ents)
+            ]
+
+        assert mentions.doc_to_mentions(doc, seed) == [
+            EntityMention(
+                seed,
+                ent.start_char,
+                ent.end_char,
+                ent.label_,
+                ent.ent_id_,
+                *(ent._.get(name) for name in mentions.ENT_EXTENSIONS),
+            )
+            for ent in doc.ents
+        ]
+
+
+def test_doc_to_mentions_extensions(nlp):
+    doc = _process(
+        nlp,
+        spacy.tokens.Doc(
+            nlp.vocab,
+            words=["Katharine", "and", "Charles", "Parsons", "met", "Parsons"],
+            ents=["B-PERSON", "O", "B-PERSON", "I-PERSON", "O", "B-PERSON"],
+        ),
+    )
+    katharine, charles, duplicate = mentions.doc_to_mentions(doc, "r1")
+
+    assert katharine.alt_ent_text == "Katharine Parsons"
+    assert (charles.start_char, charles.end_char, charles.label) == (14, 29, "PERSON")
+    assert duplicate.entity_duplicate is True
+    assert duplicate.entity_co_occurrence == charles.entity_co_occurrence
+    assert pickle.loads(pickle.dumps(duplicate)) == duplicate
+
+
+def test_pipe_mentions(nlp):
+    ruler = nlp.add_pipe("entity_ruler", first=True)
+    ruler.add_patterns([{"label": "LOC", "pattern": "Brighton"}])
+
+    results = list(
+        mentions.pipe_mentions(nlp, [("a", "In Brighton ."), ("b", "Nowhere .")])
+    )
+
+    assert results == [[EntityMention("a", 3, 11, "LOC", "", None, None, False)], []]
+
+
+def test_mentions_to_array(nlp):
+    doc = _process(nlp, benchmarking.make_synthetic_doc(nlp, 20))
+    doc_mentions = mentions.doc_to_mentions(doc, "r1")
+    array = mentions.mentions_to_array(doc_mentions)
+
+    assert array.dtype == mentions.MENTION_DTYPE
+    assert array["start_char"].tolist() == [m.start_char for m in doc_mentions]
+    assert array["label"].tolist() == [m.label for m in doc_mentions]
+    assert set(array["record_id"]) == {"r1"}
+
+
+def test_mentions_to_arrow(nlp):
+    pytest.importorskip("pyarrow")
+    doc = _process(nlp, benchmarking.make_synthetic_doc(nlp, 20))
+    doc_mentions = mentions.doc_to_mentions(doc, "r1")
+    batch = mentions.mentions_to_arrow(doc_mentions)
+
+    assert batch.schema.names == list(mentions.MENTION_FIELDS)
+    assert batch.num_rows == len(doc_mentions)
+    assert batch.column("end_char").to_pylist() == [m.end_char for m in doc_mentions]
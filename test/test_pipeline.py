@@ -1,4 +1,4 @@
-from hc_nlp import pipeline, constants, io
+from hc_nlp import pipeline, constants, io, benchmarking
 import spacy
 import os
 
@@ -432,3 +432,323 @@ def test_duplicate_entity_detector_loc():
     assert all(
         [doc_modified.ents[idx]._.entity_duplicate is False for idx in (0, 1, 5, 6, 7)]
     )
+
+
+def test_entity_filter_matches_token_rules():
+    """
+    The vectorised EntityFilter should keep exactly the entities with at least one token
+    that `_is_unlikely_entity` considers likely, apart from entities with ignored labels.
+    """
+    nlp = spacy.blank("en")
+    doc = nlp(
+        "In 1850 the ENGINE was built by a Victorian firm, Maudslay Sons and Field, for HMS Agamemnon in London on 12/03/1850 ."
+    )
+    spans = [(1, 2, "DATE"), (3, 4, "PRODUCT"), (6, 8, "ORG"), (8, 9, "NORP")]
+    spans += [(10, 11, "ORG"), (11, 14, "ORG"), (14, 15, "ORG"), (15, 16, "PUNCT")]
+    spans += [
+        (17, 19, "PRODUCT"),
+        (20, 21, "GPE"),
+        (22, 23, "DATE"),
+        (23, 24, "CARDINAL"),
+    ]
+
+    for kwargs in [
+        {},
+        {"remove_all_upper": True},
+        {"max_token_length": 3, "remove_all_lower": False},
+        {"ent_labels_ignore": ["NORP", "PUNCT"]},
+    ]:
+        doc.ents = [spacy.tokens.Span(doc, s, e, label) for (s, e, label) in spans]
+        ent_filter = pipeline.EntityFilter(nlp, "entity_filter", **kwargs)
+        expected = [
+            (ent.start, ent.end, ent.label_)
+            for ent in doc.ents
+            if ent.label_ in ent_filter.ent_labels_ignore
+            or any([not ent_filter._is_unlikely_entity(tok) for tok in ent])
+        ]
+
+        doc_filtered = ent_filter(doc)
+
+        assert [(e.start, e.end, e.label_) for e in doc_filtered.ents] == expected
+
+
+def test_entity_joiner_single_sweep_matches_passes():
+    """Running the EntityJoiner as one sweep gives the same result as running its three passes in turn."""
+    nlp = spacy.blank("en")
+    e_j = pipeline.EntityJoiner(nlp, "entity_joiner")
+
+    for seed in range(20):
+        doc = benchmarking.make_synthetic_doc(nlp, 50, seed=seed)
+        doc_passes = benchmarking.make_synthetic_doc(nlp, 50, seed=seed)
+
+        doc = e_j(doc)
+        doc_passes = e_j._join_consecutive_ents_with_same_label(doc_passes)
+        doc_passes = e_j._join_comma_separated_locs(doc_passes)
+        doc_passes = e_j._detect_joined_person_entities(doc_passes)
+
+        assert [
+            (ent.start, ent.end, ent.label_, ent._.alt_ent_text) for ent in doc.ents
+        ] == [
+            (ent.start, ent.end, ent.label_, ent._.alt_ent_text)
+            for ent in doc_passes.ents
+        ]
+
+
+def test_date_matcher_century_patterns():
+    """Century dates are found from token sequences alone, in a pipeline without a parser."""
+    nlp = spacy.blank("en")
+    d_m = pipeline.DateMatcher(nlp, "date_matcher", century_detection="patterns")
+
+    for text, expected in [
+        ("It was built in the 19th century.", "the 19th century"),
+        ("Made in the late eighteenth century AD by hand.", "the late eighteenth century AD"),
+        ("Used from the 18th to 19th centuries.", "the 18th to 19th centuries"),
+        ("Found in the second half of the 19th century.", "the second half of the 19th century"),
+    ]:
+        doc = d_m(nlp(text))
+
+        assert [ent.text for ent in doc.ents if ent.label_ == "DATE"] == [expected]
+
+
+def test_date_matcher_century_patterns_matches_parser():
+    """
+    On the Label Studio test set, the parser-free century detection finds the same century
+    dates as the parser-based detection for most of them. The parser doesn't always attach
+    phrases like "second half of" to the word 'century', so the spans won't all be identical.
+    """
+    d_m_parser = pipeline.DateMatcher(nlp, "date_matcher")
+    d_m_patterns = pipeline.DateMatcher(
+        nlp, "date_matcher", century_detection="patterns"
+    )
+
+    data = io.load_text_and_annotations_from_labelstudio(
+        test_data_path, spacy_model=nlp, adjust_entity_boundaries=False
+    )
+
+    n_parser, n_same = 0, 0
+    for text, _ in data:
+        if "centur" not in text.lower():
+            continue
+
+        doc = nlp(text)
+        doc.ents = []
+        ents_parser = {
+            (ent.start, ent.end) for ent in d_m_parser._add_centuries_to_doc(doc).ents
+        }
+        doc.ents = []
+        ents_patterns = {
+            (ent.start, ent.end)
+            for ent in d_m_patterns._add_centuries_to_doc(doc).ents
+        }
+
+        n_parser += len(ents_parser)
+        n_same += len(ents_parser & ents_patterns)
+
+    assert n_parser > 0
+    assert n_same / n_parser >= 0.75
+
+
+def test_date_matcher_combined_regex_matches_pattern_matcher():
+    """The DateMatcher's combined token regex finds the same dates as the original DATE_PATTERNS."""
+    nlp = spacy.blank("en")
+    d_m = pipeline.DateMatcher(nlp, "date_matcher")
+    p_m = pipeline.PatternMatcher(nlp, "pattern_matcher", constants.DATE_PATTERNS)
+
+    text = "Made c.1200 - 1220 and c. 1300, on 03/12/2000, 3.12.99, 03-12-2000 or 1805 to 1860."
+
+    assert [(ent.start, ent.end) for ent in d_m(nlp(text)).ents] == [
+        (ent.start, ent.end) for ent in p_m(nlp(text)).ents
+    ]
+
+
+def test_date_matcher_prescan():
+    """Docs without digits or the word 'century' skip the matching steps, which is counted in `stats`."""
+    nlp = spacy.blank("en")
+    d_m = pipeline.DateMatcher(nlp, "date_matcher", century_detection="patterns")
+
+    doc = d_m(nlp("A brass microscope by Thompson of London, late 19th century."))
+    assert [ent.text for ent in doc.ents] == ["late 19th century"]
+
+    doc = d_m(nlp("A brass microscope by Thompson of London."))
+    assert len(doc.ents) == 0
+
+    assert d_m.stats["docs"] == 2
+    assert d_m.stats["century_steps_skipped"] == 1
+    assert d_m.stats["pattern_steps_skipped"] == 1
+    assert d_m.stats["seconds_saved"] > 0
+
+
+def test_date_matcher_century_overlap_policy():
+    """Century dates overlapping existing entities are kept or dropped depending on the policy."""
+    nlp = spacy.blank("en")
+    text = "Made in the late 19th century and sold in the 20th century."
+
+    for policy, expected, n_conflicts in [
+        ("existing", ["in the late 19th", "the 20th", "century"], 2),
+        ("longest", ["in the late 19th", "the 20th century"], 1),
+        ("rule", ["the late 19th century", "the 20th century"], 0),
+    ]:
+        d_m = pipeline.DateMatcher(
+            nlp,
+            "date_matcher",
+            century_detection="patterns",
+            century_overlap_policy=policy,
+        )
+        doc = nlp(text)
+        doc.ents = [
+            spacy.tokens.Span(doc, 1, 5, "ORG"),
+            spacy.tokens.Span(doc, 9, 11, "DATE"),
+            spacy.tokens.Span(doc, 11, 12, "NORP"),
+        ]
+        doc = d_m._add_centuries_to_doc(doc)
+
+        assert [ent.text for ent in doc.ents] == expected
+        assert d_m.stats["century_conflicts"] == n_conflicts
+
+
+def test_rule_matcher_matches_separate_components():
+    """
+    The rule_matcher finds the same entities as the thesaurus_matcher, date_matcher and
+    pattern_matcher components one after the other.
+    """
+    thesaurus_path = os.path.join(os.path.dirname(__file__), "test_thesaurus.jsonl")
+    texts = [
+        "Built by Thames Archway Company for the Sforza Collection in the late 19th century, c.1200 - 1220.",
+        "AquaPro BV and HMS Antelope (1929) in 1805 to 1860 and the Charles Urban Archive on 03/12/2000.",
+    ]
+
+    nlp_separate = spacy.blank("en")
+    nlp_separate.add_pipe("thesaurus_matcher", config={"thesaurus_path": thesaurus_path})
+    nlp_separate.add_pipe("date_matcher", config={"century_detection": "patterns"})
+    nlp_separate.add_pipe(
+        "pattern_matcher", config={"patterns": constants.COLLECTION_NAME_PATTERNS}
+    )
+
+    nlp_combined = spacy.blank("en")
+    nlp_combined.add_pipe(
+        "rule_matcher",
+        config={
+            "thesaurus_path": thesaurus_path,
+            "century_detection": "patterns",
+            "pattern_sources": {"collection_names": constants.COLLECTION_NAME_PATTERNS},
+        },
+    )
+
+    for doc_separate, doc_combined in zip(
+        nlp_separate.pipe(texts), nlp_combined.pipe(texts)
+    ):
+        assert len(doc_combined.ents) > 0
+        assert [(e.start, e.end, e.label_, e.ent_id_) for e in doc_combined.ents] == [
+            (e.start, e.end, e.label_, e.ent_id_) for e in doc_separate.ents
+        ]
+
+
+def test_rule_matcher_priorities():
+    """Matches from sources with higher priority win over longer matches from other sources."""
+    nlp = spacy.blank("en")
+    patterns = {
+        "short": [{"label": "ORG", "pattern": "Science Museum"}],
+        "long": [{"label": "FAC", "pattern": "Science Museum Library"}],
+    }
+
+    for priorities, expected in [
+        ({}, ("Science Museum", "ORG")),
+        ({"long": 2}, ("Science Museum Library", "FAC")),
+    ]:
+        r_m = pipeline.RuleMatcher(
+            nlp,
+            "rule_matcher",
+            thesaurus_path=None,
+            case_sensitive=False,
+            cache_dir=None,
+            batch_size=1000,
+            n_process=1,
+            backend="phrase_matcher",
+            delta_paths=[],
+            dates=False,
+            century_detection="parser",
+            pattern_sources=patterns,
+            priorities=priorities,
+            overwrite_ents=False,
+        )
+        doc = r_m(nlp("Visit the Science Museum Library today."))
+
+        assert [(ent.text, ent.label_) for ent in doc.ents] == [expected]
+
+
+def test_MapEntityTypes_remaps_labels_in_place():
+    """Labels are remapped without merging adjacent entities, and unmapped docs are left as they are."""
+    nlp = spacy.blank("en")
+    mapper = pipeline.MapEntityTypes(nlp, "map_entity_types")
+
+    doc = nlp("London UK and the Science Museum")
+    doc.ents = [
+        spacy.tokens.Span(doc, 0, 1, "GPE", kb_id="london"),
+        spacy.tokens.Span(doc, 1, 2, "LOC"),
+        spacy.tokens.Span(doc, 4, 6, "ORG"),
+    ]
+    doc = mapper(doc)
+
+    assert [(ent.text, ent.label_, ent.kb_id_) for ent in doc.ents] == [
+        ("London", "LOC", "london"),
+        ("UK", "LOC", ""),
+        ("Science Museum", "ORG", ""),
+    ]
+
+    doc = nlp("the Science Museum")
+    doc.ents = [spacy.tokens.Span(doc, 1, 3, "ORG")]
+    ents = doc.ents
+    assert mapper(doc).ents == ents
+
+
+def test_hc_postprocess_matches_chained_components():
+    """The fused hc_postprocess component gives the same output as the four components in turn."""
+    nlp = spacy.blank("en")
+    chained = [
+        pipeline.EntityFilter(nlp, "entity_filter"),
+        pipeline.EntityJoiner(nlp, "entity_joiner"),
+        pipeline.MapEntityTypes(nlp, "map_entity_types"),
+        pipeline.DuplicateEntityDetector(nlp, "duplicate_entity_detector"),
+    ]
+    fused = pipeline.HCPostprocess(nlp, "hc_postprocess")
+
+    def make_docs():
+        doc = nlp(
+            "King George visited Brighton , Sussex in the year 1850 with Katharine and Charles Parsons . Parsons stayed 3 years ."
+        )
+        doc.ents = [
+            spacy.tokens.Span(doc, s, e, label)
+            for (s, e, label) in [
+                (1, 2, "PERSON"),
+                (3, 4, "GPE"),
+                (5, 6, "GPE"),
+                (7, 10, "DATE"),
+                (11, 12, "PERSON"),
+                (13, 15, "PERSON"),
+                (16, 17, "PERSON"),
+                (18, 20, "DATE"),
+            ]
+        ]
+
+        return [doc] + [
+            benchmarking.make_synthetic_doc(nlp, 50, seed=seed) for seed in range(10)
+        ]
+
+    def ent_tuples(doc):
+        return [
+            (
+                ent.start,
+                ent.end,
+                ent.label_,
+                ent._.alt_ent_text,
+                ent._.entity_co_occurrence,
+                ent._.entity_duplicate,
+            )
+            for ent in doc.ents
+        ]
+
+    for doc_chained, doc_fused in zip(make_docs(), make_docs()):
+        for component in chained:
+            doc_chained = component(doc_chained)
+
+        assert ent_tuples(fused(doc_fused)) == ent_tuples(doc_chained)
@@ -0,0 +1,163 @@
+from hc_nlp import result_cache, corpus
+import spacy
+import json
+import os
+
+thesaurus_path = os.path.join(os.path.dirname(__file__), "test_thesaurus.jsonl")
+
+
+def test_pipeline_fingerprint(tmp_path, monkeypatch):
+    nlp = spacy.blank("en")
+    nlp.add_pipe("date_matcher")
+    fingerprint = result_cache.pipeline_fingerprint(nlp)
+
+    nlp_same = spacy.blank("en")
+    nlp_same.add_pipe("date_matcher")
+    assert result_cache.pipeline_fingerprint(nlp_same) == fingerprint
+    assert result_cache.pipeline_fingerprint(nlp_same, extra="v2") != fingerprint
+
+    # the installed version of hc_nlp is covered by default
+    monkeypatch.setattr(result_cache, "hc_nlp_version", lambda: "0.0.0")
+    assert result_cache.pipeline_fingerprint(nlp_same) != fingerprint
+    monkeypatch.undo()
+
+    nlp_config = spacy.blank("en")
+    nlp_config.add_pipe("date_matcher", config={"century_detection": "patterns"})
+    assert result_cache.pipeline_fingerprint(nlp_config) != fingerprint
+
+    # changing the contents of the thesaurus changes the fingerprint
+    path = str(tmp_path / "thesaurus.jsonl")
+    with open(thesaurus_path) as f_in, open(path, "w") as f_out:
+        f_out.writelines(f_in.readlines()[:100])
+
+    nlp_thesaurus = spacy.blank("en")
+    nlp_thesaurus.add_pipe("thesaurus_matcher", config={"thesaurus_path": path})
+    thesaurus_fingerprint = result_cache.pipeline_fingerprint(nlp_thesaurus)
+
+    with open(path, "a") as f:
+        f.write('{"label": "ORG", "pattern": "Test Org", "id": "test"}\n')
+    assert result_cache.pipeline_fingerprint(nlp_thesaurus) != thesaurus_fingerprint
+
+
+def test_result_cache(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    ents = [[0, 4, "DATE", "", None, None, False]]
+
+    with result_cache.ResultCache(path, "a") as cache:
+        cache.put_many({"h1": ents, "h2": []})
+        assert cache.get_many(["h1", "h2", "h3"]) == {"h1": ents, "h2": []}
+        assert (cache.hits, cache.misses) == (2, 1)
+
+    # results persist, and are only found for the same fingerprint
+    with result_cache.ResultCache(path, "a") as cache:
+        assert cache.get_many(["h1"]) == {"h1": ents}
+    with result_cache.ResultCache(path, "b") as cache:
+        assert cache.get_many(["h1"]) == {}
+
+
+def test_result_cache_eviction(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    ents = [[0, 4, "DATE", "", None, None, False]]
+    size = len(result_cache.json.dumps(ents))
+
+    with result_cache.ResultCache(path, "a", max_bytes=10 * size) as cache:
+        cache.put_many({f"h{idx}": ents for idx in range(5)})
+        # h0 is used again, so it's more recent than h1-h4
+        cache.get_many(["h0"])
+        cache.put_many({f"h{idx}": ents for idx in range(5, 11)})
+
+        assert cache.n_bytes <= 10 * size
+        assert len(cache) == 9
+        assert set(cache.get_many([f"h{idx}" for idx in range(11)])) == {
+            "h0",
+            *[f"h{idx}" for idx in range(3, 11)],
+        }
+
+
+def test_process_corpus_with_cache(tmp_path):
+    nlp = spacy.blank("en")
+    nlp.add_pipe("date_matcher")
+    texts = ["Made c.1200 - 1220.", "No dates here.", "On 03/12/2000."]
+    records = [(str(idx), text) for idx, text in enumerate(texts)]
+
+    cache = result_cache.ResultCache(
+        str(tmp_path / "cache.sqlite"), result_cache.pipeline_fingerprint(nlp)
+    )
+    expected = list(corpus.process_corpus(nlp, records))
+
+    assert list(corpus.process_corpus(nlp, records[:2], cache=cache)) == expected[:2]
+    assert (cache.hits, cache.misses) == (0, 2)
+
+    assert list(corpus.process_corpus(nlp, records, cache=cache, window_size=2)) == expected
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_process_corpus_with_cache_streams(tmp_path, monkeypatch):
+    nlp = spacy.blank("en")
+    nlp.add_pipe("date_matcher")
+    records = [(str(idx), f"Made in {1800 + idx}.") for idx in range(40)]
+    expected = list(corpus.process_corpus(nlp, records, dedupe=False))
+
+    cache = result_cache.ResultCache(
+        str(tmp_path / "cache.sqlite"), result_cache.pipeline_fingerprint(nlp)
+    )
+    list(corpus.process_corpus(nlp, records[::2], cache=cache))
+
+    pipe_calls = []
+    pipe = nlp.pipe
+
+    def counting_pipe(*args, **kwargs):
+        # with as_tuples, nlp.pipe calls itself again without
+        if kwargs.get("as_tuples"):
+            pipe_calls.append(1)
+
+        return pipe(*args, **kwargs)
+
+    monkeypatch.setattr(nlp, "pipe", counting_pipe)
+
+    # every window has cache misses, which are all processed by one nlp.pipe call
+    assert list(corpus.process_corpus(nlp, records, cache=cache, window_size=4)) == expected
+    assert len(pipe_calls) == 1
+
+    assert list(corpus.process_corpus(nlp, records, cache=cache, window_size=4)) == expected
+    assert len(pipe_calls) == 1
+
+
+def test_annotate_corpus_cache_key_extra(tmp_path, monkeypatch):
+    nlp = spacy.blank("en")
+    nlp.add_pipe("date_matcher")
+    input_path = str(tmp_path / "records.jsonl")
+    output_path = str(tmp_path / "output.jsonl")
+    cache_path = str(tmp_path / "cache.sqlite")
+
+    with open(input_path, "w") as f:
+        for idx in range(10):
+            f.write(json.dumps({"id": idx, "text": f"Made in {1800 + idx}."}) + "\n")
+
+    pipe_calls = []
+    pipe = nlp.pipe
+
+    def counting_pipe(*args, **kwargs):
+        # with as_tuples, nlp.pipe calls itself again without
+        if kwargs.get("as_tuples"):
+            pipe_calls.append(1)
+
+        return pipe(*args, **kwargs)
+
+    monkeypatch.setattr(nlp, "pipe", counting_pipe)
+
+    def annotate(cache_key_extra):
+        corpus.annotate_corpus(
+            nlp, input_path, output_path, cache_path=cache_path, cache_key_extra=cache_key_extra
+        )
+        with open(output_path) as f:
+            return [json.loads(line) for line in f]
+
+    expected = annotate("v1")
+    assert len(pipe_calls) == 1
+
+    # the same extra hits the cache, and a different one misses it
+    assert annotate("v1") == expected
+    assert len(pipe_calls) == 1
+    assert annotate("v2") == expected
+    assert len(pipe_calls) == 2
@@ -0,0 +1,128 @@
+from hc_nlp import snapshot, thesaurus
+from hc_nlp.result_cache import FINGERPRINT_META_KEY, pipeline_fingerprint
+import spacy
+import os
+import shutil
+import srsly
+import pytest
+
+thesaurus_path = os.path.join(os.path.dirname(__file__), "test_thesaurus.jsonl")
+text = (
+    "Zebedee Quibble visited AquaPro BV and HMS Antelope (1929) in the 19th century."
+)
+
+
+def _ent_tuples(doc):
+    return [(ent.start, ent.end, ent.label_, ent.ent_id_) for ent in doc.ents]
+
+
+@pytest.fixture
+def thesaurus_files(tmp_path):
+    """Copies of the test thesaurus and a delta, which tests can delete after saving."""
+    base_path = str(tmp_path / "thesaurus.jsonl")
+    shutil.copy(thesaurus_path, base_path)
+    delta_path = str(tmp_path / "delta.jsonl")
+    srsly.write_jsonl(
+        delta_path,
+        [
+            {
+                "op": "remove",
+                "id": "https://collection.sciencemuseumgroup.org.uk/people/cp135120",
+            },
+            {"op": "add", "label": "PERSON", "pattern": "Zebedee Quibble", "id": "zq"},
+        ],
+    )
+
+    return base_path, delta_path
+
+
+def _forbid_compiling(monkeypatch):
+    monkeypatch.setattr(thesaurus, "read_thesaurus", None)
+    monkeypatch.setattr(thesaurus, "read_delta", None)
+    monkeypatch.setattr(thesaurus, "compile_thesaurus", None)
+    monkeypatch.setattr(thesaurus, "build_trie_automaton", None)
+
+
+@pytest.mark.parametrize("backend", ["phrase_matcher", "trie"])
+def test_snapshot_restores_thesaurus_without_compiling(
+    tmp_path, monkeypatch, thesaurus_files, backend
+):
+    base_path, delta_path = thesaurus_files
+    nlp = spacy.blank("en")
+    nlp.add_pipe(
+        "thesaurus_matcher",
+        config={
+            "thesaurus_path": base_path,
+            "delta_paths": [delta_path],
+            "backend": backend,
+        },
+    )
+    nlp.add_pipe("date_matcher", config={"century_detection": "patterns"})
+    nlp.add_pipe("map_entity_types")
+    expected = _ent_tuples(nlp(text))
+    fingerprint = pipeline_fingerprint(nlp)
+
+    snapshot_path = str(tmp_path / "snapshot")
+    snapshot.save_snapshot(nlp, snapshot_path)
+    assert FINGERPRINT_META_KEY not in nlp.meta
+    os.remove(base_path)
+    os.remove(delta_path)
+    _forbid_compiling(monkeypatch)
+
+    assert snapshot.is_snapshot(snapshot_path)
+    nlp_loaded = snapshot.load_pipeline(snapshot_path)
+
+    assert nlp_loaded.pipe_names == nlp.pipe_names
+    assert len(nlp_loaded.get_pipe("thesaurus_matcher")) == len(
+        nlp.get_pipe("thesaurus_matcher")
+    )
+    assert _ent_tuples(nlp_loaded(text)) == expected
+    assert ("Zebedee Quibble", "zq") in [
+        (ent.text, ent.ent_id_) for ent in nlp_loaded(text).ents
+    ]
+    assert pipeline_fingerprint(nlp_loaded) == fingerprint
+
+
+def test_snapshot_rule_matcher(tmp_path, monkeypatch, thesaurus_files):
+    base_path, delta_path = thesaurus_files
+    nlp = spacy.blank("en")
+    nlp.add_pipe(
+        "rule_matcher",
+        config={
+            "thesaurus_path": base_path,
+            "delta_paths": [delta_path],
+            "century_detection": "patterns",
+            "pattern_sources": {
+                "ships": [{"label": "OBJECT", "pattern": [{"LOWER": "antelope"}]}]
+            },
+        },
+    )
+    expected = _ent_tuples(nlp(text))
+
+    snapshot_path = str(tmp_path / "snapshot")
+    snapshot.save_snapshot(nlp, snapshot_path)
+    os.remove(base_path)
+    _forbid_compiling(monkeypatch)
+
+    assert _ent_tuples(snapshot.load_snapshot(snapshot_path)(text)) == expected
+
+
+def test_is_snapshot(tmp_path):
+    nlp = spacy.blank("en")
+    nlp.to_disk(tmp_path / "plain")
+
+    assert not snapshot.is_snapshot(str(tmp_path / "plain"))
+    assert not snapshot.is_snapshot(str(tmp_path / "missing"))
+
+
+def test_measure_snapshot_startup(tmp_path):
+    def build():
+        nlp = spacy.blank("en")
+        nlp.add_pipe("thesaurus_matcher", config={"thesaurus_path": thesaurus_path})
+
+        return nlp
+
+    timings = snapshot.measure_snapshot_startup(build, str(tmp_path / "snapshot"))
+
+    assert set(timings) == {"build_seconds", "save_seconds", "load_seconds", "speedup"}
+    assert all(value > 0 for value in timings.values())
@@ -0,0 +1,358 @@
+from hc_nlp import pipeline, thesaurus
+import spacy
+import os
+import pickle
+import srsly
+import pytest
+
+thesaurus_path = os.path.join(os.path.dirname(__file__), "test_thesaurus.jsonl")
+text = "The AquaPro BV pump was supplied to HMS Antelope (1929) by aquapro bv."
+
+
+def _ent_tuples(doc):
+    return [(ent.start, ent.end, ent.label_, ent.ent_id_) for ent in doc.ents]
+
+
+def test_thesaurus_matcher_sets_ent_ids():
+    nlp = spacy.blank("en")
+    nlp.add_pipe("thesaurus_matcher", config={"thesaurus_path": thesaurus_path})
+    doc = nlp(text)
+
+    assert ("AquaPro BV", "ORG") in [(ent.text, ent.label_) for ent in doc.ents]
+    assert {ent.ent_id_ for ent in doc.ents if ent.text == "HMS Antelope (1929)"} == {
+        "https://collection.sciencemuseumgroup.org.uk/people/cp136824"
+    }
+    # matching is case-insensitive by default
+    assert "aquapro bv" in [ent.text for ent in doc.ents]
+
+
+def test_thesaurus_matcher_case_sensitive():
+    nlp = spacy.blank("en")
+    nlp.add_pipe(
+        "thesaurus_matcher",
+        config={"thesaurus_path": thesaurus_path, "case_sensitive": True},
+    )
+    doc = nlp(text)
+
+    assert "AquaPro BV" in [ent.text for ent in doc.ents]
+    assert "aquapro bv" not in [ent.text for ent in doc.ents]
+
+
+def test_thesaurus_matcher_cache(tmp_path, monkeypatch):
+    nlp = spacy.blank("en")
+    nlp.add_pipe(
+        "thesaurus_matcher",
+        config={"thesaurus_path": thesaurus_path, "cache_dir": str(tmp_path)},
+    )
+    cache_files = sorted(os.listdir(tmp_path))
+
+    assert len(cache_files) == 2
+    assert cache_files[0].endswith(thesaurus.COMPILED_SUFFIX)
+    assert cache_files[1] == cache_files[0] + thesaurus.ID_STORE_SUFFIX
+
+    # a second load must read the artifact rather than tokenizing the patterns again
+    def fail_compile(*args, **kwargs):
+        raise AssertionError("thesaurus was recompiled")
+
+    monkeypatch.setattr(thesaurus, "compile_thesaurus", fail_compile)
+
+    nlp_cached = spacy.blank("en")
+    nlp_cached.add_pipe(
+        "thesaurus_matcher",
+        config={"thesaurus_path": thesaurus_path, "cache_dir": str(tmp_path)},
+    )
+
+    assert len(nlp_cached.get_pipe("thesaurus_matcher")) == len(
+        nlp.get_pipe("thesaurus_matcher")
+    )
+    assert _ent_tuples(nlp_cached(text)) == _ent_tuples(nlp(text))
+
+    # changing case sensitivity changes the cache key
+    with pytest.raises(AssertionError):
+        nlp_cased = spacy.blank("en")
+        nlp_cased.add_pipe(
+            "thesaurus_matcher",
+            config={
+                "thesaurus_path": thesaurus_path,
+                "cache_dir": str(tmp_path),
+                "case_sensitive": True,
+            },
+        )
+
+
+def test_pipes_required_for_attr():
+    nlp = spacy.blank("en")
+    nlp.add_pipe("tok2vec")
+    nlp.add_pipe("tagger")
+    nlp.add_pipe("parser")
+    nlp.add_pipe("ner")
+
+    assert thesaurus.pipes_required_for_attr(nlp, "LOWER") == []
+    assert thesaurus.pipes_required_for_attr(nlp, "ORTH") == []
+    assert thesaurus.pipes_required_for_attr(nlp, "TAG") == ["tok2vec", "tagger"]
+    assert thesaurus.pipes_required_for_attr(nlp, "DEP") == [
+        "tok2vec",
+        "tagger",
+        "parser",
+    ]
+
+    with pytest.raises(ValueError):
+        thesaurus.pipes_required_for_attr(nlp, "LEMMA")
+
+
+def test_compile_thesaurus_batched_multiprocess():
+    nlp = spacy.blank("en")
+    entries = thesaurus.read_thesaurus(thesaurus_path)[0:500]
+
+    compiled = thesaurus.compile_thesaurus(nlp, entries, "LOWER", batch_size=64)
+    compiled_mp = thesaurus.compile_thesaurus(
+        nlp, entries, "LOWER", batch_size=64, n_process=2
+    )
+
+    assert len(compiled) == len(compiled_mp) == 500
+    assert list(compiled.iter_entries()) == list(compiled_mp.iter_entries())
+    assert compiled.lengths.tolist() == [
+        len(nlp.make_doc(e["pattern"])) for e in entries
+    ]
+
+
+def test_normalise_text():
+    assert thesaurus.normalise_text("AquaPro BV", case_sensitive=False) == (
+        "aquapro bv",
+        None,
+    )
+    assert thesaurus.normalise_text("AquaPro BV", case_sensitive=True) == (
+        "AquaPro BV",
+        None,
+    )
+
+    norm_text, offsets = thesaurus.normalise_text("Aqua \n Pro\tBV", False)
+    assert norm_text == "aqua pro bv"
+    assert offsets == [0, 1, 2, 3, 4, 7, 8, 9, 10, 11, 12]
+
+
+def test_trie_automaton_find():
+    entries = [
+        {"label": "ORG", "pattern": "he", "id": "1"},
+        {"label": "ORG", "pattern": "she", "id": "2"},
+        {"label": "ORG", "pattern": "his", "id": "3"},
+        {"label": "ORG", "pattern": "hers", "id": "4"},
+    ]
+    automaton = thesaurus.build_trie_automaton(entries, case_sensitive=False)
+
+    assert sorted(automaton.find("uSHErs")) == [(1, 4, 1), (2, 4, 0), (2, 6, 3)]
+
+    automaton = thesaurus.TrieAutomaton.from_bytes(automaton.to_bytes())
+    assert sorted(automaton.find("ahishers")) == [
+        (1, 4, 2),
+        (3, 6, 1),
+        (4, 6, 0),
+        (4, 8, 3),
+    ]
+
+
+def test_thesaurus_matcher_trie_backend(tmp_path):
+    nlp = spacy.blank("en")
+    nlp.add_pipe("thesaurus_matcher", config={"thesaurus_path": thesaurus_path})
+
+    nlp_trie = spacy.blank("en")
+    nlp_trie.add_pipe(
+        "thesaurus_matcher",
+        config={
+            "thesaurus_path": thesaurus_path,
+            "backend": "trie",
+            "cache_dir": str(tmp_path),
+        },
+    )
+
+    assert isinstance(
+        nlp_trie.get_pipe("thesaurus_matcher"), thesaurus.TrieThesaurusMatcher
+    )
+    assert _ent_tuples(nlp_trie(text)) == _ent_tuples(nlp(text))
+
+    # matches must lie on token boundaries
+    assert nlp_trie("xAquaPro BV").ents == ()
+
+    nlp_cached = spacy.blank("en")
+    nlp_cached.add_pipe(
+        "thesaurus_matcher",
+        config={
+            "thesaurus_path": thesaurus_path,
+            "backend": "trie",
+            "cache_dir": str(tmp_path),
+        },
+    )
+    assert _ent_tuples(nlp_cached(text)) == _ent_tuples(nlp(text))
+
+
+def test_id_store(tmp_path):
+    entries = [
+        {"label": "PERSON", "pattern": "Ada Lovelace", "id": "https://example.org/1"},
+        {"label": "ORG", "pattern": "Science Museum", "id": "https://example.org/2"},
+        {"label": "ORG", "pattern": "Royal Society"},
+    ]
+    store = thesaurus.IdStore.from_entries(entries)
+
+    assert len(store) == 3
+    assert [store.label(row) for row in range(3)] == ["PERSON", "ORG", "ORG"]
+    assert [store.ent_id(row) for row in range(3)] == [
+        "https://example.org/1",
+        "https://example.org/2",
+        "",
+    ]
+
+    path = str(tmp_path / "test.ids")
+    store.to_disk(path)
+    mapped_store = thesaurus.IdStore.open(path)
+
+    assert mapped_store.ent_id(1) == "https://example.org/2"
+
+    # a memory-mapped store is pickled by path rather than by value
+    assert len(pickle.dumps(mapped_store)) < len(store.to_bytes())
+    assert pickle.loads(pickle.dumps(mapped_store)).ent_id(0) == store.ent_id(0)
+    assert pickle.loads(pickle.dumps(store)).ent_id(0) == store.ent_id(0)
+
+
+def test_id_store_find_rows(tmp_path):
+    entries = [
+        {"label": "ORG", "pattern": f"Company {idx}", "id": f"https://example.org/{idx % 500}"}
+        for idx in range(2000)
+    ] + [{"label": "ORG", "pattern": "Royal Society"}]
+    store = thesaurus.IdStore.from_entries(entries)
+    path = str(tmp_path / "test.ids")
+    store.to_disk(path)
+
+    for ids in [
+        {"https://example.org/7"},
+        {"https://example.org/7", "https://example.org/499", "https://example.org/500"},
+        {""},
+        set(),
+    ]:
+        expected = [row for row, entry in enumerate(entries) if entry.get("id", "") in ids]
+        assert store.find_rows(ids) == expected
+        assert thesaurus.IdStore.open(path).find_rows(ids) == expected
+
+    assert thesaurus.IdStore.from_entries([]).find_rows({"https://example.org/1"}) == []
+
+
+def test_thesaurus_matcher_id_store_from_cache(tmp_path):
+    nlp = spacy.blank("en")
+    nlp.add_pipe(
+        "thesaurus_matcher",
+        config={"thesaurus_path": thesaurus_path, "cache_dir": str(tmp_path)},
+    )
+    matcher = nlp.get_pipe("thesaurus_matcher")
+
+    assert all(store.path is not None for store in matcher._state.stores)
+    assert {ent.ent_id_ for ent in nlp(text).ents if ent.text == "AquaPro BV"} == {
+        "https://collection.sciencemuseumgroup.org.uk/people/cp135120"
+    }
+
+
+@pytest.mark.parametrize("backend", ["phrase_matcher", "trie"])
+def test_thesaurus_matcher_apply_delta(tmp_path, monkeypatch, backend):
+    delta_path = str(tmp_path / "delta.jsonl")
+    srsly.write_jsonl(
+        delta_path,
+        [
+            # AquaPro BV
+            {
+                "op": "remove",
+                "id": "https://collection.sciencemuseumgroup.org.uk/people/cp135120",
+            },
+            # HMS Antelope (1929)
+            {
+                "op": "change",
+                "label": "OBJECT",
+                "pattern": "HMS Antelope",
+                "id": "https://collection.sciencemuseumgroup.org.uk/people/cp136824",
+            },
+            {"op": "add", "label": "PERSON", "pattern": "Zebedee Quibble", "id": "zq"},
+        ],
+    )
+    config = {
+        "thesaurus_path": thesaurus_path,
+        "backend": backend,
+        "cache_dir": str(tmp_path / "cache"),
+    }
+    delta_text = "Zebedee Quibble visited AquaPro BV and HMS Antelope (1929)."
+
+    nlp = spacy.blank("en")
+    matcher = nlp.add_pipe("thesaurus_matcher", config=config)
+    n_entries = len(matcher)
+    matcher.apply_delta(delta_path, str(tmp_path / "cache"))
+    doc = nlp(delta_text)
+
+    assert len(matcher) == n_entries
+    assert [(ent.text, ent.label_, ent.ent_id_) for ent in doc.ents] == [
+        ("Zebedee Quibble", "PERSON", "zq"),
+        (
+            "HMS Antelope",
+            "OBJECT",
+            "https://collection.sciencemuseumgroup.org.uk/people/cp136824",
+        ),
+    ]
+
+    # loading with the same delta again reads the compiled delta from the cache
+    monkeypatch.setattr(thesaurus, "read_delta", None)
+    nlp_cached = spacy.blank("en")
+    nlp_cached.add_pipe(
+        "thesaurus_matcher", config=dict(config, delta_paths=[delta_path])
+    )
+
+    assert _ent_tuples(nlp_cached(delta_text)) == _ent_tuples(doc)
+
+
+def test_compiled_artifact_is_abstract():
+    class Incomplete(thesaurus._CompiledArtifact):
+        def _to_msg(self) -> dict:
+            return {}
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_backends_agree_on_patterns_with_several_labels(tmp_path):
+    path = str(tmp_path / "thesaurus.jsonl")
+    srsly.write_jsonl(
+        path,
+        [
+            {"label": "PERSON", "pattern": "Babbage", "id": "person"},
+            {"label": "ORG", "pattern": "babbage", "id": "org"},
+            # a later entry with the same label and pattern is ignored
+            {"label": "PERSON", "pattern": "Babbage", "id": "person2"},
+        ],
+    )
+    delta_path = str(tmp_path / "delta.jsonl")
+    srsly.write_jsonl(delta_path, [{"op": "remove", "id": "person"}])
+    duplicate_text = "Babbage met Babbage ."
+
+    results = {}
+    for backend in ["phrase_matcher", "trie"]:
+        nlp = spacy.blank("en")
+        matcher = nlp.add_pipe(
+            "thesaurus_matcher", config={"thesaurus_path": path, "backend": backend}
+        )
+        before = _ent_tuples(nlp(duplicate_text))
+        matcher.apply_delta(delta_path)
+        results[backend] = (before, _ent_tuples(nlp(duplicate_text)))
+
+    assert results["trie"] == results["phrase_matcher"]
+    assert results["trie"] == (
+        [(0, 1, "PERSON", "person"), (2, 3, "PERSON", "person")],
+        [(0, 1, "ORG", "org"), (2, 3, "ORG", "org")],
+    )
+
+
+def test_write_atomically_from_threads(tmp_path):
+    from concurrent.futures import ThreadPoolExecutor
+
+    path = str(tmp_path / "artifact.thesaurus")
+    payloads = [bytes([idx]) * 1_000_000 for idx in range(8)]
+
+    with ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda data: thesaurus._write_atomically(path, data), payloads))
+
+    with open(path, "rb") as f:
+        assert f.read() in payloads
+    assert os.listdir(tmp_path) == ["artifact.thesaurus"]